@@ -23,22 +23,74 @@ import json
 import logging
 import os
 import re
+import tempfile
+import threading
+from urllib.parse import unquote, urlparse
 
+from ..common.staging.local_staging import (
+    DEFAULT_CONTENT_TYPE,
+    read_content_encoding,
+    read_content_type,
+    write_content_encoding,
+    write_content_type,
+)
 
-def copy_byte_range(infile, outfile, start=None, stop=None, bufsize=16 * 1024):
+
+def copy_byte_range(infile, outfile, start=None, stop=None, bufsize=1024 * 1024):
     """Like shutil.copyfileobj, but only copy a range of the streams.
     Both start and stop are inclusive.
     """
     if start is not None:
         infile.seek(start)
     while 1:
-        to_read = min(bufsize, stop + 1 - infile.tell() if stop else bufsize)
+        to_read = min(bufsize, stop + 1 - infile.tell() if stop is not None else bufsize)
+        if to_read <= 0:
+            break
         buf = infile.read(to_read)
         if not buf:
             break
         outfile.write(buf)
 
 
+def sendfile_range(infile, sock, start, stop):
+    """Sends bytes start-stop (inclusive) of a file to a socket without copying them through user space"""
+    offset = start
+    remaining = stop + 1 - start
+    while remaining > 0:
+        sent = os.sendfile(sock.fileno(), infile.fileno(), offset, remaining)
+        if sent == 0:
+            break
+        offset += sent
+        remaining -= sent
+
+
+def iter_request_body(rfile, headers, bufsize=1024 * 1024):
+    """Yields the body of a request in pieces, reading either Content-Length bytes or a chunked transfer-encoding"""
+    if "chunked" in headers.get("Transfer-Encoding", "").lower():
+        while True:
+            size = int(rfile.readline().split(b";", 1)[0].strip(), 16)
+            if size == 0:
+                # Skip trailers up to the terminating empty line
+                while rfile.readline().strip():
+                    pass
+                return
+            while size > 0:
+                buf = rfile.read(min(bufsize, size))
+                if not buf:
+                    raise ValueError("Incomplete chunked request body")
+                size -= len(buf)
+                yield buf
+            rfile.readline()
+    else:
+        remaining = int(headers.get("Content-Length", 0))
+        while remaining > 0:
+            buf = rfile.read(min(bufsize, remaining))
+            if not buf:
+                raise ValueError("Incomplete request body")
+            remaining -= len(buf)
+            yield buf
+
+
 BYTE_RANGE_RE = re.compile(r"bytes=(\d+)-(\d+)?$")
 
 
@@ -59,81 +111,212 @@ def parse_byte_range(byte_range):
     return first, last
 
 
+def read_sidecar(path):
+    """Returns (content_type, content_encoding) from the .meta file of an object, or None if it has none"""
+    try:
+        with open(path + ".meta") as m:
+            lines = m.read().splitlines()
+    except OSError:
+        return None
+    # Earlier versions only wrote the content type
+    return (lines[0] if lines else DEFAULT_CONTENT_TYPE), (lines[1] if len(lines) > 1 and lines[1] else None)
+
+
+def write_metadata(path, content_type, content_encoding):
+    """Stores the metadata of an object in extended attributes, or in a .meta file where they are not supported"""
+    if write_content_type(path, content_type) and (
+        not content_encoding or write_content_encoding(path, content_encoding)
+    ):
+        return True
+    with open(path + ".meta", "wt") as m:
+        m.write("{}\n{}".format(content_type, content_encoding or ""))
+    return False
+
+
+def remove_sidecar(path):
+    try:
+        os.remove(path + ".meta")
+    except FileNotFoundError:
+        pass
+
+
+class ObjectInfo:
+    __slots__ = ("size", "last_modified", "content_type", "content_encoding")
+
+    def __init__(self, size, last_modified, content_type, content_encoding=None):
+        self.size = size
+        self.last_modified = last_modified
+        self.content_type = content_type
+        self.content_encoding = content_encoding
+
+
+class ObjectIndex:
+    """
+    In-memory metadata of the stored objects, so that serving, listing and stat do not touch the filesystem.
+    The content type and encoding are persisted as extended attributes of each object where the filesystem supports
+    them, and in a .meta sidecar file otherwise.
+    """
+
+    def __init__(self):
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    def scan(self, root_dir):
+        objects = {}
+        for entry in os.scandir(root_dir):
+            if not entry.is_file() or entry.name.startswith("."):
+                continue
+            if entry.name.endswith(".meta"):
+                continue
+            st = entry.stat()
+            objects[entry.name] = ObjectInfo(st.st_size, st.st_mtime, *self._read_metadata(entry.path))
+        with self._lock:
+            self._objects = objects
+        logging.info("Indexed {} objects in {}".format(len(objects), root_dir))
+
+    def _read_metadata(self, path):
+        """Returns (content_type, content_encoding) of the object at path"""
+        content_type = read_content_type(path, None)
+        if content_type is not None:
+            return content_type, read_content_encoding(path)
+        sidecar = read_sidecar(path)
+        if sidecar is None:
+            return DEFAULT_CONTENT_TYPE, None
+        # Move the metadata of objects written by earlier versions to extended attributes, if supported by now
+        if write_metadata(path, *sidecar):
+            remove_sidecar(path)
+        return sidecar
+
+    def add(self, name, info):
+        with self._lock:
+            self._objects[name] = info
+
+    def get(self, name):
+        return self._objects.get(name)
+
+    def lookup(self, root_dir, name):
+        """Like get, but indexes files placed in root_dir by other writers (e.g. LocalStaging) on first access"""
+        info = self._objects.get(name)
+        if info is not None:
+            return info
+        path = os.path.join(root_dir, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        info = ObjectInfo(st.st_size, st.st_mtime, *self._read_metadata(path))
+        self.add(name, info)
+        return info
+
+    def remove(self, name):
+        with self._lock:
+            return self._objects.pop(name, None)
+
+    def items(self):
+        with self._lock:
+            return list(self._objects.items())
+
+
+class ObjectStoreServer(http.server.ThreadingHTTPServer):
+    """Serves each connection in its own thread, connections are kept alive between requests"""
+
+    daemon_threads = True
+
+    def __init__(self, server_address, root_dir):
+        self.root_dir = os.path.abspath(root_dir)
+        self.index = ObjectIndex()
+        self.index.scan(self.root_dir)
+        super().__init__(server_address, self._handler)
+
+    def _handler(self, request, client_address, server):
+        return HTTPRequestHandler(request, client_address, server, directory=self.root_dir)
+
+
 class HTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
-    """Adds support for HTTP 'Range' requests to SimpleHTTPRequestHandler
-    The approach is to:
-    - Override send_head to look for 'Range' and respond appropriately.
-    - Override copyfile to only transmit a range when requested.
+    """Flat object store on top of SimpleHTTPRequestHandler
+    - PUT streams the body to a temporary file which is renamed into place once complete.
+    - GET supports 'Range' requests and sends file contents with os.sendfile.
+    - Object metadata is served from the server's in-memory ObjectIndex.
     """
 
-    def _set_headers(self):
-        self.send_response(200)
-        self.send_header("Content-Type", "application/json")
+    protocol_version = "HTTP/1.1"
+
+    def _reply(self, code, message, body=b"", content_type="text/plain"):
+        self.send_response(code, message)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
         self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
 
-    def do_GET(self):
+    def _object_name(self):
+        """Returns the object name addressed by the request path, or None for directories and nested paths"""
         path = self.translate_path(self.path)
         if path.endswith("/"):
-            self._set_headers()
-            output = {}
-            _, _, filenames = next(os.walk(path))
-            for f in filenames:
-                if not f.endswith(".meta"):
-                    output[f] = os.path.getsize(path + f)
-            self.wfile.write(json.dumps(output).encode())
-            return
-        else:
-            return http.server.SimpleHTTPRequestHandler.do_GET(self)
+            return None
+        name = os.path.relpath(path, self.directory)
+        if name == "." or name.startswith(".") or os.sep in name:
+            return None
+        return name
 
-    def guess_type(self, path):
-        with open(path + ".meta") as m:
-            content_type = str(m.read())
-        return content_type
+    def do_GET(self):
+        if self.translate_path(self.path).rstrip("/") == self.directory.rstrip("/"):
+            # Listing of all objects
+            output = {
+                name: {"size": info.size, "last_modified": info.last_modified}
+                for name, info in self.server.index.items()
+            }
+            self._reply(200, "OK", json.dumps(output).encode(), "application/json")
+            return
+        f = self.send_head()
+        if f:
+            try:
+                self.copyfile(f, self.wfile)
+            finally:
+                f.close()
 
     def send_head(self):
-        isRange = True
-        if "Range" not in self.headers:
-            self.headers["Range"] = "bytes=0-"
-            isRange = False
+        isRange = "Range" in self.headers
         try:
-            self.range = parse_byte_range(self.headers["Range"])
+            first, last = parse_byte_range(self.headers["Range"] if isRange else "bytes=0-")
         except ValueError:
             self.send_error(400, "Invalid byte range")
             return None
-        first, last = self.range
-
-        # Mirroring SimpleHTTPServer.py here
-        path = self.translate_path(self.path)
-        f = None
 
+        name = self._object_name()
+        info = self.server.index.lookup(self.directory, name) if name is not None else None
+        if info is None:
+            self.send_error(404, "File not found")
+            return None
         try:
-            f = open(path, "rb")
-            ctype = self.guess_type(path)
-        except Exception:
+            f = open(os.path.join(self.directory, name), "rb")
+        except OSError:
+            # Removed behind our back
+            self.server.index.remove(name)
             self.send_error(404, "File not found")
             return None
 
-        fs = os.fstat(f.fileno())
-        file_len = fs[6]
-
+        file_len = os.fstat(f.fileno()).st_size
         if file_len != 0 and first >= file_len:
+            f.close()
             self.send_error(416, "Requested Range Not Satisfiable")
             return None
 
+        if last is None or last >= file_len:
+            last = file_len - 1
+        self.range = (first, last)
+
         if isRange:
             self.send_response(206)
         else:
             self.send_response(200)
-        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Type", info.content_type)
+        if info.content_encoding:
+            self.send_header("Content-Encoding", info.content_encoding)
         self.send_header("Accept-Ranges", "bytes")
-
-        if last is None or last >= file_len:
-            last = file_len - 1
-        response_length = last - first + 1
-
         self.send_header("Content-Range", "bytes %s-%s/%s" % (first, last, file_len))
-        self.send_header("Content-Length", str(response_length))
-        self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
+        self.send_header("Content-Length", str(last - first + 1))
+        self.send_header("Last-Modified", self.date_time_string(info.last_modified))
         self.send_header("Access-Control-Allow-Origin", "*")
         self.send_header("Access-Control-Allow-Methods", "GET, OPTIONS")
         self.send_header("Access-Control-Allow-Headers", "X-Requested-With")
@@ -143,12 +326,15 @@ class HTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         return f
 
     def copyfile(self, source, outputfile):
-        if not self.range:
-            return http.server.SimpleHTTPRequestHandler.copyfile(self, source, outputfile)
-
-        # SimpleHTTPRequestHandler uses shutil.copyfileobj, which doesn't let
-        # you stop the copying before the end of the file.
         start, stop = self.range  # set in send_head()
+        if stop < start:
+            return
+        try:
+            sendfile_range(source, self.connection, start, stop)
+            return
+        except (OSError, AttributeError, ValueError) as e:
+            # e.g. a wrapped socket or a filesystem without sendfile support, fall back to copying
+            logging.debug("sendfile unavailable, copying instead: {}".format(e))
         copy_byte_range(source, outputfile, start, stop)
 
     def do_OPTIONS(self):
@@ -158,47 +344,83 @@ class HTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         self.send_header("Access-Control-Allow-Headers", "X-Requested-With")
         self.send_header("Access-Control-Allow-Headers", "Authorization")
         self.send_header("Access-Control-Allow-Headers", "Content-Type")
+        self.send_header("Content-Length", "0")
         self.end_headers()
 
     def do_PUT(self):
-        path = self.translate_path(self.path)
-        logging.info(path)
-        if path.endswith("/"):
-            self.send_response(405, "Method Not Allowed")
-            self.wfile.write("PUT not allowed on a directory\n".encode())
+        name = self._object_name()
+        logging.debug("Storing object {}".format(name))
+        if name is None:
+            self.close_connection = True
+            self._reply(405, "Method Not Allowed", "PUT not allowed on a directory\n".encode())
+            return
+
+        content_type = self.headers.get("Content-Type", DEFAULT_CONTENT_TYPE)
+        content_encoding = self.headers.get("Content-Encoding")
+        path = os.path.join(self.directory, name)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".put-")
+        os.chmod(tmp, 0o644)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for buf in iter_request_body(self.rfile, self.headers):
+                    f.write(buf)
+            if write_metadata(tmp, content_type, content_encoding):
+                remove_sidecar(path)
+            else:
+                os.replace(tmp + ".meta", path + ".meta")
+            os.replace(tmp, path)
+        except Exception as e:
+            logging.exception("Failed to store {}: {}".format(name, e))
+            os.unlink(tmp)
+            remove_sidecar(tmp)
+            self.close_connection = True
+            self._reply(400, "Bad Request", "Could not create file\n".encode())
             return
-        else:
-            try:
-                os.makedirs(os.path.dirname(path))
-            except FileExistsError:
-                pass
-            length = int(self.headers["Content-Length"])
-            content_type = self.headers["Content-Type"]
-            with open(path, "wb") as f, open(path + ".meta", "wt") as m:
-                f.write(self.rfile.read(length))
-                m.write(content_type)
-            self.send_response(201, "Created")
-            self.end_headers()
-            self.wfile.write("Successfully created file\n".encode())
+
+        st = os.stat(path)
+        self.server.index.add(name, ObjectInfo(st.st_size, st.st_mtime, content_type, content_encoding))
+        self._reply(201, "Created", "Successfully created file\n".encode())
+
+    def do_MOVE(self):
+        """Renames an object to the path given in the 'Destination' header, keeping its metadata"""
+        name = self._object_name()
+        destination = self.headers.get("Destination")
+        dst = None
+        if destination:
+            dst = os.path.basename(unquote(urlparse(destination).path))
+        if name is None or not dst or dst.startswith("."):
+            self._reply(400, "Bad Request", "MOVE needs an object and a destination object\n".encode())
+            return
+        src_path, dst_path = os.path.join(self.directory, name), os.path.join(self.directory, dst)
+        try:
+            os.replace(src_path, dst_path)
+        except FileNotFoundError:
+            self.server.index.remove(name)
+            self._reply(404, "Not Found", "File not found\n".encode())
+            return
+        try:
+            os.replace(src_path + ".meta", dst_path + ".meta")
+        except FileNotFoundError:
+            remove_sidecar(dst_path)
+        info = self.server.index.remove(name)
+        if info is not None:
+            self.server.index.add(dst, info)
+        self._reply(201, "Created", "Successfully moved file\n".encode())
 
     def do_DELETE(self):
-        path = self.translate_path(self.path)
-        if path.endswith("/"):
-            self.send_response(405, "Method Not Allowed")
-            self.end_headers()
-            self.wfile.write("DELETE not allowed on a directory\n".encode())
+        name = self._object_name()
+        if name is None:
+            self._reply(405, "Method Not Allowed", "DELETE not allowed on a directory\n".encode())
             return
-        else:
-            try:
-                os.remove(path)
-                os.remove(path + ".meta")
-                self.send_response(200, "Deleted")
-                self.end_headers()
-                self.wfile.write("Successfully deleted file\n".encode())
-            except Exception:
-                self.send_response(401, "Not deleted")
-                self.end_headers()
-                self.wfile.write("Could not delete file\n".encode())
+        try:
+            self.server.index.remove(name)
+            os.remove(os.path.join(self.directory, name))
+            remove_sidecar(os.path.join(self.directory, name))
+            self._reply(200, "Deleted", "Successfully deleted file\n".encode())
+        except FileNotFoundError:
+            self._reply(404, "Not Found", "File not found\n".encode())
+        except Exception:
+            self._reply(401, "Not deleted", "Could not delete file\n".encode())
 
 
 class BasicObjectStore:
@@ -219,9 +441,8 @@ class BasicObjectStore:
                 logging.info("Could not create the basic object store root directory")
                 raise
 
-        os.chdir(self.root_dir)
         try:
-            httpd = http.server.HTTPServer(("0.0.0.0", int(self.port)), HTTPRequestHandler)
+            httpd = ObjectStoreServer(("0.0.0.0", int(self.port)), self.root_dir)
             logging.info("Serving HTTP on %s port %s ..." % (self.host, self.port))
             logging.info("basic object store started.")
             httpd.serve_forever()
@@ -0,0 +1,124 @@
+#
+# Copyright 2022 European Centre for Medium-Range Weather Forecasts (ECMWF)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+
+import logging
+import os
+import threading
+import time
+
+import requests
+
+
+class JWKSCache:
+    """
+    Per-process store of JSON Web Keys indexed by 'kid'.
+
+    Keys are fetched once and then refreshed by a background thread using conditional requests (ETag), so that
+    verifying a token signature needs no network I/O. A token signed with an unknown 'kid' (e.g. after a key
+    rotation) triggers an immediate refresh, rate-limited by min_refresh_interval so that forged tokens cannot be
+    used to hammer the identity provider.
+    """
+
+    def __init__(self, url, refresh_interval=300, min_refresh_interval=10, timeout=5):
+        self.url = url
+        self.refresh_interval = refresh_interval
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+
+        self._keys = {}
+        self._etag = None
+        self._last_refresh = 0.0
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+        self._thread = None
+        self._pid = None
+
+    def get_key(self, kid):
+        """
+        Returns the key matching kid, suitable for jose.jwt.decode. If kid is None, all known keys are returned as a
+        key set. Raises KeyError if no such key exists, even after a refresh.
+        """
+        self._ensure_started()
+
+        if kid is None:
+            return {"keys": list(self._keys.values())}
+
+        key = self._keys.get(kid)
+        if key is None:
+            self.refresh(force=False)
+            key = self._keys.get(kid)
+        if key is None:
+            raise KeyError("Unknown signing key {}".format(kid))
+        return key
+
+    def refresh(self, force=True):
+        """Fetches the key set, unless it was fetched less than min_refresh_interval ago and force is False"""
+        with self._lock:
+            if not force and time.monotonic() - self._last_refresh < self.min_refresh_interval:
+                return
+            self._last_refresh = time.monotonic()
+
+            headers = {}
+            if self._etag is not None:
+                headers["If-None-Match"] = self._etag
+
+            response = self._session.get(self.url, headers=headers, timeout=self.timeout)
+            if response.status_code == 304:
+                logging.debug("JWKS at {} not modified".format(self.url))
+                return
+            response.raise_for_status()
+
+            keys = {}
+            for key in response.json().get("keys", []):
+                keys[key.get("kid")] = key
+
+            # Replace atomically, readers never take the lock
+            self._keys = keys
+            self._etag = response.headers.get("ETag")
+            logging.debug("Fetched {} signing keys from {}".format(len(keys), self.url))
+
+    def _ensure_started(self):
+        # Threads do not survive a fork, so start (or restart) the refresher in each worker process
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._keys = {}
+            self._etag = None
+            self._last_refresh = 0.0
+            self._session = requests.Session()
+            self._thread = threading.Thread(target=self._run, name="jwks-refresh", daemon=True)
+            self._thread.start()
+        try:
+            self.refresh()
+        except Exception as e:
+            logging.warning("Failed to fetch JWKS from {}: {}".format(self.url, e))
+
+    def _run(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                # Keep serving the keys we have, the next cycle will try again
+                logging.warning("Failed to refresh JWKS from {}: {}".format(self.url, e))
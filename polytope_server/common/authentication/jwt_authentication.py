@@ -20,13 +20,12 @@
 
 import logging
 
-import requests
 from jose import jwt
 
 from ..auth import User
-from ..caching import cache
 from ..exceptions import ForbiddenRequest
 from . import authentication
+from .jwks import JWKSCache
 
 
 class JWTAuthentication(authentication.Authentication):
@@ -35,6 +34,7 @@ class JWTAuthentication(authentication.Authentication):
 
         self.certs_url = config["cert_url"]
         self.client_id = config["client_id"]
+        self.jwks = JWKSCache(self.certs_url, refresh_interval=config.get("jwks_refresh_interval", 300))
 
         super().__init__(name, realm, config)
 
@@ -44,18 +44,12 @@ class JWTAuthentication(authentication.Authentication):
     def authentication_info(self):
         return "Authenticate with JWT token"
 
-    @cache(lifetime=120)
-    def get_certs(self):
-        return requests.get(self.certs_url).json()
-
-    @cache(lifetime=120)
     def authenticate(self, credentials: str) -> User:
 
         try:
-            certs = self.get_certs()
-            decoded_token = jwt.decode(
-                token=credentials, algorithms=jwt.get_unverified_header(credentials).get("alg"), key=certs
-            )
+            header = jwt.get_unverified_header(credentials)
+            key = self.jwks.get_key(header.get("kid"))
+            decoded_token = jwt.decode(token=credentials, algorithms=header.get("alg"), key=key)
 
             logging.info("Decoded JWT: {}".format(decoded_token))
 
@@ -53,8 +53,24 @@ class KeycloakAuthentication(authentication.Authentication):
         # Mapping user attributes to keycloak attributes
         self.attribute_map = config.get("attributes", {})
 
+        # A single client (and its pooled HTTP session) is reused for all users. Proxies are passed explicitly rather
+        # than through os.environ, which is shared by all threads of the frontend.
+        proxy = os.getenv("POLYTOPE_PROXY", "")
+        self.client = KeycloakOpenID(
+            server_url=self.url,
+            client_id=self.client_id,
+            realm_name=self.keycloak_realm,
+            client_secret_key=self.client_secret,
+            verify=(self.skipTLS is False),
+            proxies={"http": proxy, "https": proxy},
+            timeout=self.timeout,
+        )
+
         super().__init__(name, realm, config)
 
+    def cache_id(self):
+        return self.config
+
     def authentication_type(self):
         return "Basic"
 
@@ -73,48 +89,24 @@ class KeycloakAuthentication(authentication.Authentication):
         except ValueError:
             raise ForbiddenRequest("Credentials could not be unpacked")
 
-        _environ = dict(os.environ)
         try:
-            os.environ["http_proxy"] = os.getenv("POLYTOPE_PROXY", "")
-            os.environ["https_proxy"] = os.getenv("POLYTOPE_PROXY", "")
-
-            logging.debug("Setting HTTPS_PROXY to {}".format(os.environ["https_proxy"]))
-
-            try:
-
-                # Open a session as a registered client
-                client = KeycloakOpenID(
-                    server_url=self.url,
-                    client_id=self.client_id,
-                    realm_name=self.keycloak_realm,
-                    client_secret_key=self.client_secret,
-                    verify=(self.skipTLS is False),
-                )
-
-                client.connection.timeout = self.timeout
-
-                # Obtain a session token on behalf of the user
-                token = client.token(auth_user, auth_password)
-
-            except KeycloakConnectionError:
-                # Raise ForbiddenRequest rather than ServerError so that we are not blocked if Keycloak is down
-                raise ForbiddenRequest("Could not connect to Keycloak")
-            except Exception:
-                raise ForbiddenRequest("Invalid Keycloak credentials")
-
-            userinfo = client.userinfo(token["access_token"])
+            # Obtain a session token on behalf of the user
+            token = self.client.token(auth_user, auth_password)
+        except KeycloakConnectionError:
+            # Raise ForbiddenRequest rather than ServerError so that we are not blocked if Keycloak is down
+            raise ForbiddenRequest("Could not connect to Keycloak")
+        except Exception:
+            raise ForbiddenRequest("Invalid Keycloak credentials")
 
-            user = User(auth_user, self.realm())
+        userinfo = self.client.userinfo(token["access_token"])
 
-            logging.debug("Found user {} in keycloak".format(auth_user))
+        user = User(auth_user, self.realm())
 
-            for k, v in self.attribute_map.items():
-                if v in userinfo:
-                    user.attributes[k] = userinfo[v]
-                    logging.debug("User {} has attribute {} : {}".format(user.username, k, user.attributes[k]))
+        logging.debug("Found user {} in keycloak".format(auth_user))
 
-            return user
+        for k, v in self.attribute_map.items():
+            if v in userinfo:
+                user.attributes[k] = userinfo[v]
+                logging.debug("User {} has attribute {} : {}".format(user.username, k, user.attributes[k]))
 
-        finally:
-            os.environ.clear()
-            os.environ.update(_environ)
+        return user
@@ -28,6 +28,7 @@ from ..auth import User
 from ..caching import cache
 from ..exceptions import ForbiddenRequest
 from . import authentication
+from .jwks import JWKSCache
 
 
 class OpenIDOfflineAuthentication(authentication.Authentication):
@@ -43,19 +44,20 @@ class OpenIDOfflineAuthentication(authentication.Authentication):
         self.jwt_aud = config.get("jwt_aud", None)
         self.jwt_iss = config.get("jwt_iss", None)
         self.disable_check = config.get("disable_check", False)
+        self.session = requests.Session()
+        self.jwks = JWKSCache(self.certs_url, refresh_interval=config.get("jwks_refresh_interval", 300))
 
         super().__init__(name, realm, config)
 
+    def cache_id(self):
+        return self.config
+
     def authentication_type(self):
         return "Bearer"
 
     def authentication_info(self):
         return "Authenticate with OpenID offline_access token"
 
-    @cache(lifetime=120)
-    def get_certs(self):
-        return requests.get(self.certs_url).json()
-
     @cache(lifetime=120)
     def check_offline_access_token(self, token: str) -> bool:
         """
@@ -71,7 +73,7 @@ class OpenIDOfflineAuthentication(authentication.Authentication):
         )
         introspection_data = {"token": token}
         b_auth = requests.auth.HTTPBasicAuth(self.private_client_id, self.private_client_secret)
-        resp = requests.post(url=keycloak_token_introspection, data=introspection_data, auth=b_auth).json()
+        resp = self.session.post(url=keycloak_token_introspection, data=introspection_data, auth=b_auth).json()
         if resp["active"] and resp["token_type"] == "Offline":
             return True
         else:
@@ -86,7 +88,7 @@ class OpenIDOfflineAuthentication(authentication.Authentication):
             "refresh_token": credentials,
         }
         keycloak_token_endpoint = self.iam_url + "/realms/" + self.iam_realm + "/protocol/openid-connect/token"
-        resp = requests.post(url=keycloak_token_endpoint, data=refresh_data)
+        resp = self.session.post(url=keycloak_token_endpoint, data=refresh_data)
 
         if resp.ok:
             token = resp.json()["access_token"]
@@ -98,11 +100,11 @@ class OpenIDOfflineAuthentication(authentication.Authentication):
         else:
             resp.raise_for_status()
 
-        certs = self.get_certs()
+        header = jwt.get_unverified_header(token)
         decoded_token = jwt.decode(
             token=token,
-            algorithms=jwt.get_unverified_header(token).get("alg"),
-            key=certs,
+            algorithms=header.get("alg"),
+            key=self.jwks.get_key(header.get("kid")),
             audience=self.jwt_aud,
             issuer=self.jwt_iss,
         )
@@ -111,7 +113,6 @@ class OpenIDOfflineAuthentication(authentication.Authentication):
 
         return decoded_token
 
-    @cache(lifetime=120)
     def authenticate(self, credentials: str) -> User:
         try:
             # Check if this is a valid offline_access token
@@ -18,12 +18,18 @@
 # does it submit to any jurisdiction.
 #
 
-import json
+import contextlib
+import logging
+import os
+import queue
+import threading
+import time
 
 from ldap3 import SUBTREE, Connection, Server
+from ldap3.core.exceptions import LDAPException
+from ldap3.utils.conv import escape_filter_chars
 
 from ..auth import User
-from ..caching import cache
 from . import authorization
 
 
@@ -39,74 +45,238 @@ class LDAPAuthorization(authorization.Authorization):
 
         # Alternative attribute to use instead of user's username
         self.username_attribute = config.get("username-attribute", None)
+
+        # Roles are kept in-process for role_lifetime seconds. Users seen within the last active_window seconds have
+        # their roles re-fetched in batches every refresh_interval seconds, so they never wait on LDAP.
+        self.role_lifetime = config.get("role_lifetime", 120)
+        self.refresh_interval = config.get("refresh_interval", 60)
+        self.active_window = config.get("active_window", 900)
+
+        self.pool = LDAPConnectionPool(
+            self.url,
+            self.ldap_user,
+            self.ldap_password,
+            size=config.get("pool_size", 4),
+            timeout=config.get("timeout", 5),
+        )
+
+        self._roles = {}  # uid -> (roles, fetched_at)
+        self._last_seen = {}  # uid -> last time get_roles was called
+        self._lock = threading.Lock()
+        self._pid = None
+
         super().__init__(name, realm, config)
 
-    @cache(lifetime=120)
     def get_roles(self, user: User) -> list:
         if user.realm != self.realm():
             raise ValueError(
                 "Trying to authorize a user in the wrong realm, expected {}, got {}".format(self.realm(), user.realm)
             )
-        try:
-            if self.username_attribute is None:
-                return retrieve_ldap_user_roles(
-                    user.username, self.filter, self.url, self.search_base, self.ldap_user, self.ldap_password
-                )
-            else:
-                return retrieve_ldap_user_roles(
-                    user.attributes[self.username_attribute],
-                    filter=self.filter,
-                    url=self.url,
-                    search_base=self.search_base,
-                )
-        except KeyError:
+        if self.username_attribute is None:
+            uid = user.username
+        elif self.username_attribute in user.attributes:
+            uid = user.attributes[self.username_attribute]
+        else:
             return []
 
+        self._ensure_started()
+        now = time.monotonic()
+        with self._lock:
+            self._last_seen[uid] = now
+
+        cached = self._roles.get(uid)
+        if cached is not None and now - cached[1] < self.role_lifetime:
+            return list(cached[0])
+
+        roles = self.get_roles_batch([uid])[uid]
+        return list(roles)
+
+    def get_roles_batch(self, uids: list) -> dict:
+        """Resolves the roles of many uids with as few LDAP searches as possible, and caches them in-process"""
+        fetched_at = time.monotonic()
+        result = retrieve_ldap_users_roles(uids, self.filter, self.pool, self.search_base)
+        with self._lock:
+            for uid, roles in result.items():
+                self._roles[uid] = (roles, fetched_at)
+        return result
+
     def get_attributes(self, user: User) -> dict:
         return {}
 
+    def _ensure_started(self):
+        # Threads do not survive a fork, so start the refresher in each worker process
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._roles = {}
+            self._last_seen = {}
+            self.pool.reset()
+            threading.Thread(target=self._run, name="ldap-roles-refresh", daemon=True).start()
+
+    def _run(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh_active_users()
+            except Exception as e:
+                logging.warning("Failed to refresh LDAP roles: {}".format(e))
+
+    def refresh_active_users(self):
+        """Re-fetches roles of recently active users and forgets users who have been idle for too long"""
+        horizon = time.monotonic() - self.active_window
+        with self._lock:
+            idle = [uid for uid, seen in self._last_seen.items() if seen < horizon]
+            for uid in idle:
+                del self._last_seen[uid]
+                self._roles.pop(uid, None)
+            active = list(self._last_seen)
+        if active:
+            self.get_roles_batch(active)
+            logging.debug("Refreshed LDAP roles of {} active users".format(len(active)))
+
 
 #################################################
 
 
-def retrieve_ldap_user_roles(
-    uid: str, filter: str, url: str, search_base: str, ldap_user: str, ldap_password: str
-) -> list:
+class LDAPConnectionPool:
     """
-    Takes an ECMWF UID and returns all roles matching
-    the provided filter 'filter'.
+    Keeps up to [size] bound LDAP connections for reuse, and lets at most [size] be in use at once (further callers
+    wait for one to be returned). A connection is only handed to one thread at a time, and is discarded (and the
+    operation retried once on a fresh connection) if it fails, e.g. because the server dropped it.
     """
 
-    server = Server(url)
+    def __init__(self, url: str, ldap_user: str, ldap_password: str, size: int = 4, timeout: int = 5):
+        self.server = Server(url, connect_timeout=timeout)
+        self.user = "CN={},OU=Connectors,OU=Service Accounts,DC=ecmwf,DC=int".format(ldap_user)
+        self.password = ldap_password
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._in_use = threading.BoundedSemaphore(size)
+
+    def reset(self):
+        self._idle = queue.LifoQueue(maxsize=self.size)
+        self._in_use = threading.BoundedSemaphore(self.size)
+
+    def _connect(self) -> Connection:
+        return Connection(
+            self.server,
+            user=self.user,
+            password=self.password,
+            auto_bind=True,
+            receive_timeout=self.timeout,
+            raise_exceptions=True,
+        )
+
+    def _checkout(self) -> Connection:
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if not conn.closed and conn.bound:
+                return conn
+
+    def _checkin(self, conn: Connection):
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            _unbind(conn)
 
-    connection = Connection(
-        server,
-        user="CN={},OU=Connectors,OU=Service Accounts,DC=ecmwf,DC=int".format(ldap_user),
-        password=ldap_password,
-        raise_exceptions=True,
-    )
+    @contextlib.contextmanager
+    def connection(self):
+        with self._in_use:
+            conn = self._checkout()
+            healthy = True
+            try:
+                yield conn
+            except LDAPException:
+                healthy = False
+                raise
+            finally:
+                # Other errors come from the caller, not from the connection, so it can still be reused
+                if healthy:
+                    self._checkin(conn)
+                else:
+                    _unbind(conn)
 
-    with connection as conn:
-        conn.search(
+    def search(self, **kwargs) -> list:
+        """Runs a search on a pooled connection and returns the response entries"""
+        for attempt in range(2):
+            try:
+                with self.connection() as conn:
+                    conn.search(**kwargs)
+                    return [entry for entry in conn.response if entry.get("type") == "searchResEntry"]
+            except LDAPException as e:
+                if attempt == 1:
+                    raise
+                logging.info("LDAP search failed on pooled connection, retrying on a new one: {}".format(e))
+
+
+def _unbind(conn: Connection):
+    try:
+        conn.unbind()
+    except Exception:
+        pass
+
+
+def _first(value):
+    if isinstance(value, list):
+        return value[0] if value else None
+    return value
+
+
+def _common_name(dn: str) -> str:
+    """Extracts the common name (CN) from a distinguished name such as CN=x,OU=y,OU=z,..."""
+    for rdn in dn.split(","):
+        key, _, value = rdn.partition("=")
+        if key.strip().upper() == "CN":
+            return value
+    raise ValueError("No CN in {}".format(dn))
+
+
+def retrieve_ldap_users_roles(
+    uids: list, filter: str, pool: LDAPConnectionPool, search_base: str, batch_size: int = 100
+) -> dict:
+    """
+    Takes a list of ECMWF UIDs and returns a dict mapping each of them to all roles matching the provided filter
+    'filter'. Users are looked up with a single OR-filter search per batch, users not found in LDAP get no roles.
+    """
+
+    result = {uid: [] for uid in uids}
+    by_name = {str(uid).lower(): uid for uid in uids}
+    names = list(by_name)
+
+    for i in range(0, len(names), batch_size):
+        batch = names[i : i + batch_size]
+        search_filter = "(&(objectClass=person)(|{}))".format(
+            "".join("(cn={})".format(escape_filter_chars(name)) for name in batch)
+        )
+        entries = pool.search(
             search_base=search_base,
-            search_filter="(&(objectClass=person)(cn={}))".format(uid),
+            search_filter=search_filter,
             search_scope=SUBTREE,
-            attributes=["memberOf"],
+            attributes=["cn", "memberOf"],
         )
-        user_data = json.loads(conn.response_to_json())
-        if len(user_data["entries"]) == 0:
-            raise KeyError("User {} not found in LDAP.".format(uid))
-        roles = user_data["entries"][0]["attributes"]["memberOf"]
-
-    # Filter roles
-    matches = []
-    for role in roles:
-        if filter is None or filter in role:
-            matches.append(role)
-
-    # Parse CN=x,OU=y,OU=z,... into dict and extract 'common name' (CN)
-    for i, role in enumerate(matches):
-        d = dict(s.split("=") for s in role.split(","))
-        matches[i] = d["CN"]
-
-    return matches
+        for entry in entries:
+            attributes = entry["attributes"]
+            uid = by_name.get(str(_first(attributes.get("cn"))).lower())
+            if uid is None:
+                continue
+            result[uid] = [
+                _common_name(role) for role in attributes.get("memberOf") or [] if filter is None or filter in role
+            ]
+
+    return result
+
+
+def retrieve_ldap_user_roles(uid: str, filter: str, pool: LDAPConnectionPool, search_base: str) -> list:
+    """
+    Takes an ECMWF UID and returns all roles matching
+    the provided filter 'filter'.
+    """
+    return retrieve_ldap_users_roles([uid], filter, pool, search_base)[uid]
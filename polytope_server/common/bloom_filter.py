@@ -0,0 +1,88 @@
+#
+# Copyright 2022 European Centre for Medium-Range Weather Forecasts (ECMWF)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+
+import hashlib
+import math
+import os
+
+
+class BloomFilter:
+    """
+    Fixed-size set membership test with no false negatives. Sized for capacity items at the given false positive
+    rate, it takes about 1.2 bytes per item at 1%, regardless of the size of the items. The salt changes which items
+    collide, so that filters built with different salts have independent false positives.
+    """
+
+    def __init__(self, capacity, error_rate=0.01, salt=b""):
+        self.capacity = max(1, int(capacity))
+        self.error_rate = error_rate
+        self.num_bits = max(8, int(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / self.capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.salt = salt
+        self.count = 0
+
+    def _positions(self, item):
+        # Double hashing, k positions from the two halves of a single digest
+        digest = hashlib.blake2b(item.encode(), digest_size=16, salt=self.salt).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+    def __len__(self):
+        return self.count
+
+
+class ScalableBloomFilter:
+    """
+    Bloom filter which grows with the number of items added, for when it is not known in advance. Each time the
+    current filter is full a new one is added with twice the capacity and half the error rate, so that the overall
+    false positive rate stays below error_rate. A random salt is used unless one is given.
+    """
+
+    def __init__(self, initial_capacity=100000, error_rate=0.01, salt=None):
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.salt = os.urandom(16) if salt is None else salt
+        self.filters = []
+
+    def add(self, item):
+        if not self.filters or len(self.filters[-1]) >= self.filters[-1].capacity:
+            n = len(self.filters)
+            self.filters.append(BloomFilter(self.initial_capacity * 2**n, self.error_rate / 2 ** (n + 1), self.salt))
+        self.filters[-1].add(item)
+
+    def __contains__(self, item):
+        return any(item in f for f in self.filters)
+
+    def __len__(self):
+        return sum(len(f) for f in self.filters)
+
+    @property
+    def nbytes(self):
+        return sum(len(f.bits) for f in self.filters)
@@ -18,15 +18,26 @@
 # does it submit to any jurisdiction.
 #
 
+import asyncio
+import atexit
+import collections
+import contextlib
+import contextvars
 import datetime
 import functools
 import hashlib
+import inspect
 import io
 import logging
 import pickle
+import threading
+import time
+import uuid
+import weakref
 from abc import ABC, abstractmethod
 
 import pymemcache
+import pymongo
 import redis
 
 from .. import mongo_client_factory
@@ -55,6 +66,101 @@ class Caching(ABC):
     def wipe(self):
         """Wipes the cache"""
 
+    def get_with_ttl(self, key: str) -> tuple:
+        """
+        Gets a cached object by key, along with the number of seconds it has left to live (None if unknown or if it
+        never expires). Raises KeyError if key not found
+        """
+        return self.get(key), None
+
+    def publish_invalidation(self, message: str):
+        """Broadcasts an invalidation message to all replicas subscribed to this cache, if supported"""
+
+    def subscribe_invalidations(self, callback) -> bool:
+        """
+        Calls callback(message) for every invalidation message published by any replica.
+        Returns False if this cache does not support invalidation messages.
+        """
+        return False
+
+    def acquire_lock(self, key: str, timeout: float):
+        """
+        Takes a lock on key shared by all replicas, held for at most [timeout] seconds.
+        Returns a token to pass to release_lock, False if the lock is held by someone else, or None if this cache
+        does not support distributed locks.
+        """
+        return None
+
+    def release_lock(self, key: str, token: str):
+        """Releases a lock taken with acquire_lock, if it is still held with this token"""
+
+
+# ------------------ in-process LRU -----------------
+
+
+class LocalLRUCache:
+    """
+    Bounded in-process cache of serialized values. Entries expire after their own lifetime and the least recently
+    used entries are evicted once either max_entries or max_bytes is exceeded. on_evict(owner) is called for every
+    entry evicted to make room, where owner is the tag given to set().
+    """
+
+    def __init__(self, max_entries=4096, max_bytes=64 * 1024 * 1024, on_evict=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.size = 0
+        self._entries = collections.OrderedDict()  # key -> (data, expiry, size, owner)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        return self.get_with_ttl(key)[0]
+
+    def get_with_ttl(self, key):
+        with self._lock:
+            data, expiry, _, _ = self._entries[key]
+            now = time.monotonic()
+            if expiry is not None and expiry <= now:
+                self._remove(key)
+                raise KeyError(key)
+            self._entries.move_to_end(key)
+            return data, None if expiry is None else expiry - now
+
+    def set(self, key, data, lifetime, owner=None):
+        size = len(data) if isinstance(data, (bytes, bytearray)) else 0
+        if size > self.max_bytes:
+            return
+        expiry = None if not lifetime else time.monotonic() + lifetime
+        evicted = []
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (data, expiry, size, owner)
+            self.size += size
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                old_key = next(iter(self._entries))
+                evicted.append(self._entries[old_key][3])
+                self._remove(old_key)
+        if self.on_evict is not None:
+            for owner in evicted:
+                self.on_evict(owner)
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def wipe(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        self.size -= self._entries.pop(key)[2]
+
 
 # ------------------ globalvar cache -----------------
 
@@ -63,27 +169,25 @@ class GlobalVarCaching(Caching):
     def __init__(self, cache_config):
         super().__init__(cache_config)
         self.config = cache_config
-        self.store = {}
+        self.store = LocalLRUCache(
+            max_entries=cache_config.get("max_entries", 4096),
+            max_bytes=cache_config.get("max_bytes", 64 * 1024 * 1024),
+        )
 
     def get_type(self):
         return "globalvar"
 
     def get(self, key):
-        obj = self.store.get(key, None)
-        if obj is None:
-            raise KeyError()
-        return obj["data"]
+        return self.store.get(key)
+
+    def get_with_ttl(self, key):
+        return self.store.get_with_ttl(key)
 
     def set(self, key, object, lifetime):
-        if lifetime == 0 or lifetime is None:
-            self.store[key] = {"data": object}
-        else:
-            logging.warn("GlobalVarCaching ignores 'lifetime' arguments")
-            expiry = datetime.datetime.now() + datetime.timedelta(seconds=lifetime)
-            self.store[key] = {"data": object, "expiry": expiry}
+        self.store.set(key, object, lifetime)
 
     def wipe(self):
-        self.store = {}
+        self.store.wipe()
 
 
 # ------------------ Memcached -----------------
@@ -125,16 +229,48 @@ class RedisCaching(Caching):
         port = cache_config.get("port", 6379)
         db = cache_config.get("db", 0)
         self.client = redis.Redis(host=host, port=port, db=db)
+        self.channel = cache_config.get("invalidation_channel", "polytope-cache-invalidation")
 
     def get_type(self):
         return "redis"
 
+    def publish_invalidation(self, message):
+        self.client.publish(self.channel, message)
+
+    def subscribe_invalidations(self, callback):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.channel: lambda m: callback(m["data"].decode())})
+        self.invalidation_thread = pubsub.run_in_thread(sleep_time=1, daemon=True)
+        return True
+
+    # Only delete the lock if we still own it, it may have expired and been taken by another replica
+    _release_script = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+    def acquire_lock(self, key, timeout):
+        token = uuid.uuid4().hex
+        if self.client.set("lock-" + key, token, nx=True, px=int(timeout * 1000)):
+            return token
+        return False
+
+    def release_lock(self, key, token):
+        self.client.eval(self._release_script, 1, "lock-" + key, token)
+
     def get(self, key):
         obj = self.client.get(key)
         if obj is None:
             raise KeyError()
         return obj
 
+    def get_with_ttl(self, key):
+        pipeline = self.client.pipeline()
+        pipeline.get(key)
+        pipeline.pttl(key)
+        obj, pttl = pipeline.execute()
+        if obj is None:
+            raise KeyError()
+        # pttl is negative for keys without an expiry
+        return obj, pttl / 1000 if pttl >= 0 else None
+
     def set(self, key, object, lifetime):
         if lifetime == 0 or lifetime is None:
             self.client.set(key, object)
@@ -149,6 +285,12 @@ class RedisCaching(Caching):
 
 
 class MongoDBCaching(Caching):
+    """
+    Hits and misses are counted in-process and flushed to the 'hits' and 'misses' documents every
+    stats_flush_interval seconds with a single bulk write, both in total and per key prefix (the decorated function).
+    Set read_preference (e.g. secondaryPreferred) to serve cache lookups from secondaries.
+    """
+
     def __init__(self, cache_config):
         super().__init__(cache_config)
         uri = cache_config.get("uri", "mongodb://localhost:27017")
@@ -169,16 +311,36 @@ class MongoDBCaching(Caching):
         self.collection.update_one({"_id": "hits"}, {"$setOnInsert": {"n": 0}}, upsert=True)
         self.collection.update_one({"_id": "misses"}, {"$setOnInsert": {"n": 0}}, upsert=True)
 
+        read_preference = cache_config.get("read_preference")
+        if read_preference is None:
+            self.read_collection = self.collection
+        else:
+            mode = pymongo.read_preferences.read_pref_mode_from_name(read_preference)
+            self.read_collection = self.database.get_collection(
+                collection, read_preference=pymongo.read_preferences.make_read_preference(mode, None)
+            )
+
+        self.stats_flush_interval = cache_config.get("stats_flush_interval", 10)
+        self._pending = {"hits": collections.Counter(), "misses": collections.Counter()}
+        self._pending_lock = threading.Lock()
+        self._flusher = None
+        atexit.register(self.flush_stats)
+
     def get_type(self):
         return "mongodb"
 
     def get(self, key):
-        obj = self.collection.find_one({"_id": key})
+        return self.get_with_ttl(key)[0]
+
+    def get_with_ttl(self, key):
+        obj = self.read_collection.find_one({"_id": key})
+        self._count("misses" if obj is None else "hits", key)
         if obj is None:
-            self.collection.update_one({"_id": "misses"}, {"$inc": {"n": 1}})
             raise KeyError()
-        self.collection.update_one({"_id": "hits"}, {"$inc": {"n": 1}})
-        return obj["data"]
+        expiry = obj.get("expire_at")
+        if expiry is None or expiry.year == datetime.MAXYEAR:
+            return obj["data"], None
+        return obj["data"], (expiry - datetime.datetime.now()).total_seconds()
 
     def set(self, key, object, lifetime):
         if lifetime == 0 or lifetime is None:
@@ -193,11 +355,62 @@ class MongoDBCaching(Caching):
         )
 
     def wipe(self):
-        hits = self.collection.find_one({"_id": "hits"})["n"]
-        misses = self.collection.find_one({"_id": "misses"})["n"]
+        self.flush_stats()
+        hits = self.collection.find_one({"_id": "hits"})
+        misses = self.collection.find_one({"_id": "misses"})
         self.collection.drop()
-        self.collection.update_one({"_id": "hits"}, {"$setOnInsert": {"n": hits}}, upsert=True)
-        self.collection.update_one({"_id": "misses"}, {"$setOnInsert": {"n": misses}}, upsert=True)
+        for counter, doc in (("hits", hits), ("misses", misses)):
+            doc = {k: v for k, v in (doc or {"n": 0}).items() if k != "_id"}
+            self.collection.update_one({"_id": counter}, {"$setOnInsert": doc}, upsert=True)
+
+    def stats(self) -> dict:
+        """Returns total and per key prefix hits and misses, including counts not flushed yet"""
+        self.flush_stats()
+        result = {}
+        for counter in ("hits", "misses"):
+            doc = self.collection.find_one({"_id": counter}) or {}
+            result[counter] = doc.get("n", 0)
+            for prefix, n in doc.get("prefixes", {}).items():
+                result.setdefault("prefixes", {}).setdefault(prefix, {"hits": 0, "misses": 0})[counter] = n
+        return result
+
+    def flush_stats(self):
+        """Writes the counts accumulated since the last flush with one bulk $inc"""
+        with self._pending_lock:
+            pending = self._pending
+            self._pending = {"hits": collections.Counter(), "misses": collections.Counter()}
+
+        updates = []
+        for counter, counts in pending.items():
+            if counts:
+                inc = {"prefixes." + prefix: n for prefix, n in counts.items()}
+                inc["n"] = sum(counts.values())
+                updates.append(pymongo.UpdateOne({"_id": counter}, {"$inc": inc}, upsert=True))
+        if updates:
+            self.collection.bulk_write(updates, ordered=False)
+
+    def _count(self, counter, key):
+        # Key prefixes are the decorated function names, escaped for use as field names
+        prefix = key.rpartition("-")[0].replace(".", ":").replace("$", "_")
+        with self._pending_lock:
+            self._pending[counter][prefix] += 1
+        if self._flusher is None:
+            self._start_flusher()
+
+    def _start_flusher(self):
+        with self._pending_lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._flush_periodically, name="cache-stats-flush", daemon=True)
+            self._flusher.start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.stats_flush_interval)
+            try:
+                self.flush_stats()
+            except Exception as e:
+                logging.warning("Could not flush cache statistics: {}".format(e))
 
 
 # ------------------ Decorator -----------------
@@ -218,19 +431,193 @@ class DBPickler(pickle.Pickler):
             return None
 
 
+# ------------------ Cache keys -----------------
+
+# Keys are derived from user-supplied arguments such as credentials, so a collision-resistant hash is required.
+# blake2b is a good deal cheaper than pickling and MD5-ing every argument.
+_KEY_DIGEST_SIZE = 16
+
+_instance_prefixes = weakref.WeakKeyDictionary()
+
+
+def _instance_prefix(obj) -> bytes:
+    """Digest of obj.cache_id(), computed once per instance. cache_id() must not change over an instance's life."""
+    try:
+        return _instance_prefixes[obj]
+    except (KeyError, TypeError):
+        pass
+    buffer = io.BytesIO()
+    DBPickler(buffer, protocol=4).dump(obj.cache_id())
+    prefix = hashlib.blake2b(buffer.getvalue(), digest_size=_KEY_DIGEST_SIZE).digest()
+    try:
+        _instance_prefixes[obj] = prefix
+    except TypeError:
+        pass  # unhashable or not weak-referenceable, recomputed on every call
+    return prefix
+
+
+def _key_fragment(obj) -> bytes:
+    """Encodes one argument, tagged with its type so that e.g. 1 and "1" never produce the same key"""
+    t = type(obj)
+    if t is str:
+        return b"s" + obj.encode("utf-8", "surrogatepass")
+    if t is bytes:
+        return b"b" + obj
+    if t is int or t is bool or t is float or obj is None:
+        return b"n" + repr(obj).encode()
+    if callable(getattr(obj, "cache_id", None)):
+        return b"i" + _instance_prefix(obj)
+    buffer = io.BytesIO()
+    DBPickler(buffer, protocol=4).dump(obj)
+    return b"p" + buffer.getvalue()
+
+
+def cache_key(name: str, args: tuple, kwargs: dict) -> str:
+    """Builds the cache key of a call to the function with fully-qualified-name [name]"""
+    h = hashlib.blake2b(digest_size=_KEY_DIGEST_SIZE)
+    for arg in args:
+        fragment = _key_fragment(arg)
+        h.update(len(fragment).to_bytes(8, "little"))
+        h.update(fragment)
+    for k in sorted(kwargs):
+        fragment = _key_fragment(kwargs[k])
+        h.update(b"k" + k.encode() + len(fragment).to_bytes(8, "little"))
+        h.update(fragment)
+    return "{0}-{1}".format(name, h.hexdigest())
+
+
+# ------------------ Value codecs -----------------
+
+
+class Codec(ABC):
+    """Serializes return values of @cache() decorated functions"""
+
+    name = None
+
+    @abstractmethod
+    def encode(self, obj) -> bytes:
+        pass
+
+    @abstractmethod
+    def decode(self, data: bytes):
+        pass
+
+
+class PickleCodec(Codec):
+    name = "pickle"
+
+    def encode(self, obj):
+        return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data):
+        return pickle.loads(data)
+
+
+class MsgpackCodec(Codec):
+    """Compact and fast for plain data (dicts, lists, strings, numbers), cannot store arbitrary objects"""
+
+    name = "msgpack"
+
+    def __init__(self):
+        import msgpack
+
+        self.msgpack = msgpack
+
+    def encode(self, obj):
+        return self.msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, data):
+        return self.msgpack.unpackb(data, raw=False)
+
+
+class ZstdCodec(Codec):
+    """Pickles values and zstd-compresses those larger than min_size bytes"""
+
+    name = "zstd"
+
+    def __init__(self, level=3, min_size=1024):
+        import zstandard
+
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        self.decompressor = zstandard.ZstdDecompressor()
+        self.min_size = min_size
+
+    def encode(self, obj):
+        data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) < self.min_size:
+            return b"\x00" + data
+        return b"\x01" + self.compressor.compress(data)
+
+    def decode(self, data):
+        if data[:1] == b"\x01":
+            return pickle.loads(self.decompressor.decompress(data[1:]))
+        return pickle.loads(memoryview(data)[1:])
+
+
+codec_map = {
+    "pickle": PickleCodec,
+    "msgpack": MsgpackCodec,
+    "zstd": ZstdCodec,
+}
+
+
+class _KeyLocks:
+    """Hands out one lock per key, and forgets it once nobody holds or waits for it"""
+
+    def __init__(self):
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def hold(self, key):
+        with self._lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+
+# Set by cache.cancel(), local to the thread or asyncio task running the decorated function
+_cancelled = contextvars.ContextVar("cache_cancelled", default=False)
+
+
 class cache(object):
     """
     This class applies a decorator for caching a function. It uses the fully-qualified-name (FQN) of the function and
-    a hash of all function arguments to create a hash key. The return value of the function is serialized and cached.
-    The hash is done using pickle and if it encounters custom types it will traverse the entire __dict__ to create a
-    unique identifier. To override this behaviour, provide a cache_id() function which returns an identifier. This
-    identifier can be a hash or any other picklable object (like a dict). It even works on class methods, where the
+    a hash of all function arguments to create a hash key. The return value of the function is serialized with the
+    selected codec and cached. Strings, bytes and numbers are hashed directly, other arguments are pickled and if
+    pickle encounters custom types it will traverse the entire __dict__ to create a unique identifier. To override
+    this behaviour, provide a cache_id() function which returns an identifier. This identifier can be a hash or any
+    other picklable object (like a dict), and is hashed once per instance. It even works on class methods, where the
     first argument (self) is used as part of the hash. If you want to cache between different instances of a class
     you should define self.cache_id() as described.
+
+    Values are looked up in a bounded in-process LRU first and then in the configured (remote) cache. The LRU keeps
+    entries for at most its own lifetime, and can be kept coherent across replicas by broadcasting invalidations
+    through the remote cache (redis only). Hits, misses and evictions are counted per decorated function.
+
+    Concurrent misses on the same key are collapsed: only one thread (or asyncio task) computes the value while the
+    others wait for it. With caching.distributed_lock enabled (redis only), this extends across replicas. If stale is
+    given, values are kept for another [stale] seconds after they expire, during which they are still returned while
+    a single background call refreshes them. Both plain and async def functions can be decorated.
     """
 
     cache = None
     config = None
+    local = None
+    local_lifetime = None
+    invalidation = False
+    distributed_lock = False
+    lock_timeout = 30
+    origin = uuid.uuid4().hex
+    statistics = {}
+    _stats_lock = threading.Lock()
 
     @classmethod
     def init(cls, config):
@@ -240,10 +627,37 @@ class cache(object):
         if cls.cache is not None and config == cls.config:
             return
         cls.config = config
-        type = next(iter(config.keys()), "mongodb")
+        type = next((k for k in config.keys() if k in type_to_class_map), "mongodb")
         cls.cache = globals()[type_to_class_map[type]](config.get(type, {}))
 
-        logging.info("Caching initialized using {}".format(cls.cache.get_type()))
+        local_config = config.get("local", {})
+        # An in-process backend gains nothing from an extra in-process tier, unless explicitly asked for
+        if not local_config.get("enabled", type != "globalvar"):
+            cls.local = None
+        else:
+            cls.local = LocalLRUCache(
+                max_entries=local_config.get("max_entries", 4096),
+                max_bytes=local_config.get("max_bytes", 64 * 1024 * 1024),
+                on_evict=lambda owner: cls._count(owner, "evictions"),
+            )
+            cls.local_lifetime = local_config.get("lifetime", 60)
+
+        cls.invalidation = False
+        if cls.local is not None and config.get("invalidation", False):
+            cls.invalidation = cls.cache.subscribe_invalidations(cls._on_invalidation)
+            if not cls.invalidation:
+                logging.warning(
+                    "Cache invalidation across replicas disabled, {} does not support it".format(cls.cache.get_type())
+                )
+
+        cls.distributed_lock = config.get("distributed_lock", False)
+        cls.lock_timeout = config.get("lock_timeout", 30)
+
+        logging.info(
+            "Caching initialized using {}{}".format(
+                cls.cache.get_type(), " with a local LRU tier" if cls.local is not None else ""
+            )
+        )
 
     @classmethod
     def wipe(cls):
@@ -251,72 +665,314 @@ class cache(object):
         Wipes the cache entirely.
         """
         cls.cache.wipe()
+        if cls.local is not None:
+            cls.local.wipe()
+            cls._publish("*")
+
+    @classmethod
+    def stats(cls) -> dict:
+        """
+        Returns hit, miss and eviction counters for each decorated function, keyed by its fully-qualified-name.
+        """
+        with cls._stats_lock:
+            return {name: dict(counters) for name, counters in cls.statistics.items()}
+
+    @classmethod
+    def _count(cls, name, counter):
+        with cls._stats_lock:
+            counters = cls.statistics.setdefault(
+                name, {"local_hits": 0, "remote_hits": 0, "stale_hits": 0, "misses": 0, "evictions": 0}
+            )
+            counters[counter] += 1
+
+    @classmethod
+    def _publish(cls, key):
+        if cls.invalidation:
+            try:
+                cls.cache.publish_invalidation("{} {}".format(cls.origin, key))
+            except Exception as e:
+                logging.warning("Could not publish cache invalidation: {}".format(e))
+
+    @classmethod
+    def _on_invalidation(cls, message):
+        origin, _, key = message.partition(" ")
+        if origin == cls.origin or cls.local is None:
+            return
+        if key == "*":
+            cls.local.wipe()
+        else:
+            cls.local.delete(key)
 
     @classmethod
     def cancel(cls):
         """
         When called within a @cache() decorated function, cancel will prevent this function
         from being cached when it returns. This is useful if a function fails and you don't
-        want to cache the failure.
+        want to cache the failure. Only the call running in the current thread or task is affected.
         """
-        cls.cancelled = True
+        _cancelled.set(True)
 
-    def __init__(self, lifetime=0, ignore=None):  # lifetime in seconds
+    def __init__(self, lifetime=0, ignore=None, stale=0, codec="pickle"):  # lifetime in seconds
         """
         Init is called at import-time when the @cache() decorator is used.
+        codec selects how return values are stored, one of codec_map (pickle, msgpack, zstd).
         """
+        if codec not in codec_map:
+            raise ValueError("Unknown cache codec {}, expected one of {}".format(codec, list(codec_map)))
         self.lifetime = lifetime
+        self.stale = stale
+        self.codec_name = codec
+        self._codec = None
+        self._flights = _KeyLocks()
+        self._refreshing = set()
+        self._refreshing_lock = threading.Lock()
+        # Computations running in each event loop, by cache key. Tasks cannot be awaited from another loop.
+        self._tasks = weakref.WeakKeyDictionary()
+        self._tasks_lock = threading.Lock()
 
     def __call__(self, f):
         """
         This function is called when accessing the decorated function.
         """
 
+        name = "{0}-{1}".format(f.__module__, f.__qualname__)
+
+        if inspect.iscoroutinefunction(f):
+
+            @functools.wraps(f)
+            async def async_wrapper(*args, **kwargs):
+                if self.cache is None:
+                    logging.warning("Caching not set up")
+                    return await f(*args, **kwargs)
+
+                cache_key = self._key(name, args, kwargs)
+                try:
+                    result, fresh = await asyncio.to_thread(self._get, name, cache_key)
+                    tasks = self._loop_tasks()
+                    if not fresh and cache_key not in tasks:
+                        tasks[cache_key] = asyncio.ensure_future(self._compute_async(f, name, cache_key, args, kwargs))
+                    return result
+                except KeyError:
+                    pass
+
+                # Single-flight: join the computation already running in this event loop, if any
+                tasks = self._loop_tasks()
+                task = tasks.get(cache_key)
+                if task is None:
+                    task = asyncio.ensure_future(self._compute_async(f, name, cache_key, args, kwargs))
+                    tasks[cache_key] = task
+                return await asyncio.shield(task)
+
+            return async_wrapper
+
         @functools.wraps(f)
         def wrapper(*args, **kwargs):
-            cache.cancelled = False
-
             if self.cache is None:
                 logging.warning("Caching not set up")
                 return f(*args, **kwargs)
 
-            # Hash function args
-            items = sorted(kwargs.items())
-            hashable_args = (args, tuple(items))
-            bytes = io.BytesIO()
-            DBPickler(bytes, protocol=-1).dump(hashable_args)
-            bytes.seek(0)
-            hashed_args = hashlib.md5(bytes.read()).hexdigest()
+            cache_key = self._key(name, args, kwargs)
+            try:
+                result, fresh = self._get(name, cache_key)
+                if not fresh:
+                    self._revalidate(f, name, cache_key, args, kwargs)
+                return result
+            except KeyError:
+                pass
+
+            # Single-flight: only one thread computes a missing key, the others pick up its result
+            with self._flights.hold(cache_key):
+                try:
+                    result, fresh = self._get(name, cache_key, count=False)
+                    if fresh:
+                        return result
+                except KeyError:
+                    pass
+                return self._compute(f, name, cache_key, args, kwargs)
+
+        return wrapper
 
-            # Generate unique cache key
-            cache_key = "{0}-{1}-{2}".format(f.__module__, f.__qualname__, hashed_args)
+    def _key(self, name, args, kwargs):
+        return cache_key(name, args, kwargs)
 
-            # logging.debug(cache_key)
+    @property
+    def codec(self) -> Codec:
+        # Resolved on first use, so that optional codec dependencies are only needed where they are used
+        if self._codec is None:
+            self._codec = codec_map[self.codec_name]()
+        return self._codec
 
-            # Return cached version
+    def _get(self, name, cache_key, count=True):
+        """
+        Returns (result, fresh) for a cached value, from the local tier if possible.
+        Raises KeyError if the key is not cached.
+        """
+        local = self.local
+        cache_result = None
+        if local is not None:
             try:
-                cache_result = self.cache.get(cache_key)
+                cache_result = local.get(cache_key)
+                counter = "local_hits"
+            except KeyError:
+                pass
+
+        if cache_result is None:
+            try:
+                cache_result, remaining = self.cache.get_with_ttl(cache_key)
                 logging.debug("Cache hit with key {}".format(cache_key))
-                result = pickle.loads(cache_result)
-                return result
+                counter = "remote_hits"
+                # The local copy must not outlive the remote entry
+                if local is not None and (remaining is None or remaining > 0):
+                    local.set(cache_key, cache_result, self._local_lifetime(remaining), name)
             except KeyError:
-                logging.info("Cache miss with key {}".format(cache_key))
+                if count:
+                    logging.info("Cache miss with key {}".format(cache_key))
+                    cache._count(name, "misses")
+                raise
+
+        result = self.codec.decode(cache_result)
+        fresh = True
+        if self.stale:
+            # Values that may be served stale are stored along with the time they expire
+            expiry, result = result
+            fresh = time.time() < expiry
+            if not fresh:
+                counter = "stale_hits"
+        if count:
+            cache._count(name, counter)
+        return result, fresh
+
+    def _set(self, name, cache_key, result):
+        if self.stale:
+            result = (time.time() + self.lifetime, result)
+        try:
+            data = self.codec.encode(result)
+        except Exception:
+            logging.warning("Could not cache object, the return type is not serializable.")
+            return
 
-            result = f(*args, **kwargs)
+        logging.debug("Caching function result with key {}".format(cache_key))
 
-            # Cache output
+        self.cache.set(cache_key, data, self.lifetime + self.stale if self.lifetime else 0)
+        if self.local is not None:
+            self.local.set(cache_key, data, self._local_lifetime(), name)
+            cache._publish(cache_key)
 
-            if not cache.cancelled:
+    def _compute(self, f, name, cache_key, args, kwargs):
+        """Calls f and caches its result, holding the distributed lock on the key if enabled"""
+        with self._remote_flight(name, cache_key) as cached:
+            if cached is not None:
+                return cached[0]
+            token = _cancelled.set(False)
+            try:
+                result = f(*args, **kwargs)
+                if not _cancelled.get():
+                    self._set(name, cache_key, result)
+            finally:
+                _cancelled.reset(token)
+        return result
+
+    def _loop_tasks(self):
+        with self._tasks_lock:
+            return self._tasks.setdefault(asyncio.get_running_loop(), {})
+
+    async def _compute_async(self, f, name, cache_key, args, kwargs):
+        try:
+            lock = await asyncio.to_thread(self._acquire_remote, cache_key)
+            try:
+                if lock is False:
+                    cached, lock = await asyncio.to_thread(self._wait_remote, name, cache_key)
+                    if cached is not None:
+                        return cached[0]
+                token = _cancelled.set(False)
                 try:
-                    data = pickle.dumps(result)
-                except Exception:
-                    logging.warning("Could not cache object, the return type is not serializable.")
-                    return result
-
-                logging.debug("Caching function result with key {}".format(cache_key))
+                    result = await f(*args, **kwargs)
+                    if not _cancelled.get():
+                        await asyncio.to_thread(self._set, name, cache_key, result)
+                finally:
+                    _cancelled.reset(token)
+                return result
+            finally:
+                await asyncio.to_thread(self._release_remote, cache_key, lock)
+        finally:
+            self._loop_tasks().pop(cache_key, None)
+
+    def _revalidate(self, f, name, cache_key, args, kwargs):
+        """Refreshes a stale value in a background thread, unless a refresh is already running"""
+        with self._refreshing_lock:
+            if cache_key in self._refreshing:
+                return
+            self._refreshing.add(cache_key)
+
+        def refresh():
+            try:
+                with self._flights.hold(cache_key):
+                    self._compute(f, name, cache_key, args, kwargs)
+            except Exception as e:
+                logging.warning("Could not refresh stale cache key {}: {}".format(cache_key, e))
+            finally:
+                with self._refreshing_lock:
+                    self._refreshing.discard(cache_key)
+
+        threading.Thread(target=refresh, name="cache-revalidate", daemon=True).start()
+
+    @contextlib.contextmanager
+    def _remote_flight(self, name, cache_key):
+        """
+        Takes the distributed lock on cache_key, if enabled. If another replica holds it, waits for that replica to
+        cache the value and yields (result,), or None if we should compute it: because the lock was released without
+        a value (and we took it over), or because the value did not show up in time.
+        """
+        lock = self._acquire_remote(cache_key)
+        cached = None
+        if lock is False:
+            cached, lock = self._wait_remote(name, cache_key)
+        try:
+            yield cached
+        finally:
+            self._release_remote(cache_key, lock)
+
+    def _acquire_remote(self, cache_key):
+        """Returns a lock token, False if the lock is held elsewhere, or None if distributed locks are not in use"""
+        if not self.distributed_lock:
+            return None
+        try:
+            return self.cache.acquire_lock(cache_key, self.lock_timeout)
+        except Exception as e:
+            logging.warning("Could not take distributed cache lock: {}".format(e))
+            return None
 
-                self.cache.set(cache_key, data, self.lifetime)
+    def _release_remote(self, cache_key, lock):
+        if lock:
+            try:
+                self.cache.release_lock(cache_key, lock)
+            except Exception as e:
+                logging.warning("Could not release distributed cache lock: {}".format(e))
 
-            return result
+    def _wait_remote(self, name, cache_key):
+        """
+        Waits for the replica holding the lock on cache_key to cache the value. Returns ((result,), lock) once it is
+        cached, or (None, lock) if the holder released the lock without caching it (e.g. it failed or was cancelled)
+        and we took it over, or if the lock timed out. lock is then our token, to release once done.
+        """
+        deadline = time.monotonic() + self.lock_timeout
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            lock = self._acquire_remote(cache_key)
+            try:
+                result, fresh = self._get(name, cache_key, count=False)
+                if fresh:
+                    return (result,), lock
+            except KeyError:
+                pass
+            if lock is not False:
+                return None, lock
+        return None, None
 
-        return wrapper
+    def _local_lifetime(self, remaining=None):
+        """
+        Local entries live no longer than the function's own lifetime, nor than the local tier allows, nor than the
+        [remaining] seconds of the remote entry they were copied from
+        """
+        lifetimes = [t for t in (self.lifetime, self.local_lifetime, remaining) if t]
+        return min(lifetimes) if lifetimes else 0
@@ -35,6 +35,7 @@ class Collection:
         self.name = name
         self.roles = config.get("roles", {})
         self.limits = config.get("limits", {})
+        self.result_cache = config.get("result_cache", False)
         self.ds_configs = []
 
         if len(self.config.get("datasources", [])) == 0:
@@ -50,12 +51,23 @@ class Collection:
             extra={"collection": self._serialize()},
         )
 
-    def dispatch(self, request: PolytopeRequest, input_data: bytes | None) -> DataSource:
+    def dispatch(self, request: PolytopeRequest, input_data: bytes | None, ds_config: Dict = None) -> DataSource:
         """
-        Match the request against the collection's datasources.
+        Match the request against the collection's datasources, unless already matched to ds_config.
         Instantiates, dispatches and returns the first matching datasource.
         Raises a BadRequest exception if no datasource matches.
         """
+        if ds_config is None:
+            ds_config = self.match(request)
+        ds = create_datasource(ds_config)
+        ds.dispatch(request, input_data)
+        return ds
+
+    def match(self, request: PolytopeRequest) -> Dict:
+        """
+        Coerces the request and returns the configuration of the first datasource it matches.
+        Raises an exception if no datasource matches.
+        """
         coerced_ur = coercion.coerce(yaml.safe_load(request.user_request))
         logging.info("Coerced user request", extra={"coerced_request": coerced_ur})
         match_errors = []
@@ -67,16 +79,20 @@ class Collection:
                 logging.info(message)
                 request.datasource = ds_config.get("name")
                 request.coerced_request = coerced_ur
-                ds = create_datasource(ds_config)
-                ds.dispatch(request, input_data)
-                return ds
+                return ds_config
             else:
                 match_errors.append(match_result)
         message = "\n".join(match_errors)
         raise Exception(f"No matching datasource found for request:\n{message}")
 
     def _serialize(self) -> Dict:
-        return {"name": self.name, "roles": self.roles, "limits": self.limits, "datasources": self.ds_configs}
+        return {
+            "name": self.name,
+            "roles": self.roles,
+            "limits": self.limits,
+            "result_cache": self.result_cache,
+            "datasources": self.ds_configs,
+        }
 
 
 def create_collections(config) -> Dict[str, Collection]:
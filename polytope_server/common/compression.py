@@ -0,0 +1,191 @@
+#
+# Copyright 2022 European Centre for Medium-Range Weather Forecasts (ECMWF)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+
+import logging
+import time
+import zlib
+from abc import ABC, abstractmethod
+from typing import Dict, Iterable, Iterator, Optional
+
+
+class Encoding(ABC):
+    """Streaming compressor for one HTTP Content-Encoding"""
+
+    name = None
+
+    @abstractmethod
+    def compressor(self, level: Optional[int]):
+        """Returns an object with compress(bytes) and flush() methods"""
+
+    @abstractmethod
+    def decompressor(self):
+        """Returns an object with a decompress(bytes) method"""
+
+
+class GzipEncoding(Encoding):
+    name = "gzip"
+
+    def compressor(self, level=None):
+        return zlib.compressobj(6 if level is None else level, zlib.DEFLATED, 31)
+
+    def decompressor(self):
+        return zlib.decompressobj(31)
+
+
+class ZstdEncoding(Encoding):
+    name = "zstd"
+
+    def __init__(self):
+        import zstandard
+
+        self.zstandard = zstandard
+
+    def compressor(self, level=None):
+        return self.zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+
+    def decompressor(self):
+        return self.zstandard.ZstdDecompressor().decompressobj()
+
+
+encoding_map = {
+    "gzip": GzipEncoding,
+    "zstd": ZstdEncoding,
+}
+
+
+def get_encoding(name: str) -> Encoding:
+    if name not in encoding_map:
+        raise ValueError("Unsupported content encoding {}, expected one of {}".format(name, list(encoding_map)))
+    return encoding_map[name]()
+
+
+def compress(
+    data: Iterable[bytes], encoding: str, level: Optional[int] = None, stats: Optional[Dict] = None
+) -> Iterator[bytes]:
+    """
+    Compresses a stream of chunks. If given, stats is updated with 'bytes_in', 'bytes_out' and 'cpu_time' (seconds of
+    CPU time spent in the compressor by the calling thread) as the stream is consumed.
+    """
+    compressor = get_encoding(encoding).compressor(level)
+    if stats is None:
+        stats = {}
+    for key in ("bytes_in", "bytes_out", "cpu_time"):
+        stats.setdefault(key, 0)
+
+    for chunk in data:
+        start = time.thread_time()
+        out = compressor.compress(chunk)
+        stats["cpu_time"] += time.thread_time() - start
+        stats["bytes_in"] += memoryview(chunk).nbytes
+        if out:
+            stats["bytes_out"] += len(out)
+            yield out
+
+    start = time.thread_time()
+    out = compressor.flush()
+    stats["cpu_time"] += time.thread_time() - start
+    if out:
+        stats["bytes_out"] += len(out)
+        yield out
+
+
+def decompress(data: Iterable[bytes], encoding: str) -> Iterator[bytes]:
+    """Decompresses a stream of chunks"""
+    decompressor = get_encoding(encoding).decompressor()
+    for chunk in data:
+        out = decompressor.decompress(chunk)
+        if out:
+            yield out
+    # zlib may hold back the tail of the data until flushed
+    flush = getattr(decompressor, "flush", None)
+    if flush is not None:
+        out = flush()
+        if out:
+            yield out
+
+
+def accepts_encoding(accept_encoding: Optional[str], encoding: str) -> bool:
+    """Whether an HTTP Accept-Encoding header value allows the given content encoding"""
+    if not accept_encoding:
+        return False
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[name.strip().lower()] = q
+    return accepted.get(encoding, accepted.get("*", 0.0)) > 0
+
+
+class CompressionPolicy:
+    """
+    Chooses a content encoding by MIME type and compresses results with it, keeping statistics per collection.
+
+    Configured as, e.g.:
+        compression:
+          level: 3
+          types:
+            application/prs.coverage+json: zstd
+            application/json: gzip
+    """
+
+    def __init__(self, config=None):
+        config = config or {}
+        self.level = config.get("level", None)
+        self.types = dict(config.get("types", {}))
+        # Fail at startup on unknown encodings, or missing optional libraries
+        for encoding in set(self.types.values()):
+            get_encoding(encoding)
+        self.stats = {}
+
+    def encoding_for(self, content_type: str) -> Optional[str]:
+        return self.types.get(content_type.split(";")[0].strip())
+
+    def compress(self, data: Iterable[bytes], encoding: str, collection: str) -> Iterator[bytes]:
+        stats = self.stats.setdefault(collection, {"objects": 0, "bytes_in": 0, "bytes_out": 0, "cpu_time": 0.0})
+        request_stats = {}
+        try:
+            yield from compress(data, encoding, self.level, request_stats)
+        finally:
+            stats["objects"] += 1
+            for key in ("bytes_in", "bytes_out", "cpu_time"):
+                stats[key] += request_stats.get(key, 0)
+            logging.info(
+                "Compressed result with {}: {} -> {} bytes in {:.3f}s CPU".format(
+                    encoding,
+                    request_stats.get("bytes_in", 0),
+                    request_stats.get("bytes_out", 0),
+                    request_stats.get("cpu_time", 0.0),
+                ),
+                extra={"compression": dict(request_stats, encoding=encoding, collection=collection)},
+            )
+
+    def report(self) -> Dict[str, Dict]:
+        """Returns statistics per collection, including bytes saved"""
+        return {
+            collection: dict(stats, bytes_saved=stats["bytes_in"] - stats["bytes_out"])
+            for collection, stats in self.stats.items()
+        }
@@ -143,7 +143,10 @@ class DataSource(ABC):
         raise NotImplementedError()
 
     def result(self, request) -> Iterator[bytes]:
-        """Returns a generator for the resultant data"""
+        """Returns a generator for the resultant data. Chunks may be bytes or bytearrays, which the consumer is free to
+        keep, or memoryviews, which are only valid until the next chunk is requested. The result may also have a
+        transfer_to(fd) method, moving all the data to a file descriptor and returning its size, as a faster
+        alternative to iterating."""
         raise NotImplementedError()
 
     def destroy(self, request) -> None:
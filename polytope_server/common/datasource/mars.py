@@ -19,19 +19,31 @@
 #
 
 import copy
+import datetime
 import logging
 import os
 import tempfile
-from subprocess import CalledProcessError
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import CalledProcessError, TimeoutExpired
 
 import requests
 import yaml
 
 from ..io.fifo import FIFO
+from ..io.transfer import copy_file
+from ..logging import propagate_context
 from ..subprocess import Subprocess
 from . import datasource
 from .datasource import convert_to_mars_request
 
+# Axes along which a request can be split without changing the output. MARS writes fields with the date outermost,
+# so sub-requests for consecutive blocks of dates give the same fields in the same order once concatenated. Fields of
+# other axes (step, param, levelist...) are interleaved within each date, and would come out grouped by sub-request.
+SPLIT_AXES = ("date",)
+
 
 class MARSDataSource(datasource.DataSource):
     def __init__(self, config):
@@ -53,6 +65,31 @@ class MARSDataSource(datasource.DataSource):
         self.use_file_io = config.get("use_file_io", False)
 
         self.mars_error_filter = config.get("mars_error_filter", "mars - EROR")
+        # Seconds between checks that MARS is still running while waiting for it, and before giving up on its output
+        self.poll_interval = config.get("poll_interval", 1.0)
+        self.read_timeout = config.get("read_timeout")
+        # Size of the chunks of output, S3 staging uploads chunks of at least its own buffer_size without copying them
+        self.buffer_size = config.get("buffer_size", 2 * 1024 * 1024)
+
+        # Optionally split requests along one axis (see SPLIT_AXES) into sub-requests retrieved by concurrent MARS
+        # processes, whose outputs are concatenated in order. With the dhs protocol, max_concurrency should not exceed
+        # the number of callback ports of the worker's service. A sub-request still running after 'timeout' seconds
+        # (read_timeout by default) is killed and fails the request.
+        split = config.get("split", {})
+        self.split_axis = split.get("axis")
+        if self.split_axis is not None and self.split_axis not in SPLIT_AXES:
+            raise ValueError(
+                "Cannot split MARS requests along {}, only along {}: the concatenated output would be in a different "
+                "order".format(self.split_axis, ", ".join(SPLIT_AXES))
+            )
+        self.split_parts = split.get("parts", 4)
+        self.split_concurrency = split.get("max_concurrency", self.split_parts)
+        self.split_timeout = split.get("timeout", self.read_timeout)
+        self.executor = None
+        self.parts = []
+        self.part_processes = []
+        self.parts_lock = threading.Lock()
+        self.cancelled = False
 
         # self.fdb_config = None
         self.fdb_config = config.get("fdb_config", {})
@@ -85,6 +122,12 @@ class MARSDataSource(datasource.DataSource):
         raise NotImplementedError("Archiving not implemented for MARS data source")
 
     def retrieve(self, request):
+        self.cpu_start = time.process_time()
+        self.wall_start = time.monotonic()
+
+        sub_requests = split_request(request.coerced_request or {}, self.split_axis, self.split_parts)
+        if len(sub_requests) > 1:
+            return self.retrieve_parts(request, sub_requests)
 
         if self.use_file_io:
             with tempfile.NamedTemporaryFile(delete=False) as tmp:
@@ -95,41 +138,30 @@ class MARSDataSource(datasource.DataSource):
             self.fifo = FIFO("MARS-FIFO-" + request.id)
             target = self.fifo.path
 
-        # Parse the user request as YAML, and add the FIFO as target
-        r = copy.deepcopy(request.coerced_request) or {}
-        r["target"] = '"' + target + '"'
+        self.request_file = self.write_request(request.coerced_request or {}, target)
 
-        # Make a temporary file for the request
-        with tempfile.NamedTemporaryFile(delete=False) as tmp:
-            self.request_file = tmp.name
-            logging.info("Writing request to tempfile {}".format(self.request_file))
-            tmp.write(convert_to_mars_request(r, "retrieve").encode())
-
-        # Call MARS
+        # Call MARS, its output is logged by the subprocess' own reader threads so it never holds up the data
         self.subprocess = Subprocess()
         self.subprocess.run(
             cmd=[self.command, self.request_file],
             cwd=os.path.dirname(__file__),
             env=self.make_env(request),
+            err_filter=self.mars_error_filter,
         )
 
         logging.info("MARS subprocess started with PID {}".format(self.subprocess.subprocess.pid))
 
         if self.use_file_io:
-            while self.subprocess.running():
-                self.subprocess.read_output(request, self.mars_error_filter)
+            self.subprocess.wait()
             logging.info("MARS process finished.")
             return True
 
-        # Poll until the FIFO has been opened by MARS, watch in case the spawned process dies before opening the FIFO
+        # Wait until the FIFO has been opened by MARS, watch in case the spawned process dies before opening the FIFO
         try:
             while self.subprocess.running():
-                # logging.debug("Checking if MARS process has opened FIFO.")  # this floods the logs
-                if self.fifo.ready():
+                if self.fifo.ready(timeout=self.poll_interval):
                     logging.info("FIFO is ready for reading.")
                     break
-
-                self.subprocess.read_output(request, self.mars_error_filter)
             else:
                 logging.info("Detected MARS process has exited before opening FIFO.")
                 self.destroy(request)
@@ -141,40 +173,155 @@ class MARSDataSource(datasource.DataSource):
 
         return True
 
+    def retrieve_parts(self, request, sub_requests):
+        """
+        Starts a MARS process for each sub-request, at most split_concurrency at a time. Each writes to its own file,
+        so that later parts are retrieved while earlier ones are being read.
+        """
+        logging.info(
+            "Splitting MARS request along {} into {} sub-requests, retrieving up to {} at a time".format(
+                self.split_axis, len(sub_requests), self.split_concurrency
+            )
+        )
+        self.executor = ThreadPoolExecutor(max_workers=self.split_concurrency)
+        for r in sub_requests:
+            with tempfile.NamedTemporaryFile(delete=False) as tmp:
+                output_file = tmp.name
+            # Written here rather than in the threads, the DHS environment hands out a callback port per call
+            request_file = self.write_request(r, output_file)
+            env = self.make_env(request)
+            future = self.executor.submit(propagate_context(self.retrieve_part), request_file, env)
+            self.parts.append((output_file, future))
+        return True
+
+    def retrieve_part(self, request_file, env):
+        """Runs MARS for one sub-request, returns its messages for the user and its error, if any"""
+        part = types.SimpleNamespace(user_message="", error=None)
+        try:
+            with self.parts_lock:
+                if self.cancelled:
+                    return part
+                process = Subprocess()
+                process.run(
+                    cmd=[self.command, request_file],
+                    cwd=os.path.dirname(__file__),
+                    env=env,
+                    err_filter=self.mars_error_filter,
+                )
+                self.part_processes.append(process)
+            if process.wait(self.split_timeout) is None:
+                logging.error("MARS sub-request did not finish in {} seconds, killing it".format(self.split_timeout))
+                process.subprocess.kill()
+                part.error = TimeoutExpired(process.subprocess.args, self.split_timeout)
+            try:
+                process.finalize(part)
+            except CalledProcessError as e:
+                if part.error is None:
+                    part.error = e
+        finally:
+            os.unlink(request_file)
+        return part
+
+    def wait_part(self, request, future):
+        """Waits for a sub-request to be retrieved, and reports its messages to the user in order"""
+        part = future.result()
+        request.user_message += part.user_message
+        if part.error is not None:
+            logging.error("MARS subprocess failed: {}".format(part.error))
+            if isinstance(part.error, TimeoutExpired):
+                raise Exception("MARS retrieval timed out after {} seconds".format(part.error.timeout))
+            raise Exception("MARS retrieval failed unexpectedly with error code {}".format(part.error.returncode))
+
+    def write_request(self, r, target):
+        """Writes the request r with the given target to a temporary file, returns its path"""
+        r = copy.deepcopy(r)
+        r["target"] = '"' + target + '"'
+        with tempfile.NamedTemporaryFile(delete=False) as tmp:
+            logging.info("Writing request to tempfile {}".format(tmp.name))
+            tmp.write(convert_to_mars_request(r, "retrieve").encode())
+        return tmp.name
+
     def result(self, request):
+        return MARSResult(self, request)
 
-        if self.use_file_io:
-            with open(self.output_file, "rb") as f:
-                while True:
-                    data = f.read(1024 * 1024)
-                    if not data:
-                        break
+    def chunks(self, request):
+        """Yields the output of MARS in chunks of buffer_size bytes"""
+        size = 0
+
+        if self.parts:
+            for output_file, future in self.parts:
+                self.wait_part(request, future)
+                for data in self.file_chunks(output_file):
+                    size += len(data)
                     yield data
+                # Free the disk space as soon as possible, the remaining parts may still be large
+                os.unlink(output_file)
+
+        elif self.use_file_io:
+            for data in self.file_chunks(self.output_file):
+                size += len(data)
+                yield data
+
+        else:
+            # The FIFO will get EOF if MARS exits unexpectedly, so we will break out of this loop automatically
+            for x in self.fifo.data(self.buffer_size, timeout=self.read_timeout):
+                size += len(x)
+                yield x
+
+            logging.info("FIFO reached EOF.")
+
+        self.finish(request, size)
+
+    def file_chunks(self, path):
+        with open(path, "rb", buffering=0) as f:
+            while True:
+                data = bytearray(self.buffer_size)
+                n = f.readinto(data)
+                if not n:
+                    break
+                del data[n:]
+                yield data
+
+    def transfer_to(self, request, fd):
+        """Moves the output of MARS to fd (a file or a socket) in the kernel where possible, returns its size"""
+        if self.parts:
+            size = 0
+            for output_file, future in self.parts:
+                self.wait_part(request, future)
+                with open(output_file, "rb", buffering=0) as f:
+                    size += copy_file(f.fileno(), fd, self.buffer_size)
+                os.unlink(output_file)
+        elif self.use_file_io:
+            with open(self.output_file, "rb", buffering=0) as f:
+                size = copy_file(f.fileno(), fd, self.buffer_size)
+        else:
+            size = self.fifo.transfer_to(fd, timeout=self.read_timeout, buffer_size=self.buffer_size)
+            logging.info("FIFO reached EOF.")
+
+        self.finish(request, size)
+        return size
 
+    def finish(self, request, size):
+        # Sub-requests have been finalized as they were read
+        if self.subprocess is not None:
             try:
-                self.subprocess.finalize(request, self.mars_error_filter)
+                self.subprocess.finalize(request)
             except CalledProcessError as e:
                 logging.exception("MARS subprocess failed: {}".format(e))
                 raise Exception("MARS retrieval failed unexpectedly with error code {}".format(e.returncode))
-            return
-
-        # The FIFO will get EOF if MARS exits unexpectedly, so we will break out of this loop automatically
-        for x in self.fifo.data():
-            # logging.debug("Yielding data from FIFO.")  # this floods the logs
-            self.subprocess.read_output(request, self.mars_error_filter)
-            yield x
-
-        logging.info("FIFO reached EOF.")
 
-        try:
-            self.subprocess.finalize(request, self.mars_error_filter)
-        except CalledProcessError as e:
-            logging.exception("MARS subprocess failed: {}".format(e))
-            raise Exception("MARS retrieval failed unexpectedly with error code {}".format(e.returncode))
+        logging.info(
+            "MARS retrieval of {} bytes took {:.2f}s, using {:.2f}s of worker CPU".format(
+                size, time.monotonic() - self.wall_start, time.process_time() - self.cpu_start
+            )
+        )
 
     def destroy(self, request):
+        if self.executor is not None:
+            self.destroy_parts()
+            return
         try:
-            self.subprocess.finalize(request, self.mars_error_filter)  # Will raise if non-zero return
+            self.subprocess.finalize(request)  # Will raise if non-zero return
         except Exception as e:
             logging.info("MARS subprocess failed: {}".format(e))
             pass
@@ -191,6 +338,21 @@ class MARSDataSource(datasource.DataSource):
         except Exception:
             pass
 
+    def destroy_parts(self):
+        # Parts not started yet are dropped, and those still running are killed, e.g. if reading an earlier one failed
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        with self.parts_lock:
+            self.cancelled = True
+            for process in self.part_processes:
+                if process.running():
+                    process.subprocess.kill()
+        self.executor.shutdown(wait=True)
+        for output_file, _ in self.parts:
+            try:
+                os.unlink(output_file)
+            except FileNotFoundError:
+                pass
+
     def mime_type(self) -> str:
         return "application/x-grib"
 
@@ -327,3 +489,67 @@ class MARSDataSource(datasource.DataSource):
             raise e
 
         return env
+
+
+def expand_values(key, value):
+    """
+    Returns the values of a request key as a list, expanding ranges of dates (YYYYMMDD/to/YYYYMMDD[/by/days]) and of
+    integers (e.g. steps). Returns None if they cannot be enumerated here.
+    """
+    values = [str(v) for v in value] if isinstance(value, (list, tuple)) else str(value).split("/")
+    words = [v.casefold() for v in values]
+    if "to" not in words and "by" not in words:
+        return values
+    if len(values) not in (3, 5) or words[1] != "to" or (len(values) == 5 and words[3] != "by"):
+        return None
+    try:
+        by = int(values[4]) if len(values) == 5 else 1
+        if by <= 0:
+            return None
+        if key == "date":
+            start = datetime.datetime.strptime(values[0], "%Y%m%d")
+            end = datetime.datetime.strptime(values[2], "%Y%m%d")
+            days = range(0, (end - start).days + 1, by)
+            return [(start + datetime.timedelta(days=d)).strftime("%Y%m%d") for d in days]
+        return [str(v) for v in range(int(values[0]), int(values[2]) + 1, by)]
+    except ValueError:
+        return None
+
+
+def split_request(request, axis, parts):
+    """
+    Splits request into at most parts sub-requests, each with a contiguous block of the values of axis, in order.
+    Only axes in SPLIT_AXES leave the concatenated output unchanged. Returns [request] if it cannot be split.
+    """
+    if not axis or parts < 2 or axis not in request:
+        return [request]
+    values = expand_values(axis, request[axis])
+    if values is None or len(values) < 2:
+        return [request]
+
+    parts = min(parts, len(values))
+    size, extra = divmod(len(values), parts)
+    sub_requests = []
+    start = 0
+    for i in range(parts):
+        end = start + size + (1 if i < extra else 0)
+        sub_requests.append({**request, axis: values[start:end]})
+        start = end
+    return sub_requests
+
+
+class MARSResult:
+    """
+    The output of a MARS retrieval. It can be iterated in chunks like any other result, or moved to a file or socket
+    with transfer_to, which staging uses where it can so that the data does not pass through the worker at all.
+    """
+
+    def __init__(self, datasource, request):
+        self.datasource = datasource
+        self.request = request
+
+    def __iter__(self):
+        return self.datasource.chunks(self.request)
+
+    def transfer_to(self, fd):
+        return self.datasource.transfer_to(self.request, fd)
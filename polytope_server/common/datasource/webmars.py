@@ -19,10 +19,13 @@
 #
 
 import copy
+import functools
 import logging
 import os
 import tempfile
+import urllib.request
 
+import ecmwfapi.api
 from ecmwfapi import ECMWFDataServer
 
 from . import datasource
@@ -41,6 +44,7 @@ class WebMARSDataSource(datasource.DataSource):
         self.tmp_dir = config.get("tmp_dir", None)
         self.override_mars_email = config.get("override_email")
         self.override_mars_apikey = config.get("override_apikey")
+        configure_ecmwfapi_proxy(os.getenv("POLYTOPE_PROXY", ""))
 
     def get_type(self):
         return self.type
@@ -57,16 +61,7 @@ class WebMARSDataSource(datasource.DataSource):
         self.data = tempfile.NamedTemporaryFile(delete=False, dir=self.tmp_dir)
         r = copy.deepcopy(request.coerced_request)
         r["target"] = self.data.name
-        _environ = dict(os.environ)
-        try:
-            os.environ["http_proxy"] = os.getenv("POLYTOPE_PROXY", "")
-            os.environ["HTTP_PROXY"] = os.getenv("POLYTOPE_PROXY", "")
-            os.environ["https_proxy"] = os.getenv("POLYTOPE_PROXY", "")
-            os.environ["HTTPS_PROXY"] = os.getenv("POLYTOPE_PROXY", "")
-            self.server.retrieve(r)
-        finally:
-            os.environ.clear()
-            os.environ.update(_environ)
+        self.server.retrieve(r)
 
         return True
 
@@ -112,3 +107,13 @@ class WebMARSDataSource(datasource.DataSource):
             raise Exception()
 
         return mars_user, mars_token
+
+
+def configure_ecmwfapi_proxy(proxy: str):
+    """
+    ecmwfapi talks to the server through urllib, which picks up proxies from os.environ. Give it openers with an
+    explicit proxy instead (or none if proxy is empty), so that os.environ never has to be modified per request.
+    """
+    handler = urllib.request.ProxyHandler({"http": proxy, "https": proxy} if proxy else {})
+    ecmwfapi.api.build_opener = functools.partial(urllib.request.build_opener, handler)
+    ecmwfapi.api.urlopen = urllib.request.build_opener(handler).open
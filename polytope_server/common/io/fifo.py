@@ -19,14 +19,22 @@
 #
 
 import errno
+import fcntl
 import logging
 import os
-import select
+import selectors
 import tempfile
 
+# Errors from splice(2) meaning it cannot be used between these file descriptors
+SPLICE_UNSUPPORTED = (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP)
+
 
 class FIFO:
-    """Creates a named pipe (FIFO) and reads data from it"""
+    """
+    Creates a named pipe (FIFO) and reads data from it.
+
+    Reads wait on a selector rather than retrying, so no CPU is used while the writer is slow.
+    """
 
     def __init__(self, name, dir=None):
 
@@ -37,32 +45,96 @@ class FIFO:
 
         os.mkfifo(self.path, 0o600)
         self.fifo = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            # Fewer, larger reads (up to /proc/sys/fs/pipe-max-size, 1 MiB by default)
+            fcntl.fcntl(self.fifo, fcntl.F_SETPIPE_SZ, 1024 * 1024)
+        except (AttributeError, OSError):
+            pass
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.fifo, selectors.EVENT_READ)
         logging.info("FIFO created")
 
-    def ready(self):
+    def wait(self, timeout=None):
+        """Waits up to timeout seconds (forever if None) for the FIFO to be readable, returns True if it is"""
+        if self.selector.get_map() is None:
+            raise OSError(errno.EBADF, "FIFO {} is closed".format(self.path))
+        return bool(self.selector.select(timeout))
+
+    def ready(self, timeout=0):
         """Wait until FIFO is ready for reading -- i.e. opened by the writing process (man select)"""
-        return len(select.select([self.fifo], [], [], 0)[0]) == 1
+        return self.wait(timeout)
 
-    def data(self, buffer_size=2 * 1024 * 1024):
-        buffer = b""
+    def data(self, buffer_size=2 * 1024 * 1024, timeout=None, reuse=False):
+        """
+        Yields the data in chunks of buffer_size bytes (except the last one), read straight into a bytearray so that
+        each byte is copied once. Each chunk is a new bytearray, owned by the consumer, unless reuse is True: then the
+        chunks are memoryviews of a single bytearray, and are only valid until the next chunk is requested.
+        """
+        arena = bytearray(buffer_size)
+        view = memoryview(arena)
+        filled = 0
 
         while True:
-            data = self.read_raw()
-            if data is None:
+            n = self.read_into(view[filled:], timeout=timeout)
+            if n == 0:
                 break
-            buffer += data
-            while len(buffer) >= buffer_size:
-                output, leftover = buffer[:buffer_size], buffer[buffer_size:]
-                buffer = leftover
-                yield output
+            filled += n
+            if filled == buffer_size:
+                if reuse:
+                    yield view
+                else:
+                    yield arena
+                    arena = bytearray(buffer_size)
+                    view = memoryview(arena)
+                filled = 0
+
+        if filled:
+            if reuse:
+                yield view[:filled]
+            else:
+                view.release()
+                del arena[filled:]
+                yield arena
 
-        if buffer != b"":
-            yield buffer
+    def transfer_to(self, fd, timeout=None, buffer_size=1024 * 1024):
+        """
+        Moves all the data to fd (a file or a socket) until EOF, returning the number of bytes moved. The data is
+        moved with splice(2) where the kernel supports it, so that it does not pass through user space, otherwise it
+        is read and written in chunks of buffer_size.
+        """
+        total = 0
+        if hasattr(os, "splice"):
+            try:
+                while True:
+                    try:
+                        n = os.splice(self.fifo, fd, buffer_size, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+                    except BlockingIOError:
+                        if not self.wait(timeout):
+                            raise TimeoutError("No data from FIFO {} in {} seconds".format(self.path, timeout))
+                        continue
+                    if n == 0:
+                        return total
+                    total += n
+            except OSError as e:
+                if e.errno not in SPLICE_UNSUPPORTED:
+                    raise
+                logging.info("Cannot splice from FIFO ({}), copying through user space".format(e))
+
+        view = memoryview(bytearray(buffer_size))
+        while True:
+            n = self.read_into(view, timeout=timeout)
+            if n == 0:
+                return total
+            written = 0
+            while written < n:
+                written += os.write(fd, view[written:n])
+            total += n
 
     def delete(self):
         """Close and delete FIFO"""
         logging.info("Deleting FIFO.")
         try:
+            self.selector.close()
             os.close(self.fifo)
         except Exception as e:
             logging.info(f"Closing FIFO had an exception {e}")
@@ -73,17 +145,35 @@ class FIFO:
             logging.info(f"Deleting FIFO had an exception {e}")
             pass
 
-    def read_raw(self, max_read=2 * 1024 * 1024):
+    def read_into(self, buffer, timeout=None):
+        """
+        Reads into buffer (a writable bytes-like object), returning the number of bytes read, 0 at EOF. Waits for data
+        if there is none yet, raising TimeoutError if there is still none after timeout seconds.
+        """
+        while True:
+            try:
+                return os.readv(self.fifo, [buffer])
+            except OSError as err:
+                if err.errno != errno.EAGAIN and err.errno != errno.EWOULDBLOCK:
+                    raise
+            if not self.wait(timeout):
+                raise TimeoutError("No data from FIFO {} in {} seconds".format(self.path, timeout))
+
+    def read_raw(self, max_read=2 * 1024 * 1024, timeout=None):
+        """
+        Returns up to max_read bytes, or None at EOF. Waits for data if there is none yet, raising TimeoutError if
+        there is still none after timeout seconds.
+        """
         while True:
             try:
                 buf = os.read(self.fifo, max_read)
                 break
             except OSError as err:
                 # Because we opened in non-blocking mode we have to filter out these errors
-                if err.errno == errno.EAGAIN or err.errno == errno.EWOULDBLOCK:
-                    pass
-                else:
+                if err.errno != errno.EAGAIN and err.errno != errno.EWOULDBLOCK:
                     raise
+            if not self.wait(timeout):
+                raise TimeoutError("No data from FIFO {} in {} seconds".format(self.path, timeout))
 
         if buf != b"":
             return buf
@@ -0,0 +1,52 @@
+#
+# Copyright 2022 European Centre for Medium-Range Weather Forecasts (ECMWF)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+
+import errno
+import logging
+import os
+
+
+def copy_file(src, dst, buffer_size=1024 * 1024):
+    """
+    Copies the file open as src, from its current offset, to dst (a file or a socket), returning the number of bytes
+    copied. The data is copied with sendfile(2) where the kernel supports it, so that it does not pass through user
+    space, otherwise it is read and written in chunks of buffer_size.
+    """
+    total = 0
+    try:
+        while True:
+            n = os.sendfile(dst, src, None, buffer_size)
+            if n == 0:
+                return total
+            total += n
+    except OSError as e:
+        if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTSOCK):
+            raise
+        logging.info("Cannot sendfile ({}), copying through user space".format(e))
+
+    view = memoryview(bytearray(buffer_size))
+    while True:
+        n = os.readv(src, [view])
+        if n == 0:
+            return total
+        written = 0
+        while written < n:
+            written += os.write(dst, view[written:n])
+        total += n
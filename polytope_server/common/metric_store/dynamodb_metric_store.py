@@ -31,7 +31,7 @@ import botocore.exceptions
 from boto3.dynamodb.conditions import Attr, Key
 
 from ..metric import Metric, MetricType, RequestStatusChange
-from . import MetricStore
+from . import EXPIRE_AT, MetricStore
 
 logger = logging.getLogger(__name__)
 
@@ -79,18 +79,29 @@ def _convert_numbers(obj, reverse=False):
 def _load(item, exclude_fields=None):
     metric_type = Metric.deserialize_slot("type", item["type"])
     cls = METRIC_TYPE_CLASS_MAP[metric_type]
-    if exclude_fields is not None:
-        item = {key: value for key, value in item.items() if key not in exclude_fields}
+    exclude_fields = {EXPIRE_AT} | set(exclude_fields or ())
+    item = {key: value for key, value in item.items() if key not in exclude_fields}
     return cls(from_dict=_convert_numbers(item, reverse=True))
 
 
-def _dump(metric):
+def _dump(metric, expiry=None):
     item = _convert_numbers(metric.serialize())
     if "request_id" in item and item["request_id"] is None:
         del item["request_id"]  # index hash keys are not nullable
+    if expiry is not None:
+        item[EXPIRE_AT] = int(expiry)  # DynamoDB TTL takes whole seconds since the epoch
     return item
 
 
+def _enable_ttl(client, table_name):
+    description = client.describe_time_to_live(TableName=table_name)["TimeToLiveDescription"]
+    if description["TimeToLiveStatus"] in ("ENABLED", "ENABLING"):
+        return
+    client.update_time_to_live(
+        TableName=table_name, TimeToLiveSpecification={"Enabled": True, "AttributeName": EXPIRE_AT}
+    )
+
+
 def _create_table(dynamodb, table_name):
     try:
         kwargs = {
@@ -146,12 +157,18 @@ class DynamoDBMetricStore(MetricStore):
         except client.exceptions.ResourceNotFoundException:
             _create_table(dynamodb, table_name)
 
+        # Metrics are deleted by DynamoDB TTL, rather than by the garbage collector. Expired items are deleted within
+        # a few days, and may still be read until then.
+        self.ttl = config.get("ttl")
+        if self.ttl is not None:
+            _enable_ttl(client, table_name)
+
     def get_type(self):
         return "dynamodb"
 
     def add_metric(self, metric):
         try:
-            self.table.put_item(Item=_dump(metric), ConditionExpression=Attr("uuid").not_exists())
+            self.table.put_item(Item=_dump(metric, self.expiry(metric)), ConditionExpression=Attr("uuid").not_exists())
         except botocore.exceptions.ClientError as e:
             if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
                 raise ValueError("Request already exists in request store") from e
@@ -230,19 +247,20 @@ class DynamoDBMetricStore(MetricStore):
         return list(items)
 
     def update_metric(self, metric):
-        self.table.put_item(Item=_dump(metric))
+        self.table.put_item(Item=_dump(metric, self.expiry(metric)))
 
     def wipe(self):
         warnings.warn("wipe is not implemented for DynamoDBMetricStore")
 
     def remove_old_metrics(self, cutoff):
         cutoff_timestamp = cutoff.timestamp()
-        response = self.table.scan(
+        to_delete = _iter_items(
+            self.table.scan,
             FilterExpression=Attr("timestamp").lt(_convert_numbers(cutoff_timestamp)),
             ProjectionExpression="#u",
             ExpressionAttributeNames={"#u": "uuid"},
         )
-        items_to_delete = [item["uuid"] for item in response.get("Items", [])]
+        items_to_delete = [item["uuid"] for item in to_delete]
 
         if not items_to_delete:
             return 0
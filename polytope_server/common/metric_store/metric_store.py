@@ -21,14 +21,20 @@
 import datetime
 import importlib
 from abc import ABC, abstractmethod
-from typing import List
+from typing import List, Optional
 
 from ..metric import Metric
 
+# Field holding the time at which the database may delete a metric by itself
+EXPIRE_AT = "expire_at"
+
 
 class MetricStore(ABC):
     """MetricStore is an interface for database-based storage for Metric objects"""
 
+    # Seconds after which metrics are expired by the database, None if they are removed by polling
+    ttl = None
+
     def __init__(self):
         """Initialize a metric store"""
 
@@ -57,6 +63,12 @@ class MetricStore(ABC):
     # def update_metric(self, metric: Metric) -> None:
     #    """ Updates a stored metric """
 
+    def expiry(self, metric: Metric) -> Optional[float]:
+        """Returns the timestamp at which metric expires, or None if it does not"""
+        if self.ttl is None:
+            return None
+        return metric.timestamp + self.ttl
+
     @abstractmethod
     def get_type(self) -> str:
         """Returns the type of the metric_store in use"""
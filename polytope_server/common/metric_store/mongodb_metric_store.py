@@ -18,13 +18,14 @@
 # does it submit to any jurisdiction.
 #
 
+import datetime
 import logging
 
 import pymongo
 
 from .. import mongo_client_factory
 from ..metric import Metric, MetricType, RequestStatusChange
-from . import MetricStore
+from . import EXPIRE_AT, MetricStore
 
 
 class MongoMetricStore(MetricStore):
@@ -49,6 +50,11 @@ class MongoMetricStore(MetricStore):
             MetricType.REQUEST_STATUS_CHANGE: RequestStatusChange,
         }
 
+        # Metrics are deleted by MongoDB's TTL monitor, rather than by the garbage collector
+        self.ttl = config.get("ttl")
+        if self.ttl is not None:
+            self.store.create_index(EXPIRE_AT, expireAfterSeconds=0)
+
         logging.debug("MongoClient configured to open at {}".format(uri))
 
     def get_type(self):
@@ -57,7 +63,7 @@ class MongoMetricStore(MetricStore):
     def add_metric(self, metric):
         if self.get_metric(metric.uuid) is not None:
             raise ValueError("Metric already exists in metric store")
-        self.store.insert_one(metric.serialize())
+        self.store.insert_one(self._dump(metric))
 
     def remove_metric(self, uuid, include_processed=False):
         """
@@ -96,7 +102,7 @@ class MongoMetricStore(MetricStore):
         return result.deleted_count
 
     def get_metric(self, uuid):
-        result = self.store.find_one({"uuid": uuid}, {"_id": False})
+        result = self.store.find_one({"uuid": uuid}, {"_id": False, EXPIRE_AT: False})
         if result:
             metric = self.metric_type_class_map[Metric.deserialize_slot("type", result["type"])](from_dict=result)
             return metric
@@ -111,7 +117,8 @@ class MongoMetricStore(MetricStore):
             ascending (str): Field to sort by ascending order.
             descending (str): Field to sort by descending order.
             limit (int): Limit the number of results.
-            exclude_fields (dict): Fields to exclude in the result (default is {"_id": False}).
+            exclude_fields (dict): Fields to exclude in the result (default is {"_id": False}). The expiry time is
+                always excluded.
             **kwargs: Filters to apply to the query.
 
         Returns:
@@ -120,6 +127,7 @@ class MongoMetricStore(MetricStore):
         # Default exclude_fields to {"_id": False} if not provided
         if exclude_fields is None:
             exclude_fields = {"_id": False}
+        exclude_fields = {**exclude_fields, EXPIRE_AT: False}
 
         all_slots = []
         found_type = None
@@ -169,10 +177,18 @@ class MongoMetricStore(MetricStore):
     def update_metric(self, metric):
         return self.store.find_one_and_update(
             {"uuid": metric.uuid},
-            {"$set": metric.serialize()},
+            {"$set": self._dump(metric)},
             return_document=pymongo.ReturnDocument.AFTER,
         )
 
+    def _dump(self, metric):
+        doc = metric.serialize()
+        expiry = self.expiry(metric)
+        if expiry is not None:
+            # TTL indexes only apply to dates, expiry follows the timestamp as in remove_old_metrics
+            doc[EXPIRE_AT] = datetime.datetime.fromtimestamp(expiry, datetime.timezone.utc)
+        return doc
+
     def wipe(self):
         self.database.drop_collection(self.store.name)
 
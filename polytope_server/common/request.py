@@ -50,6 +50,7 @@ class PolytopeRequest:
         "user",
         "verb",
         "url",
+        "staged_name",
         "md5",
         "collection",
         "status",
@@ -58,6 +59,7 @@ class PolytopeRequest:
         "coerced_request",
         "content_length",
         "content_type",
+        "content_encoding",
         "status_history",
         "datasource",
     ]
@@ -70,6 +72,7 @@ class PolytopeRequest:
         self.user = None
         self.verb = Verb.RETRIEVE
         self.url = ""
+        self.staged_name = None
         self.collection = ""
         self.status = Status.WAITING
         self.md5 = None
@@ -78,6 +81,7 @@ class PolytopeRequest:
         self.coerced_request = {}
         self.content_length = None
         self.content_type = "application/octet-stream"
+        self.content_encoding = None
         self.datasource = ""
 
         now_ts = datetime.datetime.now(datetime.timezone.utc).timestamp()
@@ -84,17 +84,32 @@ def _convert_numbers(obj, reverse=False):
 
 def _load(item):
     return PolytopeRequest(
-        from_dict={key: _convert_numbers(value, reverse=True) for key, value in item.items() if key != "user_id"}
+        from_dict={
+            key: _convert_numbers(value, reverse=True)
+            for key, value in item.items()
+            if key not in ("user_id", request_store.EXPIRE_AT)
+        }
     )
 
 
-def _dump(request):
+def _dump(request, expiry=None):
     item = _convert_numbers(request.serialize())
+    if expiry is not None:
+        item[request_store.EXPIRE_AT] = int(expiry)  # DynamoDB TTL takes whole seconds since the epoch
     if request.user is not None:
         return item | {"user_id": str(request.user.id)}
     return item
 
 
+def _enable_ttl(client, table_name):
+    description = client.describe_time_to_live(TableName=table_name)["TimeToLiveDescription"]
+    if description["TimeToLiveStatus"] in ("ENABLED", "ENABLING"):
+        return
+    client.update_time_to_live(
+        TableName=table_name, TimeToLiveSpecification={"Enabled": True, "AttributeName": request_store.EXPIRE_AT}
+    )
+
+
 def _create_table(dynamodb, table_name):
     try:
         kwargs = {
@@ -146,6 +161,12 @@ class DynamoDBRequestStore(request_store.RequestStore):
         except client.exceptions.ResourceNotFoundException:
             _create_table(dynamodb, table_name)
 
+        # Finished requests are deleted by DynamoDB TTL, rather than by the garbage collector. Expired items are deleted
+        # within a few days, and may still be read until then.
+        self.ttl = config.get("ttl")
+        if self.ttl is not None:
+            _enable_ttl(client, table_name)
+
         self.metric_store = None
         if metric_store_config is not None:
             self.metric_store = metric_store.create_metric_store(metric_store_config)
@@ -157,7 +178,7 @@ class DynamoDBRequestStore(request_store.RequestStore):
 
     def add_request(self, request):
         try:
-            self.table.put_item(Item=_dump(request), ConditionExpression=Attr("id").not_exists())
+            self.table.put_item(Item=_dump(request, self.expiry(request)), ConditionExpression=Attr("id").not_exists())
         except botocore.exceptions.ClientError as e:
             if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
                 raise ValueError("Request already exists in request store") from e
@@ -308,13 +329,18 @@ class DynamoDBRequestStore(request_store.RequestStore):
         ]
 
     def get_request_ids(self):
-        return [item["id"] for item in _iter_items(self.table.scan, ProjectionExpression="id") if "id" in item]
+        return list(self.iter_request_ids())
+
+    def iter_request_ids(self):
+        return (item["id"] for item in _iter_items(self.table.scan, ProjectionExpression="id") if "id" in item)
 
     def update_request(self, request):
         now = dt.datetime.now(dt.timezone.utc)
         request.last_modified = now.timestamp()
         try:
-            self.table.put_item(Item=_dump(request), ConditionExpression=Attr("id").eq(request.id))
+            self.table.put_item(
+                Item=_dump(request, self.expiry(request)), ConditionExpression=Attr("id").eq(request.id)
+            )
         except botocore.exceptions.ClientError as e:
             if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
                 raise NotFound("Request {} not found in request store".format(request.id)) from e
@@ -30,6 +30,9 @@ from ..metric_calculator.mongo import MongoMetricCalculator
 from ..request import PolytopeRequest, Status
 from . import request_store
 
+# Documents are loaded into requests without their database-only fields
+_PROJECTION = {"_id": False, request_store.EXPIRE_AT: False}
+
 
 class MongoRequestStore(request_store.RequestStore):
     def __init__(self, config=None, metric_store_config=None):
@@ -58,13 +61,22 @@ class MongoRequestStore(request_store.RequestStore):
         if metrics_collection is not None:
             self.metric_calculator.ensure_metric_indexes()  # Indexes for metrics collection
 
+        # Finished requests are deleted by MongoDB's TTL monitor, rather than by the garbage collector
+        self.ttl = config.get("ttl")
+        if self.ttl is not None:
+            self.store.create_index(request_store.EXPIRE_AT, expireAfterSeconds=0)
+
     def get_type(self):
         return "mongodb"
 
     def add_request(self, request):
         if self.get_request(request.id) is not None:
             raise ValueError("Request already exists in request store")
-        self.store.insert_one(request.serialize())
+        doc = request.serialize()
+        expiry = self._expire_at(request)
+        if expiry is not None:
+            doc[request_store.EXPIRE_AT] = expiry
+        self.store.insert_one(doc)
 
         if self.metric_store and request.status == Status.PROCESSED:
             self.metric_store.add_metric(
@@ -121,7 +133,7 @@ class MongoRequestStore(request_store.RequestStore):
         return 1  # Successfully revoked one request
 
     def get_request(self, id):
-        result = self.store.find_one({"id": id}, {"_id": False})
+        result = self.store.find_one({"id": id}, _PROJECTION)
         if result:
             request = PolytopeRequest(from_dict=result)
             return request
@@ -156,7 +168,7 @@ class MongoRequestStore(request_store.RequestStore):
 
             query[k] = PolytopeRequest.serialize_slot(k, v)
 
-        cursor = self.store.find(query, {"_id": False})
+        cursor = self.store.find(query, _PROJECTION)
 
         if ascending is not None and descending is not None:
             raise ValueError("Cannot sort by ascending and descending at the same time.")
@@ -177,18 +189,29 @@ class MongoRequestStore(request_store.RequestStore):
         return []
 
     def get_active_requests(self):
-        cursor = self.store.find({"status": {"$in": [Status.PROCESSING.value, Status.QUEUED.value]}}, {"_id": False})
+        cursor = self.store.find({"status": {"$in": [Status.PROCESSING.value, Status.QUEUED.value]}}, _PROJECTION)
         return [PolytopeRequest(from_dict=i) for i in cursor]
 
     def get_request_ids(self):
-        cursor = self.store.find({}, {"_id": False, "id": True})
-        return [doc["id"] for doc in cursor if "id" in doc]
+        return list(self.iter_request_ids())
+
+    def iter_request_ids(self):
+        cursor = self.store.find({}, {"_id": False, "id": True}, batch_size=10000)
+        return (doc["id"] for doc in cursor if "id" in doc)
 
     def update_request(self, request):
         request.last_modified = datetime.datetime.now(datetime.timezone.utc).timestamp()
+        update = {"$set": request.serialize()}
+        expiry = self._expire_at(request)
+        if expiry is not None:
+            update["$set"][request_store.EXPIRE_AT] = expiry
+        else:
+            # e.g. a failed request which is retried
+            update["$unset"] = {request_store.EXPIRE_AT: ""}
         res = self.store.find_one_and_update(
             {"id": request.id},
-            {"$set": request.serialize()},
+            update,
+            projection=_PROJECTION,
             return_document=pymongo.ReturnDocument.AFTER,
         )
 
@@ -202,6 +225,13 @@ class MongoRequestStore(request_store.RequestStore):
 
         return res
 
+    def _expire_at(self, request):
+        # TTL indexes only apply to dates
+        expiry = self.expiry(request)
+        if expiry is None:
+            return None
+        return datetime.datetime.fromtimestamp(expiry, datetime.timezone.utc)
+
     def wipe(self):
         if self.metric_store:
             res = self.get_requests()
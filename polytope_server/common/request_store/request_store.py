@@ -21,16 +21,22 @@
 import datetime
 import importlib
 from abc import ABC, abstractmethod
-from typing import List
+from typing import Iterator, List, Optional
 
 from ..metric import RequestStatusChange
 from ..request import PolytopeRequest, Status
 from ..user import User
 
+# Field holding the time at which the database may delete a finished request by itself
+EXPIRE_AT = "expire_at"
+
 
 class RequestStore(ABC):
     """RequestStore is an interface for database-based storage for Request objects"""
 
+    # Seconds after which finished requests are expired by the database, None if they are removed by polling
+    ttl = None
+
     def __init__(self):
         """Initialize a request store"""
 
@@ -55,6 +61,12 @@ class RequestStore(ABC):
     def get_request_ids(self) -> List[str]:
         """Return all request ids present in the store."""
 
+    def iter_request_ids(self) -> Iterator[str]:
+        """Yield all request ids present in the store, without holding them all in memory.
+        Request stores which can page through their ids should override this.
+        """
+        return iter(self.get_request_ids())
+
     @abstractmethod
     def remove_request(self, id: str) -> None:
         """Remove a request from the request store."""
@@ -100,6 +112,14 @@ class RequestStore(ABC):
             )
         self.update_request(request)
 
+    def expiry(self, request: PolytopeRequest) -> Optional[float]:
+        """Returns the timestamp at which request expires, or None if it does not. Only requests which are FAILED or
+        PROCESSED expire, ttl seconds after their last modification, as in remove_old_requests.
+        """
+        if self.ttl is None or request.status not in (Status.FAILED, Status.PROCESSED):
+            return None
+        return request.last_modified + self.ttl
+
     @abstractmethod
     def get_type(self) -> str:
         """Returns the type of the request_store in use"""
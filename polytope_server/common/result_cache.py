@@ -0,0 +1,193 @@
+#
+# Copyright 2022 European Centre for Medium-Range Weather Forecasts (ECMWF)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+
+import hashlib
+import json
+import logging
+import time
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Optional, Set
+
+import pymongo
+import yaml
+
+from . import mongo_client_factory
+from .request import PolytopeRequest
+from .staging import StagedObject, Staging
+
+
+def canonical_json(obj: Any) -> str:
+    return json.dumps(obj, sort_keys=True, separators=(",", ":"), default=str)
+
+
+def config_version(ds_config: Dict) -> str:
+    """Identifies a datasource configuration, so that cached results do not outlive changes to it"""
+    return hashlib.sha256(canonical_json(ds_config).encode()).hexdigest()[:16]
+
+
+def _is_relative_date(value: Any) -> bool:
+    """Whether a user-supplied date refers to a day relative to today (e.g. 0, -1, "-1/to/0")"""
+    for token in str(value).split("/"):
+        token = token.strip().lower()
+        if token in ("to", "by", ""):
+            continue
+        try:
+            if int(token) <= 0:
+                return True
+        except ValueError:
+            if token in ("today", "yesterday"):
+                return True
+    return False
+
+
+def _latest_date(value: Any) -> Optional[date]:
+    latest = None
+    for token in str(value).split("/"):
+        try:
+            day = datetime.strptime(token.strip(), "%Y%m%d").date()
+        except ValueError:
+            continue
+        latest = day if latest is None else max(latest, day)
+    return latest
+
+
+class ResultCache:
+    """
+    Maps requests to results already in staging, so that repeated retrievals are served without running a datasource.
+
+    Entries are keyed on the coerced request, the name of the matched datasource and a hash of its configuration. They
+    are kept in MongoDB with the staged object they point to:
+    - Requests for recent or relative dates, whose data may still change, are cached for 'lifetime_recent' seconds,
+      others for 'lifetime' seconds.
+    - evict() retires expired entries, then the least recently used ones until the cached results total at most
+      'max_size' bytes. Retired entries no longer serve hits, but keep their object pinned against the garbage collector
+      until the requests served from them have expired too, after which the object is treated as dangling data.
+    """
+
+    def __init__(self, config):
+        self.lifetime = config.get("lifetime", 7 * 24 * 3600)
+        self.lifetime_recent = config.get("lifetime_recent", 3600)
+        self.recent_days = config.get("recent_days", 2)
+        self.max_size = config.get("max_size", None)
+
+        uri = config.get("uri", "mongodb://localhost:27017")
+        collection = config.get("collection", "result_cache")
+        username = config.get("username")
+        password = config.get("password")
+        self.mongo_client = mongo_client_factory.create_client(uri, username, password)
+        self.collection = self.mongo_client.result_cache[collection]
+        self.collection.create_index([("retired", pymongo.ASCENDING), ("last_used", pymongo.ASCENDING)])
+
+    def key(self, coerced_request: Dict, ds_config: Dict) -> str:
+        material = {
+            "request": coerced_request,
+            "datasource": ds_config.get("name"),
+            "config": config_version(ds_config),
+        }
+        return hashlib.sha256(canonical_json(material).encode()).hexdigest()
+
+    def lifetime_for(self, request: PolytopeRequest) -> float:
+        """Short lifetime for requests whose data may still change, i.e. for relative or recent dates"""
+        coerced_date = (request.coerced_request or {}).get("date")
+        if coerced_date is None:
+            return self.lifetime
+        try:
+            user_request = yaml.safe_load(request.user_request) if request.user_request else {}
+        except yaml.YAMLError:
+            user_request = {}
+        if isinstance(user_request, dict) and _is_relative_date(user_request.get("date", "")):
+            return self.lifetime_recent
+        latest = _latest_date(coerced_date)
+        if latest is None or latest >= date.today() - timedelta(days=self.recent_days):
+            return self.lifetime_recent
+        return self.lifetime
+
+    def get(self, key: str, staging: Staging) -> Optional[Dict]:
+        """Returns the live entry for key, or None. Entries whose object has gone from staging are dropped."""
+        now = time.time()
+        entry = self.collection.find_one({"_id": key, "retired": False, "expires": {"$gt": now}})
+        if entry is None:
+            return None
+        if not staging.query(entry["name"]):
+            logging.info("Cached result {} is no longer in staging".format(entry["name"]))
+            self.collection.delete_one({"_id": key, "name": entry["name"]})
+            return None
+        self.collection.update_one(
+            {"_id": key, "name": entry["name"]}, {"$set": {"last_used": now}, "$inc": {"hits": 1}}
+        )
+        return entry
+
+    def put(self, key: str, staged: StagedObject, lifetime: float) -> None:
+        now = time.time()
+        entry = {
+            # Not the URL, which may be presigned and expire before the entry does
+            "name": staged.name,
+            "size": staged.size,
+            "content_type": staged.content_type,
+            "content_encoding": staged.content_encoding,
+            "created": now,
+            "expires": now + lifetime,
+            "last_used": now,
+            "hits": 0,
+            "retired": False,
+        }
+        # A previous entry for the same key stays pinned until the garbage collector releases it
+        previous = self.collection.find_one_and_replace({"_id": key}, dict(entry, _id=key), upsert=True)
+        if previous is not None and previous["name"] != staged.name:
+            retired_id = "{}-{}".format(key, previous["name"])
+            self.collection.replace_one({"_id": retired_id}, dict(previous, _id=retired_id, retired=True), upsert=True)
+
+    def evict(self, retention: float) -> int:
+        """
+        Retires expired and least recently used entries and forgets retired entries unused for retention seconds (the
+        lifetime of requests in the request store). Returns the number of entries retired.
+        """
+        now = time.time()
+        retired = self.collection.update_many(
+            {"retired": False, "expires": {"$lte": now}}, {"$set": {"retired": True}}
+        ).modified_count
+
+        if self.max_size is not None:
+            live = self.collection.find({"retired": False}, {"size": 1}).sort("last_used", pymongo.DESCENDING)
+            total = 0
+            evict = []
+            for entry in live:
+                total += entry["size"]
+                if total > self.max_size:
+                    evict.append(entry["_id"])
+            if evict:
+                retired += self.collection.update_many(
+                    {"_id": {"$in": evict}}, {"$set": {"retired": True}}
+                ).modified_count
+
+        self.collection.delete_many({"retired": True, "last_used": {"$lt": now - retention}})
+        if retired:
+            logging.info("Retired {} cached results".format(retired))
+        return retired
+
+    def pinned(self) -> Set[str]:
+        """Names of staged objects which cache entries refer to"""
+        return {entry["name"] for entry in self.collection.find({}, {"name": 1})}
+
+
+def create_result_cache(config=None) -> Optional[ResultCache]:
+    if not config:
+        return None
+    return ResultCache(config)
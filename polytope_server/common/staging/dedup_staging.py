@@ -0,0 +1,199 @@
+#
+# Copyright 2022 European Centre for Medium-Range Weather Forecasts (ECMWF)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+
+import logging
+import time
+import uuid
+
+import pymongo
+
+from .. import mongo_client_factory
+from . import staging
+
+
+class DedupStaging(staging.Staging):
+    """
+    Stores each unique content once in the wrapped staging, under a key derived from its sha256 digest, and maps
+    request names to it with references kept in MongoDB.
+
+    Data is streamed to a temporary object while it is hashed, then either renamed to its content key or dropped if
+    the content is already staged. URLs of a request point directly at the shared content. Deleting a request only
+    removes its reference; content is removed by collect() once it has been unreferenced for 'grace_period' seconds.
+
+    Each content document carries the key of its content object, generated when the document is first inserted.
+    Content that is re-created after collect() removed its document therefore lands under a new key, and cannot be
+    deleted by a collection that is still in progress.
+    """
+
+    def __init__(self, inner: staging.Staging, config):
+        self.inner = inner
+        self.grace_period = config.get("grace_period", 3600)
+
+        uri = config.get("uri", "mongodb://localhost:27017")
+        collection = config.get("collection", "staging_references")
+        username = config.get("username")
+        password = config.get("password")
+        self.mongo_client = mongo_client_factory.create_client(uri, username, password)
+        self.collection = self.mongo_client.staging[collection]
+        self.collection.create_index("refs")
+        self.collection.create_index("key")
+        self.collection.create_index([("refs", pymongo.ASCENDING), ("updated", pymongo.ASCENDING)])
+
+        logging.info("Deduplicating data in {}".format(inner.get_type()))
+
+    def _resolve(self, name):
+        # Content keys, as found in request URLs, resolve to themselves
+        doc = self.collection.find_one(
+            {"$or": [{"refs": name}, {"key": name}]}, {"key": 1, "size": 1, "content_type": 1}
+        )
+        if doc is None:
+            raise KeyError(name)
+        return doc
+
+    def create(self, name, data, content_type, content_encoding=None):
+        incoming = "incoming-{}".format(uuid.uuid4().hex)
+        # Iterated rather than transferred in the kernel (see DataSource.result), as the checksum is needed
+        uploaded = self.inner.create(incoming, iter(data), content_type, content_encoding)
+        checksum = uploaded.checksum
+        if checksum is None:
+            self.inner.delete(incoming)
+            raise ValueError("{} does not report checksums, cannot deduplicate".format(self.inner.get_type()))
+
+        # Keep any suffix the wrapped staging added to the name (e.g. a file extension for the content type)
+        incoming, suffix = uploaded.name, uploaded.name[len(incoming) :]
+        key = "sha256-{}-{}{}".format(checksum, uuid.uuid4().hex[:8], suffix)
+        now = time.time()
+        # A request name refers to a single content, drop any previous reference before adding the new one
+        self.collection.update_many({"refs": name}, {"$pull": {"refs": name}, "$set": {"updated": now}})
+        doc = self.collection.find_one_and_update(
+            {"_id": "{}:{}:{}".format(content_type, content_encoding or "identity", checksum)},
+            {
+                "$addToSet": {"refs": name},
+                "$set": {"updated": now},
+                "$setOnInsert": {"key": key, "size": uploaded.size, "content_type": content_type, "created": now},
+            },
+            upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER,
+        )
+
+        if doc["key"] == key or not self.inner.query(doc["key"]):
+            # New content, or its first writer has not finished renaming it into place yet
+            self.inner.rename(incoming, doc["key"])
+            logging.info("Staged {} as new content {}".format(name, doc["key"]))
+        else:
+            self.inner.delete(incoming)
+            logging.info("Staged {} as a reference to existing content {}".format(name, doc["key"]))
+
+        return staging.StagedObject(
+            name, self.inner.get_url(doc["key"]), uploaded.size, content_type, checksum, content_encoding
+        )
+
+    def read(self, name):
+        return self.inner.read(self._resolve(name)["key"])
+
+    def read_stream(self, name, start=None, end=None, chunk_size=1024 * 1024):
+        return self.inner.read_stream(self._resolve(name)["key"], start, end, chunk_size)
+
+    def delete(self, name):
+        result = self.collection.update_many(
+            {"refs": name}, {"$pull": {"refs": name}, "$set": {"updated": time.time()}}
+        )
+        if result.matched_count == 0:
+            raise KeyError(name)
+        return True
+
+    def delete_many(self, names):
+        names = list(names)
+        self.collection.update_many(
+            {"refs": {"$in": names}},
+            {"$pull": {"refs": {"$in": names}}, "$set": {"updated": time.time()}},
+        )
+        return {}
+
+    def query(self, name):
+        try:
+            self._resolve(name)
+        except KeyError:
+            return False
+        return True
+
+    def stat(self, name):
+        doc = self._resolve(name)
+        return doc["content_type"], doc["size"]
+
+    def list(self):
+        """
+        Lists the references, so that each request appears in the listing. The size of shared content is divided
+        between its references, so that the sizes add up to what is actually stored.
+        """
+        for doc in self.collection.find({"refs.0": {"$exists": True}}, {"refs": 1, "size": 1, "updated": 1}):
+            share, extra = divmod(doc["size"], len(doc["refs"]))
+            for i, name in enumerate(doc["refs"]):
+                yield staging.ResourceInfo(name, share + (1 if i < extra else 0), doc["updated"])
+
+    def collect(self, incomplete=False):
+        """
+        Deletes content which has not been referenced for grace_period seconds, and if incomplete is True uploads
+        interrupted for as long (which needs a full listing of the wrapped staging). Returns the number removed.
+        """
+        cutoff = time.time() - self.grace_period
+        removed = 0
+        for doc in self.collection.find({"refs": {"$size": 0}, "updated": {"$lt": cutoff}}, {"_id": 1}):
+            # Re-check atomically, a request may have referenced this content since
+            doc = self.collection.find_one_and_delete(
+                {"_id": doc["_id"], "refs": {"$size": 0}, "updated": {"$lt": cutoff}}
+            )
+            if doc is None:
+                continue
+            try:
+                self.inner.delete(doc["key"])
+            except Exception as e:
+                logging.warning("Could not delete unreferenced content {}: {}".format(doc["key"], e))
+            removed += 1
+
+        if not incomplete:
+            return removed
+
+        # Uploads interrupted before they could be renamed to their content key
+        for resource in self.inner.list():
+            if resource.name.startswith("incoming-") and resource.last_modified < cutoff:
+                try:
+                    self.inner.delete(resource.name)
+                    removed += 1
+                except Exception as e:
+                    logging.warning("Could not delete incomplete upload {}: {}".format(resource.name, e))
+
+        return removed
+
+    def wipe(self):
+        self.inner.wipe()
+        self.collection.delete_many({})
+
+    def get_url(self, name):
+        return self.inner.get_url(self._resolve(name)["key"])
+
+    def get_internal_url(self, name):
+        return self.inner.get_internal_url(self._resolve(name)["key"])
+
+    def get_url_prefix(self):
+        return self.inner.get_url_prefix()
+
+    def get_type(self):
+        return "Dedup{}".format(self.inner.get_type())
@@ -0,0 +1,237 @@
+#
+# Copyright 2022 European Centre for Medium-Range Weather Forecasts (ECMWF)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+
+import logging
+import os
+import tempfile
+
+from . import staging
+
+# Extended attributes holding the HTTP headers of a staged file, shared with the basic object store
+CONTENT_TYPE_XATTR = "user.polytope.content_type"
+CONTENT_ENCODING_XATTR = "user.polytope.content_encoding"
+DEFAULT_CONTENT_TYPE = "application/octet-stream"
+
+
+def _read_xattr(path, attribute, default):
+    try:
+        return os.getxattr(path, attribute).decode()
+    except (OSError, AttributeError):
+        return default
+
+
+def _write_xattr(path, attribute, value):
+    try:
+        os.setxattr(path, attribute, value.encode())
+        return True
+    except (OSError, AttributeError):
+        return False
+
+
+def read_content_type(path, default=DEFAULT_CONTENT_TYPE):
+    return _read_xattr(path, CONTENT_TYPE_XATTR, default)
+
+
+def write_content_type(path, content_type):
+    """Returns False if the filesystem does not support extended attributes"""
+    return _write_xattr(path, CONTENT_TYPE_XATTR, content_type)
+
+
+def read_content_encoding(path):
+    return _read_xattr(path, CONTENT_ENCODING_XATTR, None)
+
+
+def write_content_encoding(path, content_encoding):
+    """Returns False if the filesystem does not support extended attributes"""
+    return _write_xattr(path, CONTENT_ENCODING_XATTR, content_encoding)
+
+
+class LocalStaging(staging.Staging):
+    """
+    Stages data as files in a directory on a local or shared filesystem, to be served by a sendfile-capable web
+    server (e.g. the basic object store or nginx) pointed at the same directory and published under 'url'.
+
+    Files are written to a temporary name in the same directory and renamed into place once complete, so readers
+    never see partial data. They are synced to disk once, on close, and can be preallocated in extents of
+    'preallocate' bytes to limit fragmentation when many results are written concurrently.
+
+    With 'splice', results which can move themselves to a file descriptor (see DataSource.result) are written by the
+    kernel without passing through the worker. No checksum is computed for them.
+    """
+
+    def __init__(self, config):
+        self.root_dir = os.path.abspath(config.get("root_dir", "/data"))
+        self.url = config.get("url", None)
+        self.internal_url = config.get("internal_url", None)
+        self.fsync = config.get("fsync", True)
+        self.preallocate = int(config.get("preallocate", 0))
+        self.buffer_size = int(config.get("buffer_size", 1024 * 1024))
+        self.splice = config.get("splice", False)
+
+        os.makedirs(self.root_dir, exist_ok=True)
+        logging.info("Opened local data staging at {}".format(self.root_dir))
+
+    def _path(self, name):
+        if not name or name.startswith(".") or os.sep in name:
+            raise ValueError("Invalid resource name {}".format(name))
+        return os.path.join(self.root_dir, name)
+
+    def create(self, name, data, content_type, content_encoding=None):
+        path = self._path(name)
+        transfer = getattr(data, "transfer_to", None) if self.splice else None
+        if transfer is None:
+            data = staging.DigestIterator(data)
+        logging.info("Creating resource: {}".format(name))
+
+        fd, tmp = tempfile.mkstemp(dir=self.root_dir, prefix=".tmp-{}-".format(name))
+        try:
+            with open(fd, "wb", buffering=self.buffer_size) as f:
+                if transfer is not None:
+                    size, checksum = transfer(fd), None
+                else:
+                    self._write(f, data)
+                    size, checksum = data.size, data.checksum
+                if self.fsync:
+                    os.fsync(fd)
+            write_content_type(tmp, content_type)
+            if content_encoding:
+                write_content_encoding(tmp, content_encoding)
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+        if self.fsync:
+            self._fsync_dir()
+
+        return staging.StagedObject(name, self.get_url(name), size, content_type, checksum, content_encoding)
+
+    def _write(self, f, data):
+        fd = f.fileno()
+        allocated = 0
+        preallocate = self.preallocate
+        for chunk in data:
+            if preallocate and data.size > allocated:
+                allocated = self._fallocate(fd, allocated, data.size, preallocate)
+                if allocated is None:
+                    preallocate, allocated = 0, 0
+            f.write(chunk)
+        f.flush()
+        if allocated > data.size:
+            os.ftruncate(fd, data.size)
+
+    @staticmethod
+    def _fallocate(fd, allocated, needed, extent):
+        """Reserves space in whole extents beyond needed, returning the new allocation or None if not supported"""
+        target = (needed // extent + 1) * extent
+        try:
+            os.posix_fallocate(fd, allocated, target - allocated)
+        except (OSError, AttributeError) as e:
+            logging.debug("Preallocation not supported, disabling it: {}".format(e))
+            return None
+        return target
+
+    def _fsync_dir(self):
+        # Makes the rename itself durable
+        fd = os.open(self.root_dir, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def read(self, name):
+        try:
+            with open(self._path(name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            raise KeyError(name)
+
+    def read_stream(self, name, start=None, end=None, chunk_size=1024 * 1024):
+        try:
+            f = open(self._path(name), "rb")
+        except FileNotFoundError:
+            raise KeyError(name)
+        with f:
+            f.seek(start or 0)
+            remaining = None if end is None else end + 1 - (start or 0)
+            while remaining is None or remaining > 0:
+                chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def delete(self, name):
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            raise KeyError(name)
+        return True
+
+    def rename(self, src, dst):
+        try:
+            os.replace(self._path(src), self._path(dst))
+        except FileNotFoundError:
+            raise KeyError(src)
+
+    def query(self, name):
+        return os.path.isfile(self._path(name))
+
+    def stat(self, name):
+        path = self._path(name)
+        try:
+            size = os.stat(path).st_size
+        except FileNotFoundError:
+            raise KeyError(name)
+        return read_content_type(path), size
+
+    def list(self):
+        with os.scandir(self.root_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith(".") or not entry.is_file():
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield staging.ResourceInfo(entry.name, st.st_size, st.st_mtime)
+
+    def wipe(self):
+        errors = self.delete_many(r.name for r in self.list())
+        if errors:
+            raise Exception("Could not delete {} resources: {}".format(len(errors), errors))
+
+    def get_url(self, name):
+        if self.url is None:
+            return None
+        return "{}/{}".format(self.url, name)
+
+    def get_internal_url(self, name):
+        if self.internal_url is None:
+            return "file://{}".format(self._path(name))
+        return "{}/{}".format(self.internal_url, name)
+
+    def get_url_prefix(self):
+        return ""
+
+    def get_type(self):
+        return "LocalStaging"
@@ -18,7 +18,6 @@
 # does it submit to any jurisdiction.
 #
 
-import json
 import logging
 
 import requests
@@ -35,49 +34,72 @@ class PolytopeStaging(staging.Staging):
         self.url = config.get("url", None)
         self.internal_url = "http://%s:%s" % (self.host, self.port)
 
+        # Reuses connections to the object store across requests
+        self.session = requests.Session()
+
         logging.info("Opened data staging at {}".format(self.internal_url))
 
-    def create(self, name, data, content_type):
+    def create(self, name, data, content_type, content_encoding=None):
 
         headers = {"Content-Type": content_type}
-        buffer = b""
-        for d in data:
-            buffer += d
+        if content_encoding:
+            headers["Content-Encoding"] = content_encoding
+        data = staging.DigestIterator(data)
         logging.info("Creating resource: {}".format(name))
-        response = requests.put(self.get_internal_url(name), headers=headers, data=buffer)
+        # A generator body is sent with chunked transfer-encoding, so the upload proceeds while data is still being
+        # produced and is never held in memory as a whole. Empty chunks would terminate the body early.
+        response = self.session.put(
+            self.get_internal_url(name), headers=headers, data=(chunk for chunk in data if len(chunk) > 0)
+        )
         if response.status_code != 201:
             raise Exception(
                 "Could not create resource {},returned with status code: {}".format(name, response.status_code)
             )
-        return self.get_url(name)
+        return staging.StagedObject(name, self.get_url(name), data.size, content_type, data.checksum, content_encoding)
 
     def read(self, name):
-        response = requests.get(self.get_internal_url(name), headers={})
-        if response.status_code != 200:
-            raise Exception(
-                "Could not read resource {}, returned with status code: {}".format(name, response.status_code)
-            )
-        return response._content
+        return b"".join(self.read_stream(name))
+
+    def read_stream(self, name, start=None, end=None, chunk_size=1024 * 1024):
+        headers = {}
+        if start is not None or end is not None:
+            headers["Range"] = "bytes={}-{}".format(start or 0, "" if end is None else end)
+        with self.session.get(self.get_internal_url(name), headers=headers, stream=True) as response:
+            if response.status_code not in (200, 206):
+                raise Exception(
+                    "Could not read resource {}, returned with status code: {}".format(name, response.status_code)
+                )
+            # The stored bytes as they are, iter_content would undo any Content-Encoding
+            yield from response.raw.stream(chunk_size, decode_content=False)
 
     def delete(self, name):
-        response = requests.delete(self.get_internal_url(name), headers={})
+        response = self.session.delete(self.get_internal_url(name), headers={})
         if response.status_code == 200:
             return True
-        elif response.status_code == 401:
-            raise KeyError()
+        elif response.status_code in (401, 404):
+            raise KeyError(name)
         else:
             raise Exception(
                 "Could not delete resource {}, returned with status code: {}".format(name, response.status_code)
             )
 
+    def rename(self, src, dst):
+        response = self.session.request("MOVE", self.get_internal_url(src), headers={"Destination": "/" + dst})
+        if response.status_code == 404:
+            raise KeyError(src)
+        if response.status_code != 201:
+            raise Exception(
+                "Could not move resource {} to {}, returned with status code: {}".format(src, dst, response.status_code)
+            )
+
     def query(self, name):
-        response = requests.head(self.get_internal_url(name), headers={})
+        response = self.session.head(self.get_internal_url(name), headers={})
         if response.status_code == 200:
             return True
         return False
 
     def stat(self, name):
-        response = requests.head(self.get_internal_url(name), headers={})
+        response = self.session.head(self.get_internal_url(name), headers={})
         if response.status_code == 200:
             return str(response.headers["Content-Type"]), int(response.headers["Content-Length"])
         elif response.status_code == 404:
@@ -88,18 +110,15 @@ class PolytopeStaging(staging.Staging):
             )
 
     def list(self):
-        response = requests.get(self.internal_url, headers={})
-        if response.status_code == 200:
-            resources = []
-            for k, v in json.loads(response.content.decode()).items():
-                resources.append(staging.ResourceInfo(k, v))
-            return resources
-        else:
+        response = self.session.get(self.internal_url, headers={})
+        if response.status_code != 200:
             raise Exception("Could not list resources, returned with status code: {}".format(response.status_code))
-
         resources = []
         for k, v in response.json().items():
-            resources.append(staging.ResourceInfo(k, v))
+            if isinstance(v, dict):
+                resources.append(staging.ResourceInfo(k, v["size"], v.get("last_modified")))
+            else:
+                resources.append(staging.ResourceInfo(k, v))
         return resources
 
     def wipe(self):
@@ -18,10 +18,12 @@
 # does it submit to any jurisdiction.
 #
 
+import itertools
 import json
 import logging
-import time
-from concurrent.futures import Future, ThreadPoolExecutor
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 import botocore
@@ -31,32 +33,11 @@ from ..exceptions import NotFound
 from . import staging
 
 
-class AvailableThreadPoolExecutor(ThreadPoolExecutor):
-    def __init__(self, max_workers=None, thread_name_prefix="", initializer=None, initargs=()):
-        super().__init__(max_workers, thread_name_prefix, initializer, initargs)
-        self._running_worker_futures: set[Future] = set()
-
-    @property
-    def available_workers(self) -> int:
-        return self._max_workers - len(self._running_worker_futures)
-
-    def wait_for_available_worker(self, timeout=None) -> None:
-        start_time = time.monotonic()
-        while True:
-            if self.available_workers > 0:
-                return
-            if timeout is not None and time.monotonic() - start_time > timeout:
-                raise TimeoutError
-            time.sleep(0.1)
-
-    def submit(self, fn, /, *args, **kwargs):
-        f = super().submit(fn, *args, **kwargs)
-        self._running_worker_futures.add(f)
-        f.add_done_callback(self._running_worker_futures.remove)
-        return f
-
-
 class S3Staging(staging.Staging):
+    PART_SIZE_DOUBLING = 1000
+    LIST_PAGE_SIZE = 1000
+    DELETE_BATCH_SIZE = 1000  # maximum accepted by delete_objects
+
     def __init__(self, config):
         self.bucket = config.get("bucket", "default")
         self.url = config.get("url", None)
@@ -71,8 +52,11 @@ class S3Staging(staging.Staging):
         self.port = config.get("port", "8333")
         self.use_ssl = config.get("use_ssl", False)
         self.max_threads = config.get("max_threads", 10)
+        self.list_shards = min(config.get("list_shards", 1), 16)
         self.buffer_size = config.get("buffer_size", 10 * 1024 * 1024)
         self.should_set_policy = config.get("should_set_policy", False)
+        # Days after which S3 deletes staged objects by itself, see set_lifecycle_rules
+        self.expiration_days = config.get("expiration_days")
 
         access_key = config.get("access_key", "")
         secret_key = config.get("secret_key", "")
@@ -109,55 +93,57 @@ class S3Staging(staging.Staging):
         # Set bucket policy
         if self.should_set_policy:
             self.set_bucket_policy()
+        if self.expiration_days is not None:
+            self.set_lifecycle_rules()
 
         logging.info(f"Opened data staging at {self.host}:{self.port} with bucket {self.bucket}")
 
-    def create(self, name, data, content_type):
+    def create(self, name, data, content_type, content_encoding=None):
 
         type_extension_map = {"application/x-grib": "grib", "application/prs.coverage+json": "covjson"}
 
         # seaweedfs does not store content-type, so we need to use an extension to communicate mime-type
         name = name + "." + type_extension_map.get(content_type, "bin")
-
-        try:
-            multipart_upload = self.s3_client.create_multipart_upload(
-                Bucket=self.bucket,
-                Key=name,
-                ContentType=content_type,
-                ContentDisposition="attachment",
+        encoding = {"ContentEncoding": content_encoding} if content_encoding else {}
+
+        data = staging.DigestIterator(data)
+        parts = self.iterator_buffer(data, self.buffer_size)
+        first_part = next(parts, None)
+        if first_part is None:
+            logging.warning(f"No data provided for {name}.")
+            raise ValueError("No data retrieved")
+
+        # Results smaller than one part are uploaded with a single PUT
+        second_part = next(parts, None)
+        if second_part is None:
+            try:
+                self.s3_client.put_object(
+                    Bucket=self.bucket,
+                    Key=name,
+                    Body=first_part,
+                    ContentType=content_type,
+                    ContentDisposition="attachment",
+                    **encoding,
+                )
+            except ClientError as e:
+                logging.exception(f"Failed to upload {name}: {e}")
+                raise
+            logging.info(f"Successfully uploaded {name} in a single request.")
+            return staging.StagedObject(
+                name, self.get_url(name), data.size, content_type, data.checksum, content_encoding
             )
-            upload_id = multipart_upload["UploadId"]
 
-            parts = []
-            part_number = 1
-            futures = []
+        multipart_upload = self.s3_client.create_multipart_upload(
+            Bucket=self.bucket,
+            Key=name,
+            ContentType=content_type,
+            ContentDisposition="attachment",
+            **encoding,
+        )
+        upload_id = multipart_upload["UploadId"]
 
-            with AvailableThreadPoolExecutor(max_workers=self.max_threads) as executor:
-                executor.wait_for_available_worker()
-                if not data:
-                    logging.info(f"No data provided. Uploading a single empty part for {name}.")
-                else:
-                    for part_data in self.iterator_buffer(data, self.buffer_size):
-                        if part_data:
-                            futures.append(
-                                executor.submit(
-                                    self.upload_part,
-                                    name,
-                                    part_number,
-                                    part_data,
-                                    upload_id,
-                                )
-                            )
-                            part_number += 1
-
-                    for future in futures:
-                        result = future.result()
-                        parts.append(result)
-
-            if not parts:
-                logging.warning(f"No parts uploaded for {name}. Aborting upload.")
-                self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=name, UploadId=upload_id)
-                raise ValueError("No data retrieved")
+        try:
+            parts = self.upload_parts(name, itertools.chain([first_part, second_part], parts), upload_id)
 
             self.s3_client.complete_multipart_upload(
                 Bucket=self.bucket,
@@ -167,14 +153,41 @@ class S3Staging(staging.Staging):
             )
 
             logging.info(f"Successfully uploaded {name} in {len(parts)} parts.")
-            return self.get_url(name)
+            return staging.StagedObject(
+                name, self.get_url(name), data.size, content_type, data.checksum, content_encoding
+            )
 
-        except ClientError as e:
+        except Exception as e:
+            # Also covers failures of the data iterator, which would otherwise leave the upload dangling
             logging.exception(f"Failed to upload {name}: {e}")
-            if "upload_id" in locals():
-                self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=name, UploadId=upload_id)
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=name, UploadId=upload_id)
             raise
 
+    def upload_parts(self, name, parts, upload_id):
+        """
+        Uploads parts concurrently while the next ones are being read. At most max_threads parts are in flight, so
+        reading stalls rather than buffering the whole object in memory when uploads fall behind.
+        """
+        window = threading.BoundedSemaphore(self.max_threads)
+        errors = []
+
+        def on_done(future):
+            if future.exception() is not None:
+                errors.append(future.exception())
+            window.release()
+
+        futures = []
+        with ThreadPoolExecutor(max_workers=self.max_threads) as executor:
+            for part_number, part_data in enumerate(parts, start=1):
+                window.acquire()
+                if errors:
+                    window.release()
+                    raise errors[0]
+                future = executor.submit(self.upload_part, name, part_number, part_data, upload_id)
+                future.add_done_callback(on_done)
+                futures.append(future)
+            return [future.result() for future in futures]
+
     def upload_part(self, name, part_number, data, upload_id):
         logging.debug(f"Uploading part {part_number} of {name}, {len(data)} bytes")
         response = self.s3_client.upload_part(
@@ -186,6 +199,31 @@ class S3Staging(staging.Staging):
         )
         return {"PartNumber": part_number, "ETag": response["ETag"]}
 
+    def set_lifecycle_rules(self):
+        """
+        Lets S3 delete objects expiration_days after they were written, and clean up multipart uploads which were
+        never completed, so that the garbage collector does not have to. Objects must not be needed for longer:
+        results served from the result cache, or deduplicated content, should use a cache lifetime (or age) shorter
+        than expiration_days.
+        """
+        rules = {
+            "Rules": [
+                {
+                    "ID": "polytope-expire-staged-data",
+                    "Status": "Enabled",
+                    "Filter": {"Prefix": ""},
+                    "Expiration": {"Days": self.expiration_days},
+                    "AbortIncompleteMultipartUpload": {"DaysAfterInitiation": 1},
+                }
+            ]
+        }
+        try:
+            self.s3_client.put_bucket_lifecycle_configuration(Bucket=self.bucket, LifecycleConfiguration=rules)
+            logging.info(f"Objects in bucket {self.bucket} expire after {self.expiration_days} days.")
+        except ClientError as e:
+            # Not every S3-compatible store supports lifecycle rules, the garbage collector still removes old data
+            logging.exception(f"Error setting lifecycle rules: {e}")
+
     def set_bucket_policy(self):
         """
         Grants read access to individual objects - user has access to all objects, but would need to know the UUID.
@@ -228,6 +266,17 @@ class S3Staging(staging.Staging):
             logging.exception(f"Could not read object {name}: {e}")
             raise NotFound(name)
 
+    def read_stream(self, name, start=None, end=None, chunk_size=1024 * 1024):
+        kwargs = {"Bucket": self.bucket, "Key": name}
+        if start is not None or end is not None:
+            kwargs["Range"] = "bytes={}-{}".format(start or 0, "" if end is None else end)
+        try:
+            response = self.s3_client.get_object(**kwargs)
+        except ClientError as e:
+            logging.exception(f"Could not read object {name}: {e}")
+            raise NotFound(name)
+        yield from response["Body"].iter_chunks(chunk_size)
+
     def delete(self, name):
         try:
             self.s3_client.delete_object(Bucket=self.bucket, Key=name)
@@ -236,6 +285,11 @@ class S3Staging(staging.Staging):
             logging.exception(f"Could not delete object {name}: {e}")
             raise NotFound(name)
 
+    def rename(self, src, dst):
+        # Server-side copy, done in parts for objects over 5GB
+        self.s3_client.copy({"Bucket": self.bucket, "Key": src}, self.bucket, dst)
+        self.delete(src)
+
     def query(self, name):
         try:
             self.s3_client.head_object(Bucket=self.bucket, Key=name)
@@ -271,43 +325,145 @@ class S3Staging(staging.Staging):
         return "S3DataStaging_boto3"
 
     def list(self):
+        """
+        Lists all objects page by page, without holding the whole listing in memory. With list_shards > 1, the key
+        space is split into ranges (by leading hex character, as keys are request ids) which are listed in parallel.
+        """
+        if self.list_shards <= 1:
+            yield from self._list_range(None, None)
+            return
+
+        alphabet = "0123456789abcdef"
+        bounds = [None] + [alphabet[i * len(alphabet) // self.list_shards] for i in range(1, self.list_shards)] + [None]
+        ranges = list(zip(bounds[:-1], bounds[1:]))
+
+        pages = queue.Queue(maxsize=2 * len(ranges))
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def list_shard(start, end):
+            try:
+                for page in self._list_pages(start, end):
+                    put(page)
+            except Exception as e:
+                put(e)
+            finally:
+                put(None)
+
+        threads = [threading.Thread(target=list_shard, args=r, daemon=True) for r in ranges]
+        for thread in threads:
+            thread.start()
         try:
-            resources = []
-            data = self.s3_client.list_objects_v2(Bucket=self.bucket, MaxKeys=999999999999999)
-
-            if data.get("contents", {}).get("IsTruncated  ncated", False):
-                logging.warning("Truncated list of objects. Some objects may not be listed.")
-
-            if "Contents" not in data:  # No objects in the bucket
-                return resources
-            for o in data["Contents"]:
-                resources.append(staging.ResourceInfo(o["Key"], o["Size"], o["LastModified"].timestamp()))
-            return resources
+            remaining = len(threads)
+            while remaining:
+                page = pages.get()
+                if page is None:
+                    remaining -= 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    yield from page
+        finally:
+            stop.set()
+
+    def _list_range(self, start, end):
+        for page in self._list_pages(start, end):
+            yield from page
+
+    def _list_pages(self, start, end):
+        """Yields pages of ResourceInfo for keys in (start, end], where None means unbounded"""
+        kwargs = {"Bucket": self.bucket, "MaxKeys": self.LIST_PAGE_SIZE}
+        if start is not None:
+            kwargs["StartAfter"] = start
+        try:
+            while True:
+                data = self.s3_client.list_objects_v2(**kwargs)
+                page = []
+                for o in data.get("Contents", []):
+                    if end is not None and o["Key"] > end:
+                        yield page
+                        return
+                    page.append(staging.ResourceInfo(o["Key"], o["Size"], o["LastModified"].timestamp()))
+                yield page
+                if not data.get("IsTruncated", False):
+                    return
+                kwargs["ContinuationToken"] = data["NextContinuationToken"]
         except ClientError as e:
             logging.exception(f"Failed to list objects: {e}")
             raise
 
+    def delete_many(self, names):
+        """Deletes objects with delete_objects in batches of up to 1000 keys, max_threads batches at a time"""
+        errors = {}
+        window = threading.BoundedSemaphore(self.max_threads)
+
+        def on_done(future):
+            errors.update(future.result())
+            window.release()
+
+        with ThreadPoolExecutor(max_workers=self.max_threads) as executor:
+            for batch in staging.batched(({"Key": name} for name in names), self.DELETE_BATCH_SIZE):
+                window.acquire()
+                executor.submit(self._delete_batch, batch).add_done_callback(on_done)
+        return errors
+
+    def _delete_batch(self, batch):
+        try:
+            response = self.s3_client.delete_objects(Bucket=self.bucket, Delete={"Objects": batch, "Quiet": True})
+        except Exception as e:
+            logging.exception(f"Error deleting objects: {e}")
+            return {o["Key"]: repr(e) for o in batch}
+        return {e["Key"]: "{}: {}".format(e.get("Code"), e.get("Message")) for e in response.get("Errors", [])}
+
     def wipe(self):
-        objects_to_delete = self.list()
-        delete_objects = [{"Key": obj} for obj in objects_to_delete]
-        if delete_objects:
-            try:
-                logging.info(f"Deleting {len(delete_objects)} : {delete_objects} objects from {self.bucket}")
-                self.s3_client.delete_objects(Bucket=self.bucket, Delete={"Objects": delete_objects})
-            except ClientError as e:
-                logging.exception(f"Error deleting objects: {e}")
-                raise
+        errors = self.delete_many(o.name for o in self.list())
+        if errors:
+            logging.error(f"Could not delete {len(errors)} objects from {self.bucket}: {errors}")
+            raise Exception(f"Could not delete {len(errors)} objects from {self.bucket}")
+        logging.info(f"Wiped all objects from {self.bucket}")
 
     def get_url_prefix(self):
         return "{}/".format(self.bucket)
 
     def iterator_buffer(self, iterable, buffer_size):
-        buffer = b""
+        """
+        Regroups the chunks of iterable into parts of at least buffer_size bytes (except the last one). Each part is
+        filled in place with a single copy of the input, except bytearray chunks of at least a part, which are owned
+        by the consumer (see DataSource.result) and used as parts without copying them. The part size doubles every
+        PART_SIZE_DOUBLING parts, so that large objects stay within the S3 limit of 10000 parts.
+        """
+        part_number = 0
+        part_size = buffer_size
+        part = bytearray(part_size)
+        filled = 0
         for data in iterable:
-            buffer += data
-            if len(buffer) >= buffer_size:
-                output, leftover = buffer[:buffer_size], buffer[buffer_size:]
-                buffer = leftover
-                yield output
-
-        yield buffer
+            if filled == 0 and type(data) is bytearray and len(data) >= part_size:
+                yield data
+                part_number += 1
+                part_size = buffer_size * 2 ** (part_number // self.PART_SIZE_DOUBLING)
+                if len(part) != part_size:
+                    part = bytearray(part_size)
+                continue
+            view = memoryview(data).cast("B")
+            while view:
+                n = min(len(view), part_size - filled)
+                part[filled : filled + n] = view[:n]
+                filled += n
+                view = view[n:]
+                if filled == part_size:
+                    yield part
+                    part_number += 1
+                    part_size = buffer_size * 2 ** (part_number // self.PART_SIZE_DOUBLING)
+                    part = bytearray(part_size)
+                    filled = 0
+
+        if filled:
+            del part[filled:]
+            yield part
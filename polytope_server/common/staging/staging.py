@@ -18,10 +18,13 @@
 # does it submit to any jurisdiction.
 #
 
+import hashlib
 import importlib
 import warnings
 from abc import ABC, abstractmethod
-from typing import AnyStr, Iterator, List, Tuple
+from typing import AnyStr, Dict, Iterable, Iterator, Tuple
+
+from ..exceptions import NotFound
 
 deprecated_staging_types = {
     "s3_boto3": "s3",
@@ -30,10 +33,61 @@ deprecated_staging_types = {
 type_to_class_map = {
     "polytope": "PolytopeStaging",
     "s3": "S3Staging",
+    "local": "LocalStaging",
+    "tiered": "TieredStaging",
     # 's3_boto3' is no longer supported, but we keep it here for backward compatibility
 }
 
 
+def batched(iterable: Iterable, n: int) -> Iterator[list]:
+    """Yields lists of n items from iterable, the last one possibly shorter"""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == n:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class DigestIterator:
+    """Wraps an iterator of bytes-like chunks, computing the size and sha256 checksum of the data passing through"""
+
+    def __init__(self, data: Iterable[bytes]):
+        self._data = iter(data)
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk = next(self._data)
+        self.size += memoryview(chunk).nbytes
+        self._hash.update(chunk)
+        return chunk
+
+    @property
+    def checksum(self) -> str:
+        return self._hash.hexdigest()
+
+
+class StagedObject:
+    """Describes an object as written by Staging.create, so that callers need not query it again"""
+
+    def __init__(self, name, url, size, content_type, checksum=None, content_encoding=None):
+        self.name = name
+        self.url = url
+        self.size = size
+        self.content_type = content_type
+        self.checksum = checksum
+        self.content_encoding = content_encoding
+
+    def __repr__(self):
+        return f"StagedObject({self.name}, {self.url}, {self.size}, {self.content_type}, {self.checksum})"
+
+
 class ResourceInfo:
     def __init__(self, name, size, last_modified=None):
         self.name = name
@@ -49,12 +103,14 @@ class Staging(ABC):
         """Initialize a data store"""
 
     @abstractmethod
-    def create(self, name: str, data: Iterator[bytes], content_type: str) -> str:
+    def create(self, name: str, data: Iterator[bytes], content_type: str, content_encoding: str = None) -> StagedObject:
         """Create new resource. If the resource already exists, update it.
         :param name: name of the resource to create
         :data: a python object
         :content_type: a string corresponding to the HTTP 'content-type' header
-        :returns: fully-qualified URL to the resource, eg. "http://polytope.com/downloads/{name}"
+        :content_encoding: if the data is compressed, the HTTP 'content-encoding' to serve it with
+        :returns: the StagedObject written, with its fully-qualified URL (eg. "http://polytope.com/downloads/{name}"),
+            its actual name in staging, size, content type and sha256 checksum
         """
 
     @abstractmethod
@@ -63,6 +119,17 @@ class Staging(ABC):
         :return: data
         """
 
+    def read_stream(
+        self, name: str, start: int = None, end: int = None, chunk_size: int = 1024 * 1024
+    ) -> Iterator[bytes]:
+        """Read resource in chunks, optionally only the byte range start-end (both inclusive).
+        Staging types that can stream or serve ranges should override this.
+        """
+        data = self.read(name)
+        data = data[start or 0 : None if end is None else end + 1]
+        for i in range(0, len(data), chunk_size):
+            yield data[i : i + chunk_size]
+
     @abstractmethod
     def delete(self, name: str) -> bool:
         """Delete an object, return true on success"""
@@ -88,13 +155,54 @@ class Staging(ABC):
         """Returns the type of the staging in use"""
 
     @abstractmethod
-    def list(self) -> List[ResourceInfo]:
-        """List all resources"""
+    def list(self) -> Iterable[ResourceInfo]:
+        """List all resources, possibly lazily"""
 
     @abstractmethod
     def wipe(self) -> None:
         """Delete all resources"""
 
+    def delete_many(self, names: Iterable[str]) -> Dict[str, str]:
+        """Delete many objects, returning a mapping of name to error message for those that could not be deleted.
+        Staging types that support batched deletes should override this. Objects which do not exist count as deleted.
+        """
+        errors = {}
+        for name in names:
+            try:
+                self.delete(name)
+            except (KeyError, NotFound):
+                pass
+            except Exception as e:
+                errors[name] = repr(e)
+        return errors
+
+    def rename(self, src: str, dst: str) -> None:
+        """Move an object to a new name, replacing any object of that name.
+        Staging types that can move objects without transferring them should override this.
+        """
+        content_type, _ = self.stat(src)
+        self.create(dst, self.read_stream(src), content_type)
+        self.delete(src)
+
+    def collect(self, incomplete: bool = False) -> int:
+        """Delete data no longer referenced by any resource, returning the number of objects removed.
+        Only staging types which share data between resources have anything to collect. If incomplete is True, also
+        delete leftovers of interrupted writes, which may take a full listing of the underlying storage.
+        """
+        return 0
+
+    def migrate(self) -> int:
+        """Move data between storage tiers, returning the number of objects moved.
+        Only tiered staging types have anything to migrate.
+        """
+        return 0
+
+    def resolve(self, name: str) -> str:
+        """Get the url where the data of an object can currently be downloaded from.
+        Differs from get_url only for staging types publishing URLs of a redirecting resolver.
+        """
+        return self.get_url(name)
+
     @abstractmethod
     def get_url_prefix(self) -> str:
         """Get url prefix for all objects (e.g. bucket name or other static URL segment)"""
@@ -128,4 +236,12 @@ def create_staging(staging_config=None) -> Staging:
     StagingClass = getattr(StagingModule, class_name)
 
     # Instantiate and return the staging object with the appropriate config
-    return StagingClass(staging_config[staging_type])
+    instance = StagingClass(staging_config[staging_type])
+
+    # Optional layer storing identical results once
+    dedup_config = staging_config[staging_type].get("deduplicate")
+    if dedup_config:
+        from .dedup_staging import DedupStaging
+
+        instance = DedupStaging(instance, dedup_config if isinstance(dedup_config, dict) else {})
+    return instance
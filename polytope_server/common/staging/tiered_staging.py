@@ -0,0 +1,258 @@
+#
+# Copyright 2022 European Centre for Medium-Range Weather Forecasts (ECMWF)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pymongo
+
+from .. import mongo_client_factory
+from ..exceptions import NotFound
+from . import staging
+
+HOT = "hot"
+COLD = "cold"
+
+
+class TieredStaging(staging.Staging):
+    """
+    Writes new results to a fast hot tier (e.g. local disk or the basic object store) and migrates them to a cold tier
+    (e.g. S3) once they are 'migrate_after' seconds old, or earlier, oldest first, while the hot tier holds more than
+    'hot_capacity' bytes. Migration is driven by migrate(), which the garbage collector calls every cycle.
+
+    The location of each object is kept in MongoDB. Published URLs point to a resolver ('url', normally the frontend's
+    /api/v1/staged endpoint) which redirects to the tier currently holding the object, so URLs stay valid across a
+    migration. The hot copy of a migrated object is kept for 'hot_grace' seconds, for downloads already redirected
+    to it.
+
+    Configured as, e.g.:
+        tiered:
+          url: https://polytope.example.int/api/v1/staged
+          hot: {local: {root_dir: /data/staging, url: https://polytope.example.int/hot}}
+          cold: {s3: {...}}
+          migrate_after: 600
+          hot_capacity: 500000000000
+    """
+
+    def __init__(self, config):
+        self.hot = staging.create_staging(config["hot"])
+        self.cold = staging.create_staging(config["cold"])
+        self.tiers = {HOT: self.hot, COLD: self.cold}
+        self.url = config.get("url", None)
+        self.migrate_after = config.get("migrate_after", 600)
+        self.hot_capacity = config.get("hot_capacity", None)
+        self.hot_grace = config.get("hot_grace", 300)
+        self.migrate_threads = config.get("migrate_threads", 4)
+
+        db_config = config.get("mongodb", {})
+        uri = db_config.get("uri", "mongodb://localhost:27017")
+        collection = db_config.get("collection", "tiered_staging")
+        self.mongo_client = mongo_client_factory.create_client(
+            uri, db_config.get("username"), db_config.get("password")
+        )
+        self.collection = self.mongo_client.staging[collection]
+        self.stats_collection = self.mongo_client.staging[collection + "_stats"]
+        self.collection.create_index([("tier", pymongo.ASCENDING), ("created", pymongo.ASCENDING)])
+        self.collection.create_index([("hot_name", pymongo.ASCENDING), ("migrated", pymongo.ASCENDING)])
+
+        logging.info("Opened tiered data staging: {} -> {}".format(self.hot.get_type(), self.cold.get_type()))
+
+    def _locate(self, name):
+        doc = self.collection.find_one({"_id": name})
+        if doc is None:
+            raise KeyError(name)
+        tier = doc["tier"]
+        return self.tiers[tier], doc[tier + "_name"], doc
+
+    def create(self, name, data, content_type, content_encoding=None):
+        staged = self.hot.create(name, data, content_type, content_encoding)
+        previous = self.collection.find_one_and_replace(
+            {"_id": name},
+            {
+                "_id": name,
+                "tier": HOT,
+                "hot_name": staged.name,
+                "cold_name": None,
+                "size": staged.size,
+                "content_type": content_type,
+                "content_encoding": content_encoding,
+                "created": time.time(),
+                "migrated": None,
+            },
+            upsert=True,
+        )
+        if previous is not None:
+            self._delete_copies(previous, keep_hot=staged.name)
+        return staging.StagedObject(
+            name, self.get_url(name), staged.size, content_type, staged.checksum, content_encoding
+        )
+
+    def _delete_copies(self, doc, keep_hot=None):
+        for tier in (HOT, COLD):
+            tier_name = doc.get(tier + "_name")
+            if tier_name is None or (tier == HOT and tier_name == keep_hot):
+                continue
+            try:
+                self.tiers[tier].delete(tier_name)
+            except (KeyError, NotFound):
+                pass
+
+    def read(self, name):
+        tier, tier_name, _ = self._locate(name)
+        return tier.read(tier_name)
+
+    def read_stream(self, name, start=None, end=None, chunk_size=1024 * 1024):
+        tier, tier_name, _ = self._locate(name)
+        return tier.read_stream(tier_name, start, end, chunk_size)
+
+    def delete(self, name):
+        doc = self.collection.find_one_and_delete({"_id": name})
+        if doc is None:
+            raise KeyError(name)
+        self._delete_copies(doc)
+        return True
+
+    def query(self, name):
+        return self.collection.count_documents({"_id": name}, limit=1) > 0
+
+    def stat(self, name):
+        _, _, doc = self._locate(name)
+        return doc["content_type"], doc["size"]
+
+    def list(self):
+        for doc in self.collection.find({}, {"size": 1, "created": 1}):
+            yield staging.ResourceInfo(doc["_id"], doc["size"], doc["created"])
+
+    def wipe(self):
+        self.hot.wipe()
+        self.cold.wipe()
+        self.collection.delete_many({})
+
+    def resolve(self, name):
+        """Returns the URL of the tier currently holding name, counting hits per tier"""
+        tier, tier_name, doc = self._locate(name)
+        self.stats_collection.update_one({"_id": "resolved"}, {"$inc": {doc["tier"]: 1}}, upsert=True)
+        return tier.get_url(tier_name)
+
+    def get_url(self, name):
+        if self.url is None:
+            return None
+        return "{}/{}".format(self.url, name)
+
+    def get_internal_url(self, name):
+        tier, tier_name, _ = self._locate(name)
+        return tier.get_internal_url(tier_name)
+
+    def get_url_prefix(self):
+        return ""
+
+    def get_type(self):
+        return "TieredStaging"
+
+    def migrate(self):
+        """
+        Copies hot objects due for migration to the cold tier, then deletes hot copies whose grace period is over.
+        Returns the number of objects migrated.
+        """
+        now = time.time()
+        due = list(self.collection.find({"tier": HOT, "created": {"$lt": now - self.migrate_after}}))
+        due_ids = {doc["_id"] for doc in due}
+
+        if self.hot_capacity is not None:
+            hot = self.collection.find({"tier": HOT}, {"size": 1, "created": 1}).sort("created", pymongo.DESCENDING)
+            total = 0
+            for doc in hot:
+                total += doc["size"]
+                if total > self.hot_capacity and doc["_id"] not in due_ids:
+                    due.append(self.collection.find_one({"_id": doc["_id"]}))
+                    due_ids.add(doc["_id"])
+
+        migrated = 0
+        migrated_bytes = 0
+        start = time.monotonic()
+        if due:
+            with ThreadPoolExecutor(max_workers=self.migrate_threads) as executor:
+                for doc, ok in zip(due, executor.map(self._migrate_one, due)):
+                    if ok:
+                        migrated += 1
+                        migrated_bytes += doc["size"]
+        seconds = time.monotonic() - start
+
+        # Hot copies of migrated objects, once downloads redirected to them have had time to finish
+        for doc in self.collection.find(
+            {"tier": COLD, "hot_name": {"$ne": None}, "migrated": {"$lt": time.time() - self.hot_grace}}
+        ):
+            try:
+                self.hot.delete(doc["hot_name"])
+            except (KeyError, NotFound):
+                pass
+            self.collection.update_one({"_id": doc["_id"], "hot_name": doc["hot_name"]}, {"$set": {"hot_name": None}})
+
+        if migrated:
+            self.stats_collection.update_one(
+                {"_id": "migrated"},
+                {"$inc": {"objects": migrated, "bytes": migrated_bytes, "seconds": seconds}},
+                upsert=True,
+            )
+            logging.info(
+                "Migrated {} objects ({} bytes) to the cold tier in {:.1f}s".format(migrated, migrated_bytes, seconds),
+                extra={"migration": {"objects": migrated, "bytes": migrated_bytes, "seconds": seconds}},
+            )
+        return migrated
+
+    def _migrate_one(self, doc):
+        try:
+            staged = self.cold.create(
+                doc["_id"], self.hot.read_stream(doc["hot_name"]), doc["content_type"], doc.get("content_encoding")
+            )
+        except Exception as e:
+            logging.warning("Could not migrate {} to the cold tier: {}".format(doc["_id"], e))
+            return False
+
+        # Only switch if the object was not replaced or deleted meanwhile
+        result = self.collection.update_one(
+            {"_id": doc["_id"], "tier": HOT, "hot_name": doc["hot_name"], "created": doc["created"]},
+            {"$set": {"tier": COLD, "cold_name": staged.name, "migrated": time.time()}},
+        )
+        if result.matched_count == 0:
+            try:
+                self.cold.delete(staged.name)
+            except (KeyError, NotFound):
+                pass
+            return False
+        return True
+
+    def stats(self):
+        """Tier hit rates of resolved URLs and migration throughput, across all processes"""
+        resolved = self.stats_collection.find_one({"_id": "resolved"}) or {}
+        migrated = self.stats_collection.find_one({"_id": "migrated"}) or {}
+        hits = {tier: resolved.get(tier, 0) for tier in (HOT, COLD)}
+        total = sum(hits.values())
+        seconds = migrated.get("seconds", 0.0)
+        return {
+            "resolved": hits,
+            "hot_hit_rate": hits[HOT] / total if total else None,
+            "migrated_objects": migrated.get("objects", 0),
+            "migrated_bytes": migrated.get("bytes", 0),
+            "migration_throughput": migrated.get("bytes", 0) / seconds if seconds else None,
+            "hot_objects": self.collection.count_documents({"tier": HOT}),
+            "cold_objects": self.collection.count_documents({"tier": COLD}),
+        }
@@ -0,0 +1,126 @@
+#
+# Copyright 2022 European Centre for Medium-Range Weather Forecasts (ECMWF)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+
+import logging
+import time
+from typing import Dict, Iterable, Iterator, Optional
+
+import pymongo
+
+from . import mongo_client_factory
+from .staging import ResourceInfo
+
+
+class StagingLedger:
+    """
+    Persistent record of the objects in staging with their size and age, so that the garbage collector can find what
+    to delete without listing the whole staging store.
+
+    Workers record each object they stage and the garbage collector removes the entries of objects it deletes. A
+    running total of the staged bytes is kept alongside. Objects staged or deleted behind the ledger's back are picked
+    up by reconcile(), which rebuilds it from a full listing of staging and which the garbage collector runs only
+    occasionally.
+    """
+
+    def __init__(self, config):
+        uri = config.get("uri", "mongodb://localhost:27017")
+        collection = config.get("collection", "staging_ledger")
+        username = config.get("username")
+        password = config.get("password")
+        self.mongo_client = mongo_client_factory.create_client(uri, username, password)
+        self.collection = self.mongo_client.staging[collection]
+        self.meta = self.mongo_client.staging[collection + "_meta"]
+        self.collection.create_index([("created", pymongo.ASCENDING)])
+
+    def record(self, name: str, size: int, request_id: str = None, created: float = None) -> None:
+        entry = {"size": size, "request_id": request_id, "created": time.time() if created is None else created}
+        previous = self.collection.find_one_and_replace({"_id": name}, dict(entry, _id=name), upsert=True)
+        delta = size - (previous["size"] if previous is not None else 0)
+        self.meta.update_one({"_id": "total"}, {"$inc": {"size": delta, "count": 0 if previous else 1}}, upsert=True)
+
+    def remove(self, names: Iterable[str]) -> int:
+        """Forgets the given objects, returns the number of bytes they accounted for"""
+        names = list(names)
+        size = 0
+        count = 0
+        for entry in self.collection.find({"_id": {"$in": names}}, {"size": 1}):
+            size += entry["size"]
+            count += 1
+        self.collection.delete_many({"_id": {"$in": names}})
+        if count:
+            self.meta.update_one({"_id": "total"}, {"$inc": {"size": -size, "count": -count}}, upsert=True)
+        return size
+
+    def total(self) -> Dict[str, int]:
+        """Number and total size of the staged objects"""
+        total = self.meta.find_one({"_id": "total"}) or {}
+        return {"size": total.get("size", 0), "count": total.get("count", 0)}
+
+    def older_than(self, cutoff: float) -> Iterator[Dict]:
+        return self.collection.find({"created": {"$lt": cutoff}}).sort("created", pymongo.ASCENDING)
+
+    def oldest(self) -> Iterator[Dict]:
+        return self.collection.find().sort("created", pymongo.ASCENDING)
+
+    def last_reconciled(self) -> Optional[float]:
+        meta = self.meta.find_one({"_id": "reconciled"})
+        return meta["time"] if meta else None
+
+    def reconcile(self, resources: Iterable[ResourceInfo], batch_size: int = 1000) -> None:
+        """
+        Rebuilds the ledger from a full listing of staging. Entries recorded while the listing is in progress are kept.
+        """
+        start = time.time()
+        batch = []
+        for resource in resources:
+            created = resource.last_modified if resource.last_modified is not None else start
+            batch.append(
+                pymongo.UpdateOne(
+                    {"_id": resource.name},
+                    {
+                        "$set": {"size": resource.size, "reconciled": start},
+                        "$setOnInsert": {"request_id": None, "created": created},
+                    },
+                    upsert=True,
+                )
+            )
+            if len(batch) >= batch_size:
+                self.collection.bulk_write(batch, ordered=False)
+                batch = []
+        if batch:
+            self.collection.bulk_write(batch, ordered=False)
+
+        self.collection.delete_many({"reconciled": {"$ne": start}, "created": {"$lt": start}})
+
+        size = 0
+        count = 0
+        for total in self.collection.aggregate(
+            [{"$group": {"_id": None, "size": {"$sum": "$size"}, "n": {"$sum": 1}}}]
+        ):
+            size, count = total["size"], total["n"]
+        self.meta.replace_one({"_id": "total"}, {"_id": "total", "size": size, "count": count}, upsert=True)
+        self.meta.replace_one({"_id": "reconciled"}, {"_id": "reconciled", "time": start}, upsert=True)
+        logging.info("Reconciled staging ledger: {} objects, {} bytes".format(count, size))
+
+
+def create_staging_ledger(config=None) -> Optional[StagingLedger]:
+    if not config:
+        return None
+    return StagingLedger(config)
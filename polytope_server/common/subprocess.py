@@ -18,20 +18,34 @@
 # does it submit to any jurisdiction.
 #
 
+import collections
 import logging
 import os
-import select
 import subprocess
+import threading
 from subprocess import CalledProcessError
 
+from .logging import propagate_context
+
 
 class Subprocess:
-    def __init__(self):
+    """
+    Runs a command, with its stdout and stderr drained by a reader thread each, so that a chatty process never blocks
+    on a full pipe and whoever reads its data never waits on log handling. Lines are logged as they arrive, the last
+    max_lines are kept in a ring buffer, and lines containing err_filter are collected to be reported to the user.
+    """
+
+    def __init__(self, max_lines=1000, max_errors=100):
         self.subprocess = None
+        self.output = collections.deque(maxlen=max_lines)
+        self.errors = collections.deque(maxlen=max_errors)
+        self.err_filter = None
+        self.readers = []
 
-    def run(self, cmd, cwd=None, env=None):
-        env = {**os.environ, **(env or None)}
+    def run(self, cmd, cwd=None, env=None, err_filter=None):
+        env = {**os.environ, **(env or {})}
         logging.info("Calling {} in directory {} with env {}".format(cmd, cwd, env))
+        self.err_filter = err_filter
         self.subprocess = subprocess.Popen(
             cmd,
             env=env,
@@ -40,25 +54,23 @@ class Subprocess:
             stderr=subprocess.PIPE,
             stdout=subprocess.PIPE,
         )
+        self.readers = [
+            threading.Thread(target=propagate_context(self._drain), args=(pipe, level), daemon=True)
+            for pipe, level in ((self.subprocess.stdout, logging.INFO), (self.subprocess.stderr, logging.ERROR))
+        ]
+        for reader in self.readers:
+            reader.start()
 
-    def read_output(self, request, err_filter=None):
-        """Read and log output from the subprocess without blocking"""
-        reads = [i for i in [self.subprocess.stdout, self.subprocess.stderr] if i]
-        ret = select.select(reads, [], [], 0)
-        while ret[0]:
-            for fd in ret[0]:
-                line = fd.readline()
-                if line:
-                    line = line.decode().strip()
-                    if fd == self.subprocess.stdout:
-                        logging.info(line)
-                    elif fd == self.subprocess.stderr:
-                        logging.error(line)
-                    if err_filter and err_filter in line:
-                        request.user_message += line + "\n"
-            if not self.running():
-                break
-            ret = select.select(reads, [], [], 0)
+    def _drain(self, pipe, level):
+        for line in pipe:
+            line = line.decode(errors="replace").strip()
+            self.output.append(line)
+            if self.err_filter and self.err_filter in line:
+                self.errors.append(line)
+                logging.error(line)
+            else:
+                logging.log(level, line)
+        pipe.close()
 
     def running(self):
         return self.subprocess.poll() is None
@@ -66,8 +78,15 @@ class Subprocess:
     def returncode(self):
         return self.subprocess.poll()
 
-    def finalize(self, request, err_filter):
-        """Close subprocess and decode output"""
+    def wait(self, timeout=None):
+        """Waits up to timeout seconds (forever if None) for the subprocess to exit, returns its return code or None"""
+        try:
+            return self.subprocess.wait(timeout)
+        except subprocess.TimeoutExpired:
+            return None
+
+    def finalize(self, request):
+        """Wait for the subprocess to exit and its output to be drained, and report matching lines to the user"""
         logging.info("Finalizing subprocess")
         # fifo has been closed so this process should finish, but sometimes hangs so we set a timeout
         try:
@@ -75,22 +94,14 @@ class Subprocess:
         except subprocess.TimeoutExpired:
             logging.error("Subprocess did not finish in time, killing it")
             self.subprocess.kill()
-            returncode = self.subprocess.returncode
+            returncode = self.subprocess.wait()
         logging.info("Subprocess finished with return code: {}".format(returncode))
-        logging.info("Subprocess stdout:")
-        for line in self.subprocess.stdout:
-            line = line.decode().strip()
-            if err_filter and err_filter in line:
-                request.user_message += line + "\n"
-                logging.error(line)
-            else:
-                logging.info(line)
-        logging.info("Subprocess stderr:")
-        for line in self.subprocess.stderr:
-            line = line.decode().strip()
-            if err_filter and err_filter in line:
-                request.user_message += line + "\n"
-            logging.error(line)
+
+        # The pipes may be held open by a child of the subprocess, so do not wait for them forever
+        for reader in self.readers:
+            reader.join(5)
+        while self.errors:
+            request.user_message += self.errors.popleft() + "\n"
 
         if returncode != 0:
-            raise CalledProcessError(returncode, self.subprocess.args)
+            raise CalledProcessError(returncode, self.subprocess.args, output="\n".join(self.output))
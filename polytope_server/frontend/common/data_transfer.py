@@ -21,10 +21,13 @@
 import hashlib
 import logging
 import sys
+from pathlib import PurePath
+from urllib.parse import urlparse
 
 # TODO: Remove flask from this module, it should be agnostic
 from flask import Request, Response
 
+from ...common.compression import accepts_encoding, decompress
 from ...common.exceptions import BadRequest, NotFound, ServerError
 from ...common.request import PolytopeRequest, Status, Verb
 from ...common.request_store.request_store import RequestStore
@@ -88,10 +91,56 @@ class DataTransfer:
         logging.info("Archive request added to store: {}".format(request.id), extra={"request_id": request.id})
         return RequestAccepted(response)
 
-    def query_request(self, user: User, id: str) -> Response:
+    def query_request(self, user: User, id: str, accept_encoding: str = None) -> Response:
         """
         Gets the status of a request and, if complete, provides download/upload information
         """
+        request = self.get_user_request(user, id)
+
+        if request.status == Status.PROCESSED:
+            if request.verb == Verb.RETRIEVE:
+                return self.process_download(request, accept_encoding)
+            else:
+                assert request.verb == Verb.ARCHIVE
+                response = self.construct_response(request)
+                return RequestSucceeded(response)
+
+        response = self.construct_response(request)
+        return RequestAccepted(response)
+
+    def download(self, user: User, id: str, accept_encoding: str = None) -> Response:
+        """
+        Serves the result of a processed retrieve request from staging, decompressing it for clients which do not
+        accept its content encoding. Other requests get the same response as query_request.
+        """
+        request = self.get_user_request(user, id)
+        if request.status != Status.PROCESSED or request.verb != Verb.RETRIEVE:
+            return self.query_request(user, id, accept_encoding)
+
+        name = request.staged_name
+        if name is None:
+            # Requests processed before the staged name was recorded
+            name = PurePath(urlparse(request.url).path).name if request.url else request.id
+        if not self.staging.query(name):
+            raise NotFound(f"Data for request {id} not found")
+
+        data = self.staging.read_stream(name)
+        headers = {}
+        if request.content_encoding is None:
+            headers["Content-Length"] = str(request.content_length)
+        elif accepts_encoding(accept_encoding, request.content_encoding):
+            headers["Content-Encoding"] = request.content_encoding
+            headers["Content-Length"] = str(request.content_length)
+        else:
+            data = decompress(data, request.content_encoding)
+
+        logging.info("Serving data of request %s through the frontend", id, extra={"request_id": id})
+        return Response(data, mimetype=request.content_type, headers=headers, direct_passthrough=True)
+
+    def get_user_request(self, user: User, id: str) -> PolytopeRequest:
+        """
+        Gets a request owned by user, raising NotFound otherwise, or BadRequest if the request failed
+        """
         request = self.get_request(id)
         if not request:
             raise NotFound(f"Request {id} not found")
@@ -105,17 +154,7 @@ class DataTransfer:
             raise NotFound(f"Request {id} not found")
         if request.status == Status.FAILED:
             raise BadRequest(f"Request failed with error:\n{request.user_message}")
-
-        if request.status == Status.PROCESSED:
-            if request.verb == Verb.RETRIEVE:
-                return self.process_download(request)
-            else:
-                assert request.verb == Verb.ARCHIVE
-                response = self.construct_response(request)
-                return RequestSucceeded(response)
-
-        response = self.construct_response(request)
-        return RequestAccepted(response)
+        return request
 
     def upload(self, id: str, http_request: Request) -> Response:
         """
@@ -135,9 +174,9 @@ class DataTransfer:
             raise BadRequest("Uploaded data checksum does not agree with header X-Checksum")
 
         try:
-            url = self.staging.create(id, [data], "application/octet-stream")
-            request.content_type, request.content_length = self.staging.stat(id)
-            assert url is not None
+            staged = self.staging.create(id, [data], "application/octet-stream")
+            request.content_type, request.content_length = staged.content_type, staged.size
+            assert staged.url is not None
         except Exception:
             logging.exception("Error while attempting to write to data staging")
             raise ServerError("Error writing to data staging")
@@ -152,13 +191,16 @@ class DataTransfer:
         response = self.construct_response(request)
         return RequestAccepted(response)
 
-    def process_download(self, request: PolytopeRequest) -> Response:
+    def process_download(self, request: PolytopeRequest, accept_encoding: str = None) -> Response:
         """
         Processes a completed retrieve request by preparing a redirect response
         to the location where the data can be downloaded.
         """
 
         response = self.construct_response(request)
+        if request.content_encoding is not None and not accepts_encoding(accept_encoding, request.content_encoding):
+            # The client could not decode the staged object, serve it decompressed through the frontend instead
+            response["location"] = "../downloads/{}".format(request.id)
         logging.info(
             "Request succeeded, redirecting to %s",
             response["location"],
@@ -180,6 +222,8 @@ class DataTransfer:
         if request.verb == Verb.RETRIEVE and request.content_length is not None:
             response["contentLength"] = request.content_length
             response["contentType"] = request.content_type
+            if request.content_encoding is not None:
+                response["contentEncoding"] = request.content_encoding
             # No URL provided, serve through frontend
             if request.url is None:
                 location = "../downloads/{}".format(request.id)
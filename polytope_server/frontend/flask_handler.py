@@ -177,7 +177,7 @@ class FlaskHandler(frontend.FrontendHandler):
             user = auth.authenticate(get_auth_header(request))
             with with_baggage_items({"user.username": user.username, "request_id": request_id}) as _:
                 if request.method == "GET":
-                    return data_transfer.query_request(user, request_id)
+                    return data_transfer.query_request(user, request_id, request.headers.get("Accept-Encoding"))
                 elif request.method == "POST":
                     raise NotFound("Unsupported collection type: %s" % request_id)
                 elif request.method == "DELETE":
@@ -195,9 +195,21 @@ class FlaskHandler(frontend.FrontendHandler):
 
         @handler.route("/api/v1/downloads/<path:request_id>", methods=["GET", "HEAD"])
         def downloads(request_id):
-            with with_baggage_items({"request_id": request_id}) as _:
+            user = auth.authenticate(get_auth_header(request))
+            with with_baggage_items({"user.username": user.username, "request_id": request_id}) as _:
                 if request.method == "GET":
-                    return handle_specific_request(request, request_id)
+                    return data_transfer.download(user, request_id, request.headers.get("Accept-Encoding"))
+
+        @handler.route("/api/v1/staged/<name>", methods=["GET", "HEAD"])
+        def staged(name):
+            # Resolves the stable URLs published by tiered staging to the tier currently holding the data
+            try:
+                location = staging.resolve(name)
+            except KeyError:
+                raise NotFound("Data {} not found".format(name))
+            if location is None:
+                raise NotFound("Data {} is not available for download".format(name))
+            return flask.redirect(location, code=307)
 
         @handler.route("/api/v1/uploads/<request_id>", methods=["GET", "POST"])
         def uploads(request_id):
@@ -262,13 +274,13 @@ class FlaskHandler(frontend.FrontendHandler):
 
         return handler
 
-    def run_server(self, handler, server_type, host, port):
+    def run_server(self, handler, server_type, host, port, threads=1):
         if server_type == "flask":
             # flask internal server for non-production environments
             # should only be used for testing and debugging
             handler.run(host=host, port=port, debug=True)
         elif server_type == "gunicorn":
-            options = {"bind": "%s:%s" % (host, port), "workers": 1}
+            options = {"bind": "%s:%s" % (host, port), "workers": 1, "threads": threads}
             GunicornServer(handler, options).run()
         elif server_type == "werkzeug":
             pass
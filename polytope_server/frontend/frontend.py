@@ -50,7 +50,7 @@ class FrontendHandler(ABC):
         pass
 
     @abstractmethod
-    def run_server(self, handler, server_type: str, host: str, port: str):
+    def run_server(self, handler, server_type: str, host: str, port: str, threads: int = 1):
         pass
 
 
@@ -69,6 +69,7 @@ class Frontend:
 
         self.host = frontend_config.get("bind_to", "localhost")
         self.port = frontend_config.get("port", "5000")
+        self.threads = frontend_config.get("threads", 1)
 
     def run(self):
         # create instances of authentication, request_store & staging
@@ -90,4 +91,4 @@ class Frontend:
         )
 
         logging.info("Starting frontend...")
-        handler_class.run_server(handler, self.server_type, self.host, self.port)
+        handler_class.run_server(handler, self.server_type, self.host, self.port, self.threads)
@@ -18,14 +18,19 @@
 # does it submit to any jurisdiction.
 #
 
+import collections
 import logging
 import re
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 
+from ..common.bloom_filter import ScalableBloomFilter
 from ..common.metric_store import create_metric_store
 from ..common.request_store import create_request_store
-from ..common.staging import create_staging
+from ..common.result_cache import create_result_cache
+from ..common.staging import batched, create_staging
+from ..common.staging_ledger import create_staging_ledger
 
 
 class GarbageCollector:
@@ -41,6 +46,12 @@ class GarbageCollector:
         self.threshold = parse_bytes(s_threshold)
         self.age = parse_time(s_age)
         self.metric_age = parse_time(s_metric_age)
+        self.reconcile_interval = parse_time(gc_config.get("reconcile_interval", "24h")).total_seconds()
+        self.delete_batch_size = gc_config.get("delete_batch_size", 1000)
+        self.delete_threads = gc_config.get("delete_threads", 4)
+        # Report dangling data instead of deleting it
+        self.dangling_dry_run = gc_config.get("dangling_dry_run", False)
+        self.bloom_error_rate = gc_config.get("bloom_error_rate", 0.001)
 
         logging.info(
             "Garbage collector initialized:\n Interval: {} ({} secs) \n \
@@ -57,49 +68,251 @@ class GarbageCollector:
         self.request_store = create_request_store(config.get("request_store"), config.get("metric_store"))
         self.staging = create_staging(config.get("staging"))
         self.metric_store = create_metric_store(config.get("metric_store"))
+        self.result_cache = create_result_cache(config.get("result_cache"))
+        # With a ledger, staging is only listed in full when reconciling
+        self.ledger = create_staging_ledger(gc_config.get("ledger"))
+        self.last_sweeps = {}
 
     def run(self):
         while not time.sleep(self.interval):
             self.remove_old_requests()
             self.remove_old_metrics()
-            self.remove_dangling_data()
-            self.remove_by_size()
+            self.evict_cached_results()
+            if self.ledger is None:
+                self.remove_dangling_data()
+                self.remove_by_size()
+            else:
+                self.reconcile_if_due()
+                self.remove_expired_data()
+                self.remove_by_size_from_ledger()
+            self.remove_unreferenced_data()
+            self.migrate_data()
+
+    def pinned(self):
+        """Names of staged objects which result cache entries refer to, kept for the requests served from them."""
+        return self.result_cache.pinned() if self.result_cache is not None else set()
+
+    def sweep_due(self, name):
+        """True if the sweep called name last ran more than reconcile_interval ago, in which case it is due now."""
+        now = time.monotonic()
+        last = self.last_sweeps.get(name)
+        if last is not None and now - last < self.reconcile_interval:
+            return False
+        self.last_sweeps[name] = now
+        return True
 
     def remove_old_requests(self):
-        """Removes requests that are FAILED or PROCESSED after the configured time"""
+        """
+        Removes requests that are FAILED or PROCESSED after the configured time. If the request store expires them
+        itself (with a ttl), this only catches requests which finished before that was enabled, every
+        reconcile_interval.
+        """
+        if self.request_store.ttl is not None and not self.sweep_due("requests"):
+            return
         cutoff = datetime.now(timezone.utc) - self.age
         logging.info("Removing requests older than {}".format(cutoff))
         self.request_store.remove_old_requests(cutoff)
 
     def remove_old_metrics(self):
-        """Removes metrics older than the configured time"""
+        """Removes metrics older than the configured time, every reconcile_interval if the metric store expires them"""
+        if self.metric_store.ttl is not None and not self.sweep_due("metrics"):
+            return
         cutoff = datetime.now(timezone.utc) - self.metric_age
         self.metric_store.remove_old_metrics(cutoff)
 
-    def remove_dangling_data(self):
-        """As a failsafe, removes data which has no corresponding request."""
-        logging.info("Removing dangling data with no corresponding request.")
-        all_objects = self.staging.list()
-        if not all_objects:
+    def evict_cached_results(self):
+        """Retires cached results past their lifetime or beyond the cache size, so their data can be removed."""
+        if self.result_cache is not None:
+            self.result_cache.evict(self.age.total_seconds())
+
+    def live_request_ids(self):
+        """
+        Streams the request ids into a Bloom filter, so that memory stays small however many requests there are.
+        A Bloom filter has no false negatives, so data with a matching request is never deleted, while the rare
+        false positive only keeps dangling data until the next run (each run uses a differently salted filter).
+        """
+        request_ids = ScalableBloomFilter(error_rate=self.bloom_error_rate)
+        for request_id in self.request_store.iter_request_ids():
+            request_ids.add(request_id)
+        logging.info("Read {} request ids into {} bytes.".format(len(request_ids), request_ids.nbytes))
+        return request_ids
+
+    def classify_data(self):
+        """
+        Streams the staging listing, yielding (data, dangling) where dangling is True if data has no corresponding
+        request. The request store is only read if staging is not empty.
+        """
+        request_ids = None
+        pinned = set()
+        started = None
+        for data in self.staging.list():
+            if request_ids is None:
+                started = time.time()
+                request_ids = self.live_request_ids()
+                # Results which are still cached, or may still be downloaded by requests served from the cache
+                pinned = self.pinned()
+
+            if data.name.rsplit(".", 1)[0] in request_ids or data.name in pinned:
+                yield data, False
+            elif data.last_modified is not None and data.last_modified > started - 60:
+                # Written after the request ids were read, its request may be too recent to be in the filter
+                yield data, False
+            else:
+                yield data, True
+
+    def remove_dangling_data(self, dry_run=None):
+        """
+        As a failsafe, removes data which has no corresponding request, in batches as the listing is streamed.
+        With dry_run (by default the dangling_dry_run setting), nothing is deleted. Returns a report of the number
+        and size of dangling objects, with a sample of their names.
+        """
+        dry_run = self.dangling_dry_run if dry_run is None else dry_run
+        logging.info("{} dangling data with no corresponding request.".format("Reporting" if dry_run else "Removing"))
+        report = {"objects": 0, "bytes": 0, "sample": []}
+
+        def dangling_names():
+            for data, dangling in self.classify_data():
+                if dangling:
+                    self._report_dangling(report, data)
+                    yield data.name
+
+        if dry_run:
+            collections.deque(dangling_names(), maxlen=0)
+            logging.info(
+                "Dry run: would delete {} objects ({}) which have no matching request, e.g. {}".format(
+                    report["objects"], format_bytes(report["bytes"]), report["sample"]
+                )
+            )
+        else:
+            self.delete_data(dangling_names())
+            logging.info(
+                "Deleted {} objects ({}) which had no matching request.".format(
+                    report["objects"], format_bytes(report["bytes"])
+                )
+            )
+        return report
+
+    @staticmethod
+    def _report_dangling(report, data):
+        report["objects"] += 1
+        report["bytes"] += data.size or 0
+        if len(report["sample"]) < 10:
+            report["sample"].append(data.name)
+
+    def reconcile_if_due(self):
+        """Removes dangling data and rebuilds the ledger from a full listing of staging, every reconcile_interval."""
+        last = self.ledger.last_reconciled()
+        if last is not None and time.time() - last < self.reconcile_interval:
             return
+        logging.info("Reconciling the staging ledger with a full listing of staging.")
+        report = {"objects": 0, "bytes": 0, "sample": []}
+
+        def live_objects():
+            dangling = []
+            for data, is_dangling in self.classify_data():
+                if not is_dangling:
+                    yield data
+                    continue
+                self._report_dangling(report, data)
+                if self.dangling_dry_run:
+                    # Still in staging, so still accounted for
+                    yield data
+                    continue
+                dangling.append(data.name)
+                if len(dangling) >= self.delete_batch_size:
+                    self.delete_data(dangling)
+                    dangling = []
+            if dangling:
+                self.delete_data(dangling)
+
+        self.ledger.reconcile(live_objects())
+        if report["objects"]:
+            logging.info(
+                "{} {} objects ({}) which have no matching request, e.g. {}".format(
+                    "Dry run: would delete" if self.dangling_dry_run else "Deleted",
+                    report["objects"],
+                    format_bytes(report["bytes"]),
+                    report["sample"],
+                )
+            )
 
-        request_ids = set(self.request_store.get_request_ids())
-
-        for data in all_objects:
-            request_id = data.name.rsplit(".", 1)[0]
+    def remove_expired_data(self):
+        """Removes data older than the configured age, as recorded in the ledger."""
+        cutoff = time.time() - self.age.total_seconds()
+        pinned = self.pinned()
+        names = [entry["_id"] for entry in self.ledger.older_than(cutoff) if entry["_id"] not in pinned]
+        if names:
+            logging.info("Deleting {} objects older than {}.".format(len(names), self.age))
+            self.delete_data(names)
+
+    def remove_by_size_from_ledger(self):
+        """Like remove_by_size, using the sizes and ages recorded in the ledger rather than listing staging."""
+        total_size = self.ledger.total()["size"]
+        logging.info(
+            "Staging holds {}/{} bytes -- {:3.1f}%".format(
+                format_bytes(total_size), format_bytes(self.threshold), total_size / self.threshold * 100
+            )
+        )
+        if total_size < self.threshold:
+            return
 
-            if request_id not in request_ids:
-                logging.info("Deleting {} because it has no matching request.".format(request_id))
-                try:
-                    self.staging.delete(data.name)  # TODO temporary fix for content-disposition error
-                except KeyError:
-                    # TODO: why does this happen?
-                    logging.info("Data {} not found in staging.".format(data.name))
+        pinned = self.pinned()
+        names = []
+        for entry in self.ledger.oldest():
+            if entry["_id"] in pinned:
+                continue
+            names.append(entry["_id"])
+            total_size -= entry["size"]
+            if total_size < self.threshold:
+                break
+        logging.info("Deleting {} oldest objects because the size threshold was reached.".format(len(names)))
+        errors = self.delete_data(names)
+        removed = self.request_store.remove_requests([name.split(".")[0] for name in names if name not in errors])
+        logging.info("Removed {} requests from request store.".format(removed))
+
+    def delete_data(self, names):
+        """
+        Deletes objects from staging in parallel batches, and forgets them in the ledger. names may be a lazy
+        iterable, at most delete_threads batches are held in memory at once.
+        """
+        errors = {}
+        pending = collections.deque()
+
+        def finish(batch, future):
+            failed = future.result()
+            errors.update(failed)
+            if self.ledger is not None:
+                # Objects which could not be deleted stay in the ledger, to be tried again
+                self.ledger.remove([name for name in batch if name not in failed])
+
+        with ThreadPoolExecutor(max_workers=self.delete_threads) as executor:
+            for batch in batched(names, self.delete_batch_size):
+                if len(pending) >= self.delete_threads:
+                    finish(*pending.popleft())
+                pending.append((batch, executor.submit(self.staging.delete_many, batch)))
+            while pending:
+                finish(*pending.popleft())
+        if errors:
+            logging.warning("Could not delete {} objects: {}".format(len(errors), list(errors.items())[:10]))
+        return errors
+
+    def remove_unreferenced_data(self):
+        """
+        Removes data shared between requests (e.g. deduplicated content) once no request refers to it. Leftovers of
+        interrupted writes are only looked for every reconcile_interval, as that lists the whole of staging.
+        """
+        removed = self.staging.collect(incomplete=self.sweep_due("incomplete_writes"))
+        if removed:
+            logging.info("Removed {} unreferenced objects from staging.".format(removed))
+
+    def migrate_data(self):
+        """Moves data between staging tiers, for staging types which have several."""
+        self.staging.migrate()
 
     def remove_by_size(self):
         """Cleans data according to size limits of the staging, removing older requests first."""
 
-        all_objects = self.staging.list()
+        all_objects = list(self.staging.list())
 
         total_size = 0
         for data in all_objects:
@@ -124,8 +337,11 @@ class GarbageCollector:
             d.name: {"size": d.size, "last_modified": d.last_modified}
             for d in sorted(all_objects, key=lambda x: x.last_modified)
         }
+        pinned = self.pinned()
         removed_requests = []
         for name, v in all_objects_by_age.items():
+            if name in pinned:
+                continue
             logging.info("Deleting {} because threshold reached and it is the oldest request.".format(name))
             try:
                 self.staging.delete(name)
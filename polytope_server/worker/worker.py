@@ -38,8 +38,11 @@ from opentelemetry.sdk.trace import TracerProvider
 from ..common import collection
 from ..common import queue as polytope_queue
 from ..common import request_store, staging
+from ..common.compression import CompressionPolicy
 from ..common.logging import propagate_context, with_baggage_items
 from ..common.request import PolytopeRequest, Status
+from ..common.result_cache import create_result_cache
+from ..common.staging_ledger import create_staging_ledger
 
 trace.set_tracer_provider(TracerProvider(resource=Resource.create({"service.name": "worker"})))
 
@@ -80,6 +83,9 @@ class Worker:
 
         self.collections = collection.create_collections(self.config.get("collections"))
         self.staging = staging.create_staging(self.config.get("staging"))
+        self.compression = CompressionPolicy(self.worker_config.get("compression"))
+        self.result_cache = create_result_cache(self.config.get("result_cache"))
+        self.ledger = create_staging_ledger(self.config.get("garbage-collector", {}).get("ledger"))
         self.request_store = request_store.create_request_store(
             self.config.get("request_store"), self.config.get("metric_store")
         )
@@ -119,6 +125,7 @@ class Worker:
                     "requests_failed": self.requests_failed,
                     "total_idle_time": self.total_idle_time,
                     "total_processing_time": self.total_processing_time,
+                    "compression": self.compression.report(),
                 }
             },
         )
@@ -242,23 +249,39 @@ class Worker:
 
         input_data = self.fetch_input_data(request.url)
 
-        # Dispatch to collection
-        datasource = collection.dispatch(request, input_data)
+        # Serve repeated retrievals from the result cache, without running a datasource
+        cache_key = None
+        if self.result_cache is not None and collection.result_cache and input_data is None:
+            ds_config = collection.match(request)
+            cache_key = self.result_cache.key(request.coerced_request, ds_config)
+            if self.serve_cached_result(request, cache_key):
+                return
+            datasource = collection.dispatch(request, input_data, ds_config)
+        else:
+            # Dispatch to collection
+            datasource = collection.dispatch(request, input_data)
+
         # Clean up
         try:
-            # delete input data if it exists in staging (input data can come from external URLs too)
+            # delete input data if it was staged (input data can come from external URLs too)
             if input_data is not None:
-                if self.staging.query(id):
-                    self.staging.delete(id)
+                self.delete_input_data(request)
 
             # upload result data
             if datasource is not None:
-                request.url = self.staging.create(id, datasource.result(request), datasource.mime_type())
-                # Getting key (name + ext) from url
-                url_path = PurePath(urlparse(request.url).path)
-                extension = url_path.suffix
-                # Getting data size in bytes
-                request.content_type, request.content_length = self.staging.stat(f"{id}{extension}")
+                content_type = datasource.mime_type()
+                data = datasource.result(request)
+                content_encoding = self.compression.encoding_for(content_type)
+                if content_encoding is not None:
+                    data = self.compression.compress(data, content_encoding, collection.name)
+                staged = self.staging.create(id, data, content_type, content_encoding)
+                request.url = staged.url
+                request.staged_name = staged.name
+                request.content_type, request.content_length = staged.content_type, staged.size
+                request.content_encoding = staged.content_encoding
+                self.record_staged(staged, id)
+                if cache_key is not None:
+                    self.result_cache.put(cache_key, staged, self.result_cache.lifetime_for(request))
 
         except Exception as e:
             logging.exception("Failed to finalize request", extra={"exception": repr(e)})
@@ -278,6 +301,34 @@ class Worker:
 
         return
 
+    def record_staged(self, staged: staging.StagedObject, request_id: str) -> None:
+        """Records a staged result in the garbage collector's ledger"""
+        if self.ledger is None:
+            return
+        try:
+            self.ledger.record(staged.name, staged.size, request_id)
+        except Exception:
+            # The garbage collector finds it on its next reconciliation
+            logging.exception("Failed to record {} in the staging ledger".format(staged.name))
+
+    def serve_cached_result(self, request: PolytopeRequest, key: str) -> bool:
+        """Completes the request with a cached result if there is one, returns whether it did"""
+        try:
+            entry = self.result_cache.get(key, self.staging)
+        except Exception:
+            logging.exception("Result cache lookup failed, processing request")
+            return False
+        if entry is None:
+            return False
+
+        logging.info("Serving request from cached result {}".format(entry["name"]), extra={"cache_key": key})
+        request.url = self.staging.get_url(entry["name"])
+        request.staged_name = entry["name"]
+        request.content_type, request.content_length = entry["content_type"], entry["size"]
+        request.content_encoding = entry.get("content_encoding")
+        request.user_message += "Success (cached)"
+        return True
+
     def fetch_input_data(self, url: str) -> bytes | None:
         """Downloads input data from external URL or staging"""
         if url != "":
@@ -301,6 +352,16 @@ class Worker:
                 )
         return None
 
+    def delete_input_data(self, request: PolytopeRequest) -> None:
+        """Deletes input data from staging, if the request URL points to an object staged for this request"""
+        name = PurePath(urlparse(request.url).path).name
+        if not name.startswith(request.id):
+            return
+        try:
+            self.staging.delete(name)
+        except Exception:
+            logging.info("Input data {} not found in staging.".format(name))
+
     def on_request_complete(self) -> None:
         """Called when the request processing exits cleanly"""
 
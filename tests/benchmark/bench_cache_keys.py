@@ -0,0 +1,100 @@
+#
+# Copyright 2022 European Centre for Medium-Range Weather Forecasts (ECMWF)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+
+"""
+Microbenchmark of @cache() key derivation and value codecs.
+
+    PYTHONPATH=. python tests/benchmark/bench_cache_keys.py
+"""
+
+import hashlib
+import io
+import timeit
+
+from polytope_server.common.caching import DBPickler, cache_key, codec_map
+from polytope_server.common.user import User
+
+
+class Authenticator:
+    def __init__(self, config):
+        self.config = config
+
+    def cache_id(self):
+        return self.config
+
+
+def legacy_cache_key(name, args, kwargs):
+    hashable_args = (args, tuple(sorted(kwargs.items())))
+    buffer = io.BytesIO()
+    DBPickler(buffer, protocol=-1).dump(hashable_args)
+    return "{0}-{1}".format(name, hashlib.md5(buffer.getvalue()).hexdigest())
+
+
+def main(number=20000):
+    config = {
+        "type": "openid_offline_access",
+        "cert_url": "https://iam.example.int/realms/polytope/protocol/openid-connect/certs",
+        "iam_url": "https://iam.example.int",
+        "iam_realm": "polytope",
+        "public_client_id": "polytope-public",
+        "private_client_id": "polytope-private",
+        "private_client_secret": "x" * 32,
+        "attributes": {"email": "email", "name": "preferred_username"},
+    }
+    authenticator = Authenticator(config)
+    user = User("alice", "ecmwf")
+    user.roles = ["polytope-user", "ecmwf-member"]
+    user.attributes = {"ecmwf-email": "alice@example.int", "ecmwf-apikey": "0123456789abcdef"}
+    token = "eyJhbGciOiJSUzI1NiJ9." + "a" * 600 + "." + "b" * 340
+
+    cases = {
+        "authenticator, token": (authenticator, token),
+        "authenticator, user": (authenticator, user),
+        "config dict": (config,),
+    }
+
+    print("{:<24} {:>14} {:>14} {:>8}".format("key arguments", "legacy (us)", "new (us)", "speedup"))
+    for label, args in cases.items():
+        legacy = timeit.timeit(lambda: legacy_cache_key("f", args, {}), number=number) / number * 1e6
+        new = timeit.timeit(lambda: cache_key("f", args, {}), number=number) / number * 1e6
+        print("{:<24} {:>14.2f} {:>14.2f} {:>7.1f}x".format(label, legacy, new, legacy / new))
+
+    values = {"user": user, "config dict": config, "jwks": {"keys": [config] * 50}}
+    print()
+    print("{:<12} {:<12} {:>10} {:>14} {:>14}".format("codec", "value", "bytes", "encode (us)", "decode (us)"))
+    for codec_name, codec_class in codec_map.items():
+        try:
+            codec = codec_class()
+        except ImportError:
+            print("{:<12} not installed".format(codec_name))
+            continue
+        for label, value in values.items():
+            try:
+                data = codec.encode(value)
+            except TypeError:
+                print("{:<12} {:<12} {:>10}".format(codec_name, label, "n/a"))
+                continue
+            encode = timeit.timeit(lambda: codec.encode(value), number=number) / number * 1e6
+            decode = timeit.timeit(lambda: codec.decode(data), number=number) / number * 1e6
+            print("{:<12} {:<12} {:>10} {:>14.2f} {:>14.2f}".format(codec_name, label, len(data), encode, decode))
+
+
+if __name__ == "__main__":
+    main()
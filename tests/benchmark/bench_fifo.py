@@ -0,0 +1,201 @@
+#
+# Copyright 2022 European Centre for Medium-Range Weather Forecasts (ECMWF)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+
+"""
+Benchmarks of reading MARS-like output through a FIFO, reporting the CPU used by the reading process: with a slow
+writer (CPU spent waiting), with a fast writer (bytes read per CPU-second), and moving the data to a staging file
+through the worker or in the kernel.
+
+    PYTHONPATH=. python tests/benchmark/bench_fifo.py
+"""
+
+import errno
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from polytope_server.common.io.fifo import FIFO
+from polytope_server.common.io.transfer import copy_file
+
+# A writer which is slow to start and then produces data in bursts, as MARS does while retrieving from tape
+SLOW_WRITER = """
+import sys, time
+time.sleep({delay})
+with open(sys.argv[1], "wb") as f:
+    for _ in range({bursts}):
+        f.write(b"x" * {burst_size})
+        f.flush()
+        time.sleep({pause})
+"""
+
+
+# A writer which produces data as fast as the reader takes it
+FAST_WRITER = """
+import os, sys
+chunk = b"x" * (1024 * 1024)
+fd = os.open(sys.argv[1], os.O_WRONLY)
+for _ in range({size_mib}):
+    os.write(fd, chunk)
+os.close(fd)
+"""
+
+
+def legacy_read(fifo):
+    """Reads as FIFO did before it waited on a selector, retrying reads on EAGAIN"""
+    while not fifo.ready():
+        pass
+    size = 0
+    while True:
+        try:
+            buf = os.read(fifo.fifo, 2 * 1024 * 1024)
+        except OSError as err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                continue
+            raise
+        if not buf:
+            return size
+        size += len(buf)
+
+
+def selector_read(fifo):
+    while not fifo.ready(timeout=1):
+        pass
+    return sum(len(x) for x in fifo.data())
+
+
+def legacy_data(fifo, buffer_size=2 * 1024 * 1024):
+    """Chunks the data as FIFO.data did before it read into a bytearray"""
+    while not fifo.ready(timeout=1):
+        pass
+    size = 0
+    buffer = b""
+    while True:
+        data = fifo.read_raw()
+        if data is None:
+            break
+        buffer += data
+        while len(buffer) >= buffer_size:
+            output, buffer = buffer[:buffer_size], buffer[buffer_size:]
+            size += len(output)
+    return size + len(buffer)
+
+
+def arena_data(fifo):
+    while not fifo.ready(timeout=1):
+        pass
+    return sum(len(x) for x in fifo.data())
+
+
+def reused_arena_data(fifo):
+    while not fifo.ready(timeout=1):
+        pass
+    return sum(len(x) for x in fifo.data(reuse=True))
+
+
+def python_to_file(fifo):
+    while not fifo.ready(timeout=1):
+        pass
+    with open(fifo.path + ".out", "wb") as f:
+        for chunk in fifo.data():
+            f.write(chunk)
+    return os.path.getsize(fifo.path + ".out")
+
+
+def splice_to_file(fifo):
+    while not fifo.ready(timeout=1):
+        pass
+    with open(fifo.path + ".out", "wb") as f:
+        return fifo.transfer_to(f.fileno())
+
+
+def copy_file_python(src, dst):
+    with open(src, "rb", buffering=0) as fsrc, open(dst, "wb") as fdst:
+        while chunk := fsrc.read(1024 * 1024):
+            fdst.write(chunk)
+
+
+def copy_file_sendfile(src, dst):
+    with open(src, "rb", buffering=0) as fsrc, open(dst, "wb") as fdst:
+        copy_file(fsrc.fileno(), fdst.fileno())
+
+
+def run(reader, writer, tmp_dir):
+    fifo = FIFO("bench-fifo-{}".format(reader.__name__), tmp_dir)
+    process = subprocess.Popen([sys.executable, "-c", writer, fifo.path])
+    wall, cpu = time.monotonic(), time.process_time()
+    size = reader(fifo)
+    wall, cpu = time.monotonic() - wall, time.process_time() - cpu
+    process.wait()
+    fifo.delete()
+    if os.path.exists(fifo.path + ".out"):
+        os.unlink(fifo.path + ".out")
+    return size, wall, cpu
+
+
+def main():
+    writer = SLOW_WRITER.format(delay=1.0, bursts=20, burst_size=1024 * 1024, pause=0.05)
+    print("{:<18} {:>10} {:>10} {:>10}".format("reader", "MiB", "wall (s)", "CPU (s)"))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for reader in (legacy_read, selector_read):
+            size, wall, cpu = run(reader, writer, tmp_dir)
+            print("{:<18} {:>10.1f} {:>10.2f} {:>10.2f}".format(reader.__name__, size / 1024**2, wall, cpu))
+
+    writer = FAST_WRITER.format(size_mib=1024)
+    print()
+    print("{:<18} {:>10} {:>10} {:>10} {:>14}".format("reader", "MiB", "wall (s)", "CPU (s)", "MiB/CPU-s"))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for reader in (legacy_data, arena_data, reused_arena_data):
+            size, wall, cpu = run(reader, writer, tmp_dir)
+            print(
+                "{:<18} {:>10.1f} {:>10.2f} {:>10.2f} {:>14.0f}".format(
+                    reader.__name__, size / 1024**2, wall, cpu, size / 1024**2 / cpu
+                )
+            )
+
+    print()
+    print("{:<18} {:>10} {:>10} {:>10} {:>14}".format("to staging file", "MiB", "wall (s)", "CPU (s)", "MiB/CPU-s"))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for reader in (python_to_file, splice_to_file):
+            size, wall, cpu = run(reader, writer, tmp_dir)
+            print(
+                "{:<18} {:>10.1f} {:>10.2f} {:>10.2f} {:>14.0f}".format(
+                    reader.__name__, size / 1024**2, wall, cpu, size / 1024**2 / cpu
+                )
+            )
+
+        src = os.path.join(tmp_dir, "mars-output")
+        with open(src, "wb") as f:
+            for _ in range(1024):
+                f.write(b"x" * 1024 * 1024)
+        for copy in (copy_file_python, copy_file_sendfile):
+            wall, cpu = time.monotonic(), time.process_time()
+            copy(src, src + ".out")
+            wall, cpu = time.monotonic() - wall, time.process_time() - cpu
+            print(
+                "{:<18} {:>10.1f} {:>10.2f} {:>10.2f} {:>14.0f}".format(
+                    copy.__name__, 1024, wall, cpu, 1024 / max(cpu, 1e-3)
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
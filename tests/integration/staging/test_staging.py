@@ -41,23 +41,23 @@ class TestStaging:
         pass
 
     def test_staging_upload_download_binary(self):
-        url = self.staging.create("test1", [self.binary_data], "application/octet-stream")
+        url = self.staging.create("test1", [self.binary_data], "application/octet-stream").url
         assert "test1" in url
         result = self.staging.read("test1")
         assert self.binary_data == result
 
     def test_staging_upload_download_string(self):
-        url = self.staging.create("test2", [self.string_data.encode()], "application/octet-stream")
+        url = self.staging.create("test2", [self.string_data.encode()], "application/octet-stream").url
         assert "test2" in url
         result = self.staging.read("test2")
         assert self.string_data == result.decode()
 
     def test_staging_upload_overwrites(self):
-        url = self.staging.create("test3", [self.string_data.encode()], "application/octet-stream")
+        url = self.staging.create("test3", [self.string_data.encode()], "application/octet-stream").url
         assert "test3" in url
         result = self.staging.read("test3")
         assert self.string_data == result.decode()
-        url = self.staging.create("test4", [self.string_data_2.encode()], "application/octet-stream")
+        url = self.staging.create("test4", [self.string_data_2.encode()], "application/octet-stream").url
         assert "test4" in url
         result = self.staging.read("test4")
         assert self.string_data_2 == result.decode()
@@ -124,13 +124,13 @@ class TestStaging:
         self.staging.wipe()
 
     def test_staging_upload_download_1byte(self):
-        url = self.staging.create("test1", [b"1"], "application/octet-stream")
+        url = self.staging.create("test1", [b"1"], "application/octet-stream").url
         assert "test1" in url
         result = self.staging.read("test1")
         assert b"1" == result
 
     def test_staging_upload_download_0byte(self):
-        url = self.staging.create("test1", [b""], "application/octet-stream")
+        url = self.staging.create("test1", [b""], "application/octet-stream").url
         assert "test1" in url
         result = self.staging.read("test1")
         assert b"" == result
@@ -138,7 +138,7 @@ class TestStaging:
     # Testing plain old python requests (used for external access)
 
     def test_staging_upload_get(self):
-        url = self.staging.create("test1", [self.binary_data], "application/octet-stream")
+        url = self.staging.create("test1", [self.binary_data], "application/octet-stream").url
         assert "test1" in url
 
         # Should be able to curl with no credentials
@@ -158,13 +158,13 @@ class TestStaging:
     def test_staging_get_string_data(self):
         data = {"hello": "world"}
         json_data = json.dumps(data)
-        url = self.staging.create("json_data.json", [json_data.encode("utf-8")], "application/octet-stream")
+        url = self.staging.create("json_data.json", [json_data.encode("utf-8")], "application/octet-stream").url
         result = requests.get(url, proxies=proxies)
         assert data == json.loads(result.content.decode("utf-8"))
 
     def test_staging_get_grib_data(self):
         data = b"I am a grib file"
-        url = self.staging.create("data.grib", [data], "application/x-grib")
+        url = self.staging.create("data.grib", [data], "application/x-grib").url
         result = requests.get(url, proxies=proxies)
         assert result.headers["content-type"] == "application/x-grib"
         assert result.content == data
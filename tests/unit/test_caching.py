@@ -0,0 +1,342 @@
+import asyncio
+import threading
+import time
+from unittest import mock
+
+import mongomock
+import pytest
+
+from polytope_server.common.caching import (
+    GlobalVarCaching,
+    LocalLRUCache,
+    MongoDBCaching,
+    cache,
+    cache_key,
+    codec_map,
+)
+from polytope_server.common.user import User
+
+executions = 0
+
+
+@cache(lifetime=120)
+def do_stuff(x=None):
+    global executions
+    executions += 1
+    return {"x": x}
+
+
+@cache(lifetime=120)
+def do_stuff_slow(x=None):
+    global executions
+    executions += 1
+    time.sleep(0.1)
+    return x
+
+
+@cache(lifetime=120)
+def do_stuff_cancel(x=None):
+    global executions
+    executions += 1
+    if x == "cancel":
+        cache.cancel()
+    else:
+        time.sleep(0.05)
+    return x
+
+
+@cache(lifetime=0.05, stale=60)
+def do_stuff_stale(x=None):
+    global executions
+    executions += 1
+    return executions
+
+
+@cache(lifetime=120)
+async def do_stuff_async(x=None):
+    global executions
+    executions += 1
+    await asyncio.sleep(0.05)
+    return x
+
+
+@pytest.fixture
+def two_tier():
+    global executions
+    executions = 0
+    cache.cache = None
+    cache.statistics = {}
+    cache.init({"globalvar": {}, "local": {"enabled": True, "max_entries": 2}})
+    yield
+    cache.cache = None
+    cache.config = None
+    cache.local = None
+
+
+def test_lru_evicts_least_recently_used():
+    evicted = []
+    lru = LocalLRUCache(max_entries=2, on_evict=evicted.append)
+    lru.set("a", b"1", 0, "fa")
+    lru.set("b", b"2", 0, "fb")
+    lru.get("a")
+    lru.set("c", b"3", 0, "fc")
+    assert evicted == ["fb"]
+    assert lru.get("a") == b"1"
+    with pytest.raises(KeyError):
+        lru.get("b")
+
+
+def test_lru_size_accounting():
+    lru = LocalLRUCache(max_bytes=10)
+    lru.set("a", b"12345", 0)
+    lru.set("b", b"12345", 0)
+    assert lru.size == 10
+    lru.set("c", b"123", 0)
+    assert lru.size == 8
+    assert len(lru) == 2
+    lru.set("huge", b"x" * 11, 0)
+    assert len(lru) == 2
+
+
+def test_lru_expiry():
+    lru = LocalLRUCache()
+    lru.set("a", b"1", 0.01)
+    time.sleep(0.02)
+    with pytest.raises(KeyError):
+        lru.get("a")
+    assert lru.size == 0
+
+
+def test_globalvar_honours_lifetime():
+    store = GlobalVarCaching({})
+    store.set("a", b"1", 0.01)
+    assert store.get("a") == b"1"
+    time.sleep(0.02)
+    with pytest.raises(KeyError):
+        store.get("a")
+
+
+def test_two_tier_stats(two_tier):
+    do_stuff(1)
+    do_stuff(1)
+    assert executions == 1
+
+    cache.local.wipe()
+    do_stuff(1)
+    assert executions == 1
+
+    do_stuff(2)
+    do_stuff(3)
+
+    stats = cache.stats()["{}-do_stuff".format(__name__)]
+    assert stats == {"local_hits": 1, "remote_hits": 1, "stale_hits": 0, "misses": 3, "evictions": 1}
+
+
+def test_results_are_not_shared(two_tier):
+    do_stuff(1)["x"] = "modified"
+    assert do_stuff(1) == {"x": 1}
+
+
+def test_invalidation_from_other_replica(two_tier):
+    do_stuff(1)
+    key = next(iter(cache.local._entries))
+    cache._on_invalidation("{} {}".format(cache.origin, key))
+    assert len(cache.local) == 1
+    cache._on_invalidation("other-replica {}".format(key))
+    assert len(cache.local) == 0
+
+
+def test_single_flight(two_tier):
+    threads = [threading.Thread(target=do_stuff_slow, args=(1,)) for _ in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert executions == 1
+
+
+def test_cancel_is_local_to_the_call(two_tier):
+    threads = [threading.Thread(target=do_stuff_cancel, args=(x,)) for x in ("keep", "cancel")]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    do_stuff_cancel("keep")
+    do_stuff_cancel("cancel")
+    assert executions == 3
+
+
+def test_stale_while_revalidate(two_tier):
+    assert do_stuff_stale() == 1
+    time.sleep(0.1)
+    # the stale value is served while a single background call refreshes it
+    assert do_stuff_stale() == 1
+    for _ in range(20):
+        if do_stuff_stale() == 2:
+            break
+        time.sleep(0.01)
+    assert executions == 2
+
+
+def test_async_single_flight(two_tier):
+    async def run():
+        return await asyncio.gather(*[do_stuff_async(1) for _ in range(5)])
+
+    assert asyncio.run(run()) == [1] * 5
+    assert asyncio.run(do_stuff_async(1)) == 1
+    assert executions == 1
+
+
+def test_distributed_lock_waits_for_other_replica(two_tier):
+    cache.distributed_lock = True
+    cache.lock_timeout = 1
+
+    def other_replica_computes(key, timeout):
+        threading.Timer(0.1, lambda: cache.cache.set(key, b"\x80\x04K*.", 0)).start()
+        return False
+
+    try:
+        with mock.patch.object(cache.cache, "acquire_lock", side_effect=other_replica_computes, create=True):
+            assert do_stuff(7) == 42
+        assert executions == 0
+    finally:
+        cache.distributed_lock = False
+
+
+def test_local_copy_expires_with_remote_entry(two_tier):
+    cache.local_lifetime = 60
+    key = cache_key("{}-do_stuff".format(__name__), (5,), {})
+    cache.cache.set(key, b"\x80\x04K*.", 0.05)
+    assert do_stuff(5) == 42
+    time.sleep(0.1)
+    assert do_stuff(5) == {"x": 5}
+    assert executions == 1
+
+
+def test_backend_without_invalidation_or_locks(two_tier):
+    cache.cache = None
+    cache.init({"globalvar": {}, "local": {"enabled": True}, "invalidation": True, "distributed_lock": True})
+    assert cache.invalidation is False
+    assert do_stuff(1) == {"x": 1}
+    cache.distributed_lock = False
+
+
+def test_waiters_take_over_from_failed_lock_holder(two_tier):
+    cache.distributed_lock = True
+    cache.lock_timeout = 30
+    try:
+        # Held by another replica on the first attempt, released without a value on the next poll
+        with mock.patch.object(cache.cache, "acquire_lock", side_effect=[False, "token"], create=True):
+            with mock.patch.object(cache.cache, "release_lock", create=True) as release_lock:
+                start = time.monotonic()
+                assert do_stuff(8) == {"x": 8}
+                assert time.monotonic() - start < 1
+        release_lock.assert_called_once_with(mock.ANY, "token")
+        assert executions == 1
+    finally:
+        cache.distributed_lock = False
+
+
+def test_async_calls_from_several_event_loops(two_tier):
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(asyncio.run(do_stuff_async(3)))) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [3] * 4
+
+
+class WithCacheId:
+    def __init__(self, config):
+        self.config = config
+        self.calls = 0
+
+    def cache_id(self):
+        self.calls += 1
+        return self.config
+
+
+def test_cache_key_distinguishes_types():
+    keys = {cache_key("f", (arg,), {}) for arg in (1, "1", b"1", 1.0, True, None, "None", (1,))}
+    assert len(keys) == 8
+    assert cache_key("f", (), {"a": 1, "b": 2}) == cache_key("f", (), {"b": 2, "a": 1})
+    assert cache_key("f", ("a", "b"), {}) != cache_key("f", ("ab",), {})
+
+
+def test_cache_key_uses_cache_id_once_per_instance():
+    a = WithCacheId({"url": "x"})
+    a2 = WithCacheId({"url": "x"})
+    b = WithCacheId({"url": "y"})
+    assert cache_key("f", (a, "token"), {}) == cache_key("f", (a2, "token"), {})
+    assert cache_key("f", (a, "token"), {}) != cache_key("f", (b, "token"), {})
+    cache_key("f", (a, "other"), {})
+    assert a.calls == 1
+
+
+def test_cache_key_user_argument():
+    user = User("alice", "ecmwf")
+    assert cache_key("f", (user,), {}) == cache_key("f", (User("alice", "ecmwf"),), {})
+    assert cache_key("f", (user,), {}) != cache_key("f", (User("bob", "ecmwf"),), {})
+
+
+@pytest.mark.parametrize("codec", ["pickle", "msgpack", "zstd"])
+def test_codecs(codec):
+    if codec == "msgpack":
+        pytest.importorskip("msgpack")
+    if codec == "zstd":
+        pytest.importorskip("zstandard")
+    c = codec_map[codec]()
+    for value in ({"a": [1, 2, "x"]}, "y" * 10000, None):
+        assert c.decode(c.encode(value)) == value
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        cache(codec="nope")
+
+
+@pytest.fixture
+def mongo_cache():
+    client = mongomock.MongoClient()
+    with mock.patch("polytope_server.common.caching.caching.mongo_client_factory.create_client", return_value=client):
+        store = MongoDBCaching({"stats_flush_interval": 3600, "read_preference": "secondaryPreferred"})
+        yield store
+
+
+def test_mongodb_counts_are_batched(mongo_cache):
+    mongo_cache.set("mod.f-abc", b"1", 0)
+    with mock.patch.object(mongo_cache.collection, "update_one") as update_one:
+        for _ in range(3):
+            mongo_cache.get("mod.f-abc")
+        with pytest.raises(KeyError):
+            mongo_cache.get("mod.g-def")
+        update_one.assert_not_called()
+
+    with mock.patch.object(mongo_cache.collection, "bulk_write", wraps=mongo_cache.collection.bulk_write) as bulk:
+        stats = mongo_cache.stats()
+        bulk.assert_called_once()
+
+    assert stats == {
+        "hits": 3,
+        "misses": 1,
+        "prefixes": {"mod:f": {"hits": 3, "misses": 0}, "mod:g": {"hits": 0, "misses": 1}},
+    }
+
+
+def test_mongodb_wipe_keeps_counts(mongo_cache):
+    mongo_cache.set("mod.f-abc", b"1", 0)
+    mongo_cache.get("mod.f-abc")
+    mongo_cache.wipe()
+    with pytest.raises(KeyError):
+        mongo_cache.get("mod.f-abc")
+    assert mongo_cache.stats()["hits"] == 1
+    assert mongo_cache.stats()["misses"] == 1
+
+
+def test_mongodb_remaining_ttl(mongo_cache):
+    mongo_cache.set("mod.f-abc", b"1", 60)
+    mongo_cache.set("mod.f-def", b"2", 0)
+    data, remaining = mongo_cache.get_with_ttl("mod.f-abc")
+    assert data == b"1" and 0 < remaining <= 60
+    assert mongo_cache.get_with_ttl("mod.f-def") == (b"2", None)
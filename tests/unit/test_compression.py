@@ -0,0 +1,111 @@
+import gzip
+from unittest import mock
+
+import pytest
+
+from polytope_server.common.compression import (
+    CompressionPolicy,
+    accepts_encoding,
+    compress,
+    decompress,
+)
+from polytope_server.common.request import PolytopeRequest, Status
+from polytope_server.common.user import User
+from polytope_server.frontend.common.data_transfer import DataTransfer
+
+DATA = [b'{"type": "Coverage", "values": [' + b"1.5, " * 2000 + b"1.5]}", b"", b"\n"]
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "zstd"])
+def test_roundtrip(encoding):
+    if encoding == "zstd":
+        pytest.importorskip("zstandard")
+    stats = {}
+    compressed = list(compress(iter(DATA), encoding, stats=stats))
+    assert b"".join(decompress(iter(compressed), encoding)) == b"".join(DATA)
+    assert stats["bytes_in"] == sum(len(d) for d in DATA)
+    assert stats["bytes_out"] == sum(len(c) for c in compressed)
+    assert stats["bytes_out"] < stats["bytes_in"] / 5
+    assert stats["cpu_time"] >= 0
+
+
+def test_gzip_is_standard():
+    assert gzip.decompress(b"".join(compress(DATA, "gzip"))) == b"".join(DATA)
+
+
+def test_unknown_encoding():
+    with pytest.raises(ValueError):
+        CompressionPolicy({"types": {"application/json": "brotli"}})
+
+
+@pytest.mark.parametrize(
+    "header, encoding, expected",
+    [
+        (None, "gzip", False),
+        ("gzip, deflate", "gzip", True),
+        ("gzip;q=0, br", "gzip", False),
+        ("br, *", "zstd", True),
+        ("zstd;q=0.5", "zstd", True),
+    ],
+)
+def test_accepts_encoding(header, encoding, expected):
+    assert accepts_encoding(header, encoding) is expected
+
+
+def test_policy_stats_per_collection():
+    policy = CompressionPolicy({"types": {"application/prs.coverage+json": "gzip"}})
+    assert policy.encoding_for("application/prs.coverage+json; charset=utf-8") == "gzip"
+    assert policy.encoding_for("application/x-grib") is None
+
+    for collection in ("a", "a", "b"):
+        b"".join(policy.compress(iter(DATA), "gzip", collection))
+
+    report = policy.report()
+    assert report["a"]["objects"] == 2
+    assert report["a"]["bytes_in"] == 2 * sum(len(d) for d in DATA)
+    assert report["a"]["bytes_saved"] == report["a"]["bytes_in"] - report["a"]["bytes_out"]
+    assert report["b"]["objects"] == 1
+
+
+@pytest.fixture
+def processed_request():
+    user = User("alice", "ecmwf")
+    request = PolytopeRequest(
+        user=user,
+        status=Status.PROCESSED,
+        url="http://staging/data/req.covjson",
+        content_type="application/prs.coverage+json",
+        content_encoding="gzip",
+    )
+    compressed = b"".join(compress(DATA, "gzip"))
+    request.content_length = len(compressed)
+    staging = mock.Mock()
+    staging.read_stream.side_effect = lambda name: iter([compressed[:10], compressed[10:]])
+    request_store = mock.Mock()
+    request_store.get_request.return_value = request
+    return DataTransfer(request_store, staging), user, request
+
+
+def test_redirect_depends_on_accept_encoding(processed_request):
+    data_transfer, user, request = processed_request
+    response = data_transfer.query_request(user, request.id, "gzip, deflate")
+    assert response.headers["Location"] == request.url
+    response = data_transfer.query_request(user, request.id, "identity")
+    assert response.headers["Location"] == "../downloads/{}".format(request.id)
+
+
+def test_download_decompresses(processed_request):
+    data_transfer, user, request = processed_request
+    response = data_transfer.download(user, request.id, None)
+    assert "Content-Encoding" not in response.headers
+    assert b"".join(response.response) == b"".join(DATA)
+    data_transfer.staging.read_stream.assert_called_with("req.covjson")
+
+    # The staged name need not match the URL, e.g. under deduplication
+    request.staged_name = "{}.covjson".format(request.id)
+    data_transfer.download(user, request.id, None)
+    data_transfer.staging.read_stream.assert_called_with(request.staged_name)
+
+    response = data_transfer.download(user, request.id, "gzip")
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(b"".join(response.response)) == b"".join(DATA)
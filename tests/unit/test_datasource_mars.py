@@ -0,0 +1,206 @@
+import os
+import stat
+import sys
+import time
+
+import pytest
+
+from polytope_server.common.datasource.mars import (
+    MARSDataSource,
+    expand_values,
+    split_request,
+)
+from polytope_server.common.request import PolytopeRequest
+from polytope_server.common.user import User
+
+# Stands in for the MARS client: logs like it, then writes the data to the request's target
+FAKE_MARS = """#!{python}
+import re, sys
+request = open(sys.argv[1]).read()
+target = re.search('target="([^"]+)"', request).group(1)
+print("mars - INFO - retrieving")
+print("mars - EROR - something odd", file=sys.stderr)
+sys.stdout.flush()
+with open(target, "wb") as f:
+    for i in range(64):
+        f.write(bytes([i]) * 16384)
+"""
+
+EXPECTED = b"".join(bytes([i]) * 16384 for i in range(64))
+
+# Writes a field per date and step, and fails for the date 20200104
+FAKE_MARS_FIELDS = """#!{python}
+import re, sys
+request = open(sys.argv[1]).read()
+target = re.search('target="([^"]+)"', request).group(1)
+dates = re.search("date=([^,]+)", request).group(1).split("/")
+steps = re.search("step=([^,]+)", request).group(1).split("/")
+if "20200104" in dates:
+    print("mars - EROR - no data for 20200104", file=sys.stderr)
+    sys.exit(1)
+print("mars - EROR - dates " + dates[0], file=sys.stderr)
+with open(target, "wb") as f:
+    for date in dates:
+        for step in steps:
+            f.write((date + "-" + step + ";").encode() * 1000)
+"""
+
+# Never finishes the sub-request for the date 20200104
+FAKE_MARS_HANGING = """#!{python}
+import re, sys, time
+request = open(sys.argv[1]).read()
+target = re.search('target="([^"]+)"', request).group(1)
+open(target, "wb").close()
+if "20200104" in request:
+    time.sleep(600)
+"""
+
+
+def _fake_mars(path, script):
+    path.write_text(script.format(python=sys.executable))
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    return path
+
+
+@pytest.fixture
+def mars(tmp_path):
+    command = _fake_mars(tmp_path / "mars", FAKE_MARS)
+
+    def make(**config):
+        return MARSDataSource(
+            {"type": "mars", "command": str(command), "protocol": "local", "buffer_size": 100000, **config}
+        )
+
+    return make
+
+
+def _request():
+    request = PolytopeRequest(user=User("alice", "ecmwf"))
+    request.coerced_request = {"class": "od", "param": "2t"}
+    return request
+
+
+@pytest.mark.parametrize("use_file_io", [False, True])
+def test_result_chunks(mars, use_file_io):
+    datasource = mars(use_file_io=use_file_io)
+    request = _request()
+    datasource.retrieve(request)
+    chunks = list(datasource.result(request))
+    datasource.destroy(request)
+
+    assert b"".join(chunks) == EXPECTED
+    assert [len(chunk) for chunk in chunks[:-1]] == [100000] * (len(chunks) - 1)
+    assert "mars - EROR - something odd" in request.user_message
+
+
+@pytest.mark.parametrize("use_file_io", [False, True])
+def test_result_transfer_to(mars, tmp_path, use_file_io):
+    datasource = mars(use_file_io=use_file_io)
+    request = _request()
+    datasource.retrieve(request)
+    with open(tmp_path / "out", "wb") as f:
+        assert datasource.result(request).transfer_to(f.fileno()) == len(EXPECTED)
+    datasource.destroy(request)
+
+    assert (tmp_path / "out").read_bytes() == EXPECTED
+    assert not os.path.exists(datasource.request_file)
+
+
+def test_expand_values():
+    assert expand_values("date", "20200130/to/20200203") == ["20200130", "20200131", "20200201", "20200202", "20200203"]
+    assert expand_values("date", "20200101/to/20200105/by/2") == ["20200101", "20200103", "20200105"]
+    assert expand_values("step", "0/to/12/by/6") == ["0", "6", "12"]
+    assert expand_values("param", ["2t", "msl"]) == ["2t", "msl"]
+    assert expand_values("param", "2t/msl") == ["2t", "msl"]
+    assert expand_values("date", "-1/to/-3/by/x") is None
+    assert expand_values("date", "2020-01-01/to/2020-01-02") is None
+
+
+def test_split_request():
+    request = {"class": "od", "date": "20200101/to/20200105", "param": "2t"}
+    assert split_request(request, "date", 2) == [
+        {"class": "od", "date": ["20200101", "20200102", "20200103"], "param": "2t"},
+        {"class": "od", "date": ["20200104", "20200105"], "param": "2t"},
+    ]
+    assert len(split_request(request, "date", 10)) == 5
+    assert split_request(request, "param", 4) == [request]
+    assert split_request(request, "step", 4) == [request]
+    assert split_request(request, None, 4) == [request]
+
+
+def _fields_request(dates):
+    request = PolytopeRequest(user=User("alice", "ecmwf"))
+    request.coerced_request = {"class": "od", "date": dates, "step": ["0", "6", "12"]}
+    return request
+
+
+@pytest.fixture
+def mars_fields(tmp_path):
+    command = _fake_mars(tmp_path / "mars-fields", FAKE_MARS_FIELDS)
+
+    def make(**config):
+        return MARSDataSource(
+            {"type": "mars", "command": str(command), "protocol": "local", "buffer_size": 10000, **config}
+        )
+
+    return make
+
+
+def _retrieve(datasource, request, tmp_path, transfer):
+    datasource.retrieve(request)
+    try:
+        if transfer:
+            with open(tmp_path / "out", "wb") as f:
+                datasource.result(request).transfer_to(f.fileno())
+            return (tmp_path / "out").read_bytes()
+        return b"".join(datasource.result(request))
+    finally:
+        datasource.destroy(request)
+
+
+DATES = ["20200105", "20200106", "20200107", "20200108", "20200109", "20200110"]
+
+
+@pytest.mark.parametrize("transfer", [False, True])
+def test_split_output_unchanged(mars_fields, tmp_path, transfer):
+    expected = _retrieve(mars_fields(), _fields_request(DATES), tmp_path, transfer)
+
+    datasource = mars_fields(split={"axis": "date", "parts": 4, "max_concurrency": 2})
+    request = _fields_request(DATES)
+    assert _retrieve(datasource, request, tmp_path, transfer) == expected
+    # Fields come out date by date, with the steps of each date inside, exactly as from a single retrieval
+    fields = [field for i, field in enumerate(expected.split(b";")[:-1]) if i % 1000 == 0]
+    assert fields == ["{}-{}".format(d, s).encode() for d in DATES for s in ("0", "6", "12")]
+    # Messages of each part are reported in order
+    assert request.user_message.split("\n")[:-1] == ["mars - EROR - dates " + d for d in ("20200105", "20200107")] + [
+        "mars - EROR - dates " + d for d in ("20200109", "20200110")
+    ]
+    assert all(not os.path.exists(output_file) for output_file, _ in datasource.parts)
+
+
+@pytest.mark.parametrize("axis", ["step", "param", "levelist"])
+def test_split_only_along_date(mars_fields, axis):
+    with pytest.raises(ValueError, match="different order"):
+        mars_fields(split={"axis": axis})
+
+
+def test_split_part_failure(mars_fields, tmp_path):
+    datasource = mars_fields(split={"axis": "date", "parts": 3})
+    request = _fields_request(["20200101", "20200102", "20200103", "20200104", "20200105", "20200106"])
+    with pytest.raises(Exception, match="error code 1"):
+        _retrieve(datasource, request, tmp_path, transfer=False)
+    assert "mars - EROR - no data for 20200104" in request.user_message
+    assert all(not os.path.exists(output_file) for output_file, _ in datasource.parts)
+
+
+def test_split_part_timeout(tmp_path):
+    command = _fake_mars(tmp_path / "mars-hanging", FAKE_MARS_HANGING)
+    datasource = MARSDataSource(
+        {"type": "mars", "command": str(command), "protocol": "local", "split": {"axis": "date", "timeout": 1}}
+    )
+    request = _fields_request(["20200101", "20200102", "20200103", "20200104"])
+    start = time.monotonic()
+    with pytest.raises(Exception, match="timed out after 1 seconds"):
+        _retrieve(datasource, request, tmp_path, transfer=False)
+    assert time.monotonic() - start < 30
+    assert all(not process.running() for process in datasource.part_processes)
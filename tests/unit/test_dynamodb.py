@@ -194,3 +194,27 @@ def test_inexact(mocked_aws):
 
     assert r2 is not None
     assert r1.user_request == r2.user_request
+
+
+def test_ttl(mocked_aws):
+    store = dynamodb_request_store.DynamoDBRequestStore({"ttl": 3600})
+    client = store.table.meta.client
+    ttl = client.describe_time_to_live(TableName="requests")["TimeToLiveDescription"]
+    assert ttl == {"TimeToLiveStatus": "ENABLED", "AttributeName": "expire_at"}
+
+    req = request.PolytopeRequest(status=request.Status.PROCESSING, user=user.User("some-user", "some-realm"))
+    store.add_request(req)
+    assert "expire_at" not in store.table.get_item(Key={"id": req.id})["Item"]
+
+    store.set_request_status(req, request.Status.PROCESSED)
+    assert store.table.get_item(Key={"id": req.id})["Item"]["expire_at"] == int(req.last_modified + 3600)
+    assert store.get_request(req.id).status == request.Status.PROCESSED
+
+    # enabling it again is a no-op
+    dynamodb_request_store.DynamoDBRequestStore({"ttl": 3600})
+
+    metric_store = dynamodb_metric_store.DynamoDBMetricStore({"ttl": 60})
+    m = metric.RequestStatusChange(status=request.Status.PROCESSED, request_id=req.id, user_id="u1")
+    metric_store.add_metric(m)
+    assert metric_store.table.get_item(Key={"uuid": m.uuid})["Item"]["expire_at"] == int(m.timestamp + 60)
+    assert metric_store.get_metric(m.uuid).request_id == req.id
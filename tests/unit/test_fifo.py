@@ -18,11 +18,20 @@
 # does it submit to any jurisdiction.
 #
 
+import errno
+import os
+import socket
 import threading
+import time
+import types
+from subprocess import CalledProcessError
+from unittest import mock
 
 import pytest
 
 from polytope_server.common.io.fifo import FIFO
+from polytope_server.common.io.transfer import copy_file
+from polytope_server.common.subprocess import Subprocess
 
 
 class Test:
@@ -96,3 +105,142 @@ class Test:
         assert len(data[0]) == 1 * 1024 * 1024
 
         fifo.delete()
+
+    def test_wait_does_not_spin(self, tmp_path):
+        fifo = FIFO("test-fifo", str(tmp_path))
+        f = open(fifo.path, "wb")
+
+        def write_later():
+            time.sleep(0.3)
+            f.write(b"late")
+            f.close()
+
+        thread = threading.Thread(target=write_later)
+        thread.start()
+        cpu = time.thread_time()
+        assert b"".join(fifo.data()) == b"late"
+        assert time.thread_time() - cpu < 0.1
+        thread.join()
+        fifo.delete()
+
+    def test_read_timeout(self, tmp_path):
+        fifo = FIFO("test-fifo", str(tmp_path))
+        f = open(fifo.path, "wb")
+        with pytest.raises(TimeoutError):
+            fifo.read_raw(timeout=0.05)
+        f.close()
+        fifo.delete()
+
+    def test_subprocess_output_does_not_block_data(self, tmp_path):
+        fifo = FIFO("test-fifo", str(tmp_path))
+        request = types.SimpleNamespace(user_message="")
+        process = Subprocess()
+        # Far more stderr than a pipe holds, which would stall the writer if nobody drained it
+        process.run(
+            [
+                "sh",
+                "-c",
+                "echo 'mars - EROR bad' >&2; yes noise | head -c 1000000 >&2; printf data > {}".format(fifo.path),
+            ],
+            err_filter="EROR",
+        )
+        while not fifo.ready(timeout=1):
+            pass
+        assert b"".join(fifo.data(timeout=5)) == b"data"
+        process.finalize(request)
+        assert request.user_message == "mars - EROR bad\n"
+        assert len(process.output) == 1000
+        fifo.delete()
+
+    def test_subprocess_failure_keeps_output_tail(self):
+        request = types.SimpleNamespace(user_message="")
+        process = Subprocess(max_lines=2)
+        process.run(["sh", "-c", "echo one; echo two; echo three; exit 3"])
+        assert process.wait(5) == 3
+        with pytest.raises(CalledProcessError) as e:
+            process.finalize(request)
+        assert e.value.returncode == 3
+        assert e.value.output == "two\nthree"
+        assert request.user_message == ""
+
+    def test_data_chunks(self, tmp_path):
+        fifo = FIFO("test-fifo", str(tmp_path))
+        with open(fifo.path, "wb") as f:
+            f.write(b"abcdefg")
+        chunks = list(fifo.data(3))
+        assert chunks == [b"abc", b"def", b"g"]
+        assert all(type(chunk) is bytearray for chunk in chunks)
+        fifo.delete()
+
+        fifo = FIFO("test-fifo", str(tmp_path))
+        with open(fifo.path, "wb") as f:
+            f.write(b"abcdefg")
+        chunks = []
+        for chunk in fifo.data(3, reuse=True):
+            assert type(chunk) is memoryview
+            chunks.append((chunk.obj, bytes(chunk)))
+        assert [data for _, data in chunks] == [b"abc", b"def", b"g"]
+        assert len({id(arena) for arena, _ in chunks}) == 1
+        fifo.delete()
+
+    def _write_later(self, fifo, data):
+        def write():
+            with open(fifo.path, "wb") as f:
+                for i in range(0, len(data), 4096):
+                    f.write(data[i : i + 4096])
+                    f.flush()
+
+        thread = threading.Thread(target=write)
+        thread.start()
+        while not fifo.ready(timeout=1):
+            pass
+        return thread
+
+    @pytest.mark.parametrize("splice", [True, False])
+    def test_transfer_to_file(self, tmp_path, splice):
+        data = os.urandom(300000)
+        fifo = FIFO("test-fifo", str(tmp_path))
+        thread = self._write_later(fifo, data)
+        with open(tmp_path / "out", "wb") as f:
+            if splice:
+                assert fifo.transfer_to(f.fileno(), buffer_size=65536) == len(data)
+            else:
+                with mock.patch("os.splice", side_effect=OSError(errno.EINVAL, "Invalid argument")):
+                    assert fifo.transfer_to(f.fileno(), buffer_size=65536) == len(data)
+        thread.join()
+        assert (tmp_path / "out").read_bytes() == data
+        fifo.delete()
+
+    def test_transfer_to_socket(self, tmp_path):
+        data = os.urandom(300000)
+        fifo = FIFO("test-fifo", str(tmp_path))
+        thread = self._write_later(fifo, data)
+        left, right = socket.socketpair()
+        received = bytearray()
+
+        def receive():
+            while chunk := right.recv(65536):
+                received.extend(chunk)
+
+        receiver = threading.Thread(target=receive)
+        receiver.start()
+        assert fifo.transfer_to(left.fileno()) == len(data)
+        left.close()
+        receiver.join()
+        thread.join()
+        assert received == data
+        right.close()
+        fifo.delete()
+
+    def test_copy_file(self, tmp_path):
+        data = os.urandom(300000)
+        (tmp_path / "in").write_bytes(data)
+        for fallback in (False, True):
+            with open(tmp_path / "in", "rb") as src, open(tmp_path / "out", "wb") as dst:
+                src.seek(10)
+                if fallback:
+                    with mock.patch("os.sendfile", side_effect=OSError(errno.ENOSYS, "Not supported")):
+                        assert copy_file(src.fileno(), dst.fileno(), 65536) == len(data) - 10
+                else:
+                    assert copy_file(src.fileno(), dst.fileno(), 65536) == len(data) - 10
+            assert (tmp_path / "out").read_bytes() == data[10:]
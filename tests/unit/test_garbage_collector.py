@@ -1,15 +1,20 @@
 import os
+import time
+from datetime import timedelta
 from unittest import mock
 
 import mongomock
 import pytest
 from moto import mock_aws
 
+from polytope_server.common.bloom_filter import ScalableBloomFilter
 from polytope_server.common.request import PolytopeRequest
 from polytope_server.common.request_store.dynamodb_request_store import (
     DynamoDBRequestStore,
 )
 from polytope_server.common.request_store.mongodb_request_store import MongoRequestStore
+from polytope_server.common.staging.local_staging import LocalStaging
+from polytope_server.common.staging_ledger import StagingLedger
 from polytope_server.garbage_collector.garbage_collector import GarbageCollector
 
 
@@ -34,6 +39,15 @@ class _DummyStaging:
         self.deleted.append(name)
         self.names.remove(name)
 
+    def delete_many(self, names):
+        errors = {}
+        for name in names:
+            try:
+                self.delete(name)
+            except KeyError:
+                errors[name] = "KeyError"
+        return errors
+
 
 class _DummyRequestStore:
     def __init__(self):
@@ -91,12 +105,18 @@ def mocked_aws():
             yield
 
 
-def _run_gc(request_store, staging):
+def _run_gc(request_store, staging, result_cache=None, dry_run=False):
     gc = GarbageCollector.__new__(GarbageCollector)
     gc.request_store = request_store
     gc.staging = staging
-    gc.remove_dangling_data()
-    return staging
+    gc.result_cache = result_cache
+    gc.ledger = None
+    gc.delete_batch_size = 2
+    gc.delete_threads = 2
+    gc.dangling_dry_run = dry_run
+    gc.bloom_error_rate = 0.001
+    gc.report = gc.remove_dangling_data()
+    return gc
 
 
 def test_remove_dangling_data_mongo(mongo_store):
@@ -113,6 +133,16 @@ def test_remove_dangling_data_mongo(mongo_store):
     assert set(staging.names) == {keep_a.id, f"{keep_b.id}.bin"}
 
 
+def test_remove_dangling_data_keeps_cached_results(mongo_store):
+    result_cache = mock.Mock()
+    result_cache.pinned.return_value = {"cached.grib"}
+    staging = _DummyStaging(["cached.grib", "orphan-file"])
+
+    _run_gc(mongo_store, staging, result_cache)
+
+    assert staging.deleted == ["orphan-file"]
+
+
 def test_remove_dangling_data_dynamo(mocked_aws):
     keep_a = PolytopeRequest()
     keep_b = PolytopeRequest()
@@ -128,6 +158,77 @@ def test_remove_dangling_data_dynamo(mocked_aws):
     assert set(staging.names) == {f"{keep_a.id}.txt", keep_b.id}
 
 
+def test_remove_dangling_data_in_batches(mongo_store):
+    keep = PolytopeRequest()
+    mongo_store.add_request(keep)
+    orphans = ["orphan-{}".format(i) for i in range(5)]
+    staging = _BatchStaging([keep.id] + orphans)
+
+    _run_gc(mongo_store, staging)
+
+    assert staging.names == [keep.id]
+    assert sorted(name for batch in staging.batches for name in batch) == orphans
+    assert max(len(batch) for batch in staging.batches) == 2
+
+
+def test_remove_dangling_data_dry_run(mongo_store):
+    staging = _DummyStaging(["orphan.grib", "other"])
+
+    gc = _run_gc(mongo_store, staging, dry_run=True)
+
+    assert staging.deleted == []
+    assert gc.report == {"objects": 2, "bytes": 0, "sample": ["orphan.grib", "other"]}
+
+
+def test_remove_dangling_data_keeps_recent_data(mongo_store):
+    staging = _DummyStaging(["written-during-gc"])
+    data = _DummyData("written-during-gc")
+    data.last_modified = time.time()
+    staging.list = lambda: [data]
+
+    _run_gc(mongo_store, staging)
+
+    assert staging.deleted == []
+
+
+def test_remove_dangling_data_skips_request_store_when_empty():
+    store = mock.Mock()
+    _run_gc(store, _DummyStaging([]))
+    store.iter_request_ids.assert_not_called()
+
+
+def test_bloom_filter():
+    ids = ScalableBloomFilter(initial_capacity=100, error_rate=0.01, salt=b"test")
+    added = ["request-{}".format(i) for i in range(1000)]
+    for request_id in added:
+        ids.add(request_id)
+
+    assert len(ids) == 1000
+    assert len(ids.filters) == 4
+    assert all(request_id in ids for request_id in added)
+    false_positives = sum("other-{}".format(i) in ids for i in range(10000))
+    assert false_positives < 200
+
+
+def test_native_expiry_sweeps_only_when_reconciling():
+    gc = GarbageCollector.__new__(GarbageCollector)
+    gc.age = timedelta(hours=1)
+    gc.metric_age = timedelta(hours=1)
+    gc.reconcile_interval = 3600
+    gc.last_sweeps = {}
+    gc.request_store = _DummyRequestStore()
+    gc.request_store.ttl = 3600
+    gc.metric_store = _DummyMetricStore()
+    gc.metric_store.ttl = None
+
+    for _ in range(3):
+        gc.remove_old_requests()
+        gc.remove_old_metrics()
+
+    assert len(gc.request_store.calls) == 1
+    assert len(gc.metric_store.calls) == 3
+
+
 def test_remove_by_size_deletes_oldest_first():
     class Obj:
         def __init__(self, name, size, last_modified):
@@ -159,9 +260,156 @@ def test_remove_by_size_deletes_oldest_first():
     gc.threshold = 80
     gc.staging = staging
     gc.request_store = store
+    gc.result_cache = None
 
     gc.remove_by_size()
 
     # total was 120 > 80 so deletes oldest (30) then second (50) to drop to 40
     assert staging.deleted == ["delete-oldest", "delete-second"]
     assert store.calls == [("remove_requests", ["delete-oldest", "delete-second"])]
+
+
+@pytest.fixture(scope="function")
+def ledger():
+    with mock.patch("polytope_server.common.mongo_client_factory.create_client", return_value=mongomock.MongoClient()):
+        yield StagingLedger({})
+
+
+class _BatchStaging(_DummyStaging):
+    def __init__(self, names):
+        super().__init__(names)
+        self.batches = []
+        self.listings = 0
+
+    def list(self):
+        self.listings += 1
+        return super().list()
+
+    def delete_many(self, names):
+        self.batches.append(list(names))
+        return super().delete_many(names)
+
+
+def _incremental_gc(ledger, staging, request_store):
+    gc = GarbageCollector.__new__(GarbageCollector)
+    gc.ledger = ledger
+    gc.staging = staging
+    gc.request_store = request_store
+    gc.result_cache = None
+    gc.age = timedelta(hours=1)
+    gc.threshold = 100
+    gc.reconcile_interval = 3600
+    gc.delete_batch_size = 2
+    gc.delete_threads = 2
+    gc.dangling_dry_run = False
+    gc.bloom_error_rate = 0.001
+    return gc
+
+
+def test_ledger_totals(ledger):
+    ledger.record("a", 10, "a")
+    ledger.record("b", 20, "b")
+    ledger.record("a", 15, "a")
+    assert ledger.total() == {"size": 35, "count": 2}
+    assert ledger.remove(["a", "missing"]) == 15
+    assert ledger.total() == {"size": 20, "count": 1}
+
+
+def test_ledger_reconcile(ledger):
+    ledger.record("gone", 10)
+    ledger.record("kept", 10, created=1)
+    resources = [_DummyData("kept"), _DummyData("unrecorded")]
+    resources[1].size = 5
+
+    def listing():
+        yield from resources
+        # recorded while the listing is in progress
+        ledger.record("new", 7)
+
+    ledger.reconcile(listing())
+    assert sorted(e["_id"] for e in ledger.oldest()) == ["kept", "new", "unrecorded"]
+    assert ledger.total() == {"size": 12, "count": 3}
+    assert ledger.last_reconciled() is not None
+
+
+def test_remove_expired_data_in_batches(ledger):
+    now = time.time()
+    for name in ["a", "b", "c", "fresh"]:
+        ledger.record(name, 1, created=now - 7200 if name != "fresh" else now)
+    staging = _BatchStaging(["a", "b", "c", "fresh"])
+    gc = _incremental_gc(ledger, staging, _DummyRequestStore())
+
+    gc.remove_expired_data()
+
+    assert staging.batches == [["a", "b"], ["c"]]
+    assert staging.names == ["fresh"]
+    assert [e["_id"] for e in ledger.oldest()] == ["fresh"]
+    assert staging.listings == 0
+
+
+def test_remove_by_size_from_ledger(ledger):
+    for created, name in enumerate(["oldest", "older", "newest"]):
+        ledger.record(name + ".grib", 40, created=created)
+    staging = _BatchStaging(["oldest.grib", "older.grib", "newest.grib"])
+    store = _DummyRequestStore()
+    gc = _incremental_gc(ledger, staging, store)
+
+    gc.remove_by_size_from_ledger()
+
+    assert staging.deleted == ["oldest.grib"]
+    assert store.calls == [("remove_requests", ["oldest"])]
+    assert ledger.total()["size"] == 80
+    assert staging.listings == 0
+
+
+def test_remove_by_size_keeps_cached_results(ledger):
+    for created, name in enumerate(["cached", "older", "newest"]):
+        ledger.record(name + ".grib", 40, created=created)
+    staging = _BatchStaging(["cached.grib", "older.grib", "newest.grib"])
+    store = _DummyRequestStore()
+    gc = _incremental_gc(ledger, staging, store)
+    gc.result_cache = mock.Mock()
+    gc.result_cache.pinned.return_value = {"cached.grib"}
+
+    gc.remove_by_size_from_ledger()
+
+    assert staging.deleted == ["older.grib"]
+    assert store.calls == [("remove_requests", ["older"])]
+
+
+def test_failed_deletes_stay_in_ledger(ledger):
+    for name in ("a", "b", "c"):
+        ledger.record(name, 10)
+    staging = _BatchStaging(["a", "b", "c"])
+    gc = _incremental_gc(ledger, staging, _DummyRequestStore())
+
+    with mock.patch.object(staging, "delete_many", return_value={"b": "AccessDenied"}):
+        assert gc.delete_data(["a", "b", "c"]) == {"b": "AccessDenied"}
+    assert [e["_id"] for e in ledger.oldest()] == ["b"]
+
+
+def test_missing_objects_count_as_deleted(ledger, tmp_path):
+    local = LocalStaging({"root_dir": str(tmp_path), "url": "http://local"})
+    local.create("a", [b"abc"], "text/plain")
+    for name in ("a", "gone"):
+        ledger.record(name, 3)
+    gc = _incremental_gc(ledger, local, _DummyRequestStore())
+
+    assert gc.delete_data(["a", "gone"]) == {}
+    assert not local.query("a")
+    assert list(ledger.oldest()) == []
+
+
+def test_reconcile_if_due(ledger, mongo_store):
+    keep = PolytopeRequest()
+    mongo_store.add_request(keep)
+    staging = _BatchStaging([keep.id, "orphan"])
+    gc = _incremental_gc(ledger, staging, mongo_store)
+
+    gc.reconcile_if_due()
+    assert staging.listings == 1
+    assert staging.deleted == ["orphan"]
+    assert [e["_id"] for e in ledger.oldest()] == [keep.id]
+
+    gc.reconcile_if_due()
+    assert staging.listings == 1
@@ -0,0 +1,64 @@
+from unittest import mock
+
+import pytest
+from jose import jwt
+from jose.utils import base64url_encode
+
+from polytope_server.common.authentication.jwks import JWKSCache
+
+
+def _jwk(kid, secret):
+    return {"kty": "oct", "kid": kid, "alg": "HS256", "k": base64url_encode(secret).decode()}
+
+
+def _response(status_code=200, keys=None, etag=None):
+    response = mock.Mock()
+    response.status_code = status_code
+    response.headers = {"ETag": etag} if etag else {}
+    response.json.return_value = {"keys": keys or []}
+    return response
+
+
+@pytest.fixture
+def jwks():
+    cache = JWKSCache("https://idp/certs", refresh_interval=3600, min_refresh_interval=0)
+    cache._session = mock.Mock()
+    with mock.patch("polytope_server.common.authentication.jwks.requests.Session", return_value=cache._session):
+        yield cache
+
+
+def test_verify_without_network(jwks):
+    jwks._session.get.return_value = _response(keys=[_jwk("a", b"secret-a")], etag='"v1"')
+    token = jwt.encode({"sub": "user"}, _jwk("a", b"secret-a"), algorithm="HS256", headers={"kid": "a"})
+
+    for _ in range(5):
+        key = jwks.get_key(jwt.get_unverified_header(token)["kid"])
+        assert jwt.decode(token, key, algorithms="HS256")["sub"] == "user"
+
+    assert jwks._session.get.call_count == 1
+
+
+def test_unknown_kid_triggers_refresh(jwks):
+    jwks._session.get.side_effect = [
+        _response(keys=[_jwk("a", b"secret-a")], etag='"v1"'),
+        _response(keys=[_jwk("a", b"secret-a"), _jwk("b", b"secret-b")], etag='"v2"'),
+    ]
+    jwks.get_key("a")
+    assert jwks.get_key("b")["kid"] == "b"
+    assert jwks._session.get.call_args.kwargs["headers"] == {"If-None-Match": '"v1"'}
+
+
+def test_not_modified_keeps_keys(jwks):
+    jwks._session.get.side_effect = [_response(keys=[_jwk("a", b"secret-a")], etag='"v1"'), _response(304)]
+    jwks.get_key("a")
+    jwks.refresh()
+    assert jwks.get_key("a")["kid"] == "a"
+
+
+def test_unknown_kid_refresh_is_rate_limited(jwks):
+    jwks.min_refresh_interval = 3600
+    jwks._session.get.return_value = _response(keys=[_jwk("a", b"secret-a")])
+    for _ in range(3):
+        with pytest.raises(KeyError):
+            jwks.get_key("forged")
+    assert jwks._session.get.call_count == 1
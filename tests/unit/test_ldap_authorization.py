@@ -0,0 +1,99 @@
+import threading
+from unittest import mock
+
+import pytest
+from ldap3 import MOCK_SYNC, Connection, Server
+
+from polytope_server.common.authorization.ldap_authorization import LDAPAuthorization
+from polytope_server.common.user import User
+
+BASE = "OU=Users,DC=ecmwf,DC=int"
+
+
+def _mock_connection():
+    conn = Connection(Server("mock"), client_strategy=MOCK_SYNC)
+    conn.strategy.add_entry(
+        "CN=alice,{}".format(BASE),
+        {
+            "objectClass": "person",
+            "cn": "alice",
+            "memberOf": ["CN=polytope-admin,OU=Roles,DC=ecmwf,DC=int", "CN=other,OU=Groups,DC=ecmwf,DC=int"],
+        },
+    )
+    conn.strategy.add_entry(
+        "CN=bob,{}".format(BASE),
+        {"objectClass": "person", "cn": "bob", "memberOf": ["CN=polytope-user,OU=Roles,DC=ecmwf,DC=int"]},
+    )
+    conn.bind()
+    return conn
+
+
+@pytest.fixture
+def authorization():
+    auth = LDAPAuthorization(
+        "ldap", "ecmwf", {"type": "ldap", "url": "ldap://mock", "search_base": BASE, "filter": "Roles"}
+    )
+    with mock.patch.object(auth.pool, "_connect", side_effect=_mock_connection) as connect:
+        yield auth, connect
+
+
+def test_get_roles(authorization):
+    auth, _ = authorization
+    assert auth.get_roles(User("alice", "ecmwf")) == ["polytope-admin"]
+    assert auth.get_roles(User("unknown", "ecmwf")) == []
+
+
+def test_get_roles_reuses_connection_and_cache(authorization):
+    auth, connect = authorization
+    for _ in range(3):
+        assert auth.get_roles(User("bob", "ecmwf")) == ["polytope-user"]
+    assert auth.get_roles(User("alice", "ecmwf")) == ["polytope-admin"]
+    assert connect.call_count == 1
+
+
+def test_get_roles_batch(authorization):
+    auth, _ = authorization
+    roles = auth.get_roles_batch(["alice", "bob", "carol"])
+    assert roles == {"alice": ["polytope-admin"], "bob": ["polytope-user"], "carol": []}
+
+
+def test_refresh_active_users(authorization):
+    auth, _ = authorization
+    auth.get_roles(User("alice", "ecmwf"))
+    with mock.patch.object(auth, "get_roles_batch") as batch:
+        auth.refresh_active_users()
+        batch.assert_called_once_with(["alice"])
+
+    auth.active_window = -1
+    auth.refresh_active_users()
+    assert auth._roles == {}
+
+
+def test_wrong_realm(authorization):
+    auth, _ = authorization
+    with pytest.raises(ValueError):
+        auth.get_roles(User("alice", "other"))
+
+
+def test_connection_returned_after_other_errors(authorization):
+    auth, connect = authorization
+    auth.get_roles(User("alice", "ecmwf"))
+    with pytest.raises(KeyError):
+        with auth.pool.connection():
+            raise KeyError("caller error")
+    assert auth.pool._idle.qsize() == 1
+    auth.get_roles(User("bob", "ecmwf"))
+    assert connect.call_count == 1
+
+
+def test_connections_in_use_are_capped(authorization):
+    auth, _ = authorization
+    auth.pool.size = 1
+    auth.pool.reset()
+    entered = threading.Event()
+    with auth.pool.connection():
+        thread = threading.Thread(target=lambda: auth.pool.connection().__enter__() and entered.set())
+        thread.start()
+        assert not entered.wait(0.1)
+    assert entered.wait(1)
+    thread.join()
@@ -2,7 +2,9 @@ from unittest.mock import patch
 
 import mongomock
 
+from polytope_server.common.metric import RequestStatusChange
 from polytope_server.common.metric_store.mongodb_metric_store import MongoMetricStore
+from polytope_server.common.request import Status
 
 from .test_metric_store import (
     _test_remove_metrics_by_request_ids,
@@ -38,3 +40,14 @@ def test_remove_metrics_by_request_ids():
         store.store = mock_collection
 
         _test_remove_metrics_by_request_ids(store)
+
+
+def test_ttl():
+    with patch("polytope_server.common.mongo_client_factory.create_client", return_value=mongomock.MongoClient()):
+        store = MongoMetricStore({"ttl": 60})
+
+    m = RequestStatusChange(status=Status.PROCESSED, request_id="req", user_id="u1")
+    store.add_metric(m)
+    assert store.store.find_one({"uuid": m.uuid})["expire_at"] is not None
+    assert store.get_metric(m.uuid).request_id == "req"
+    assert [x.uuid for x in store.get_metrics(request_id="req")] == [m.uuid]
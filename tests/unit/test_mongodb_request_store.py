@@ -1,6 +1,9 @@
+import datetime
+
 import mongomock
 import pytest
 
+from polytope_server.common import request, user
 from polytope_server.common.request_store.mongodb_request_store import MongoRequestStore
 
 from .test_request_store import (
@@ -56,3 +59,27 @@ def test_get_request_ids(mongomock_request_store):
 
 def test_remove_requests(mongomock_request_store):
     _test_remove_requests(mongomock_request_store)
+
+
+def test_ttl_expires_finished_requests(monkeypatch):
+    mock_client = mongomock.MongoClient()
+    monkeypatch.setattr(
+        "polytope_server.common.request_store.mongodb_request_store.mongo_client_factory.create_client",
+        lambda uri, username=None, password=None: mock_client,
+    )
+    store = MongoRequestStore({"collection": "requests", "ttl": 3600})
+    assert any(index.get("expireAfterSeconds") == 0 for index in store.store.index_information().values())
+
+    req = request.PolytopeRequest(status=request.Status.QUEUED, user=user.User("test-user", "test-realm"))
+    store.add_request(req)
+    assert "expire_at" not in store.store.find_one({"id": req.id})
+
+    store.set_request_status(req, request.Status.FAILED)
+    expire_at = store.store.find_one({"id": req.id})["expire_at"]
+    assert abs(expire_at.replace(tzinfo=datetime.timezone.utc).timestamp() - (req.last_modified + 3600)) < 1
+    assert store.get_request(req.id).status == request.Status.FAILED
+    assert [r.id for r in store.get_requests(status=request.Status.FAILED)] == [req.id]
+
+    # retried, so it no longer expires
+    store.set_request_status(req, request.Status.QUEUED)
+    assert "expire_at" not in store.store.find_one({"id": req.id})
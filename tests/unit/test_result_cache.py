@@ -0,0 +1,110 @@
+import time
+from datetime import date, timedelta
+from unittest import mock
+
+import mongomock
+import pytest
+
+from polytope_server.common.request import PolytopeRequest
+from polytope_server.common.result_cache import ResultCache
+from polytope_server.common.staging import StagedObject
+
+DS_CONFIG = {"name": "mars", "type": "mars", "match": {"class": "od"}}
+
+
+@pytest.fixture
+def result_cache():
+    client = mongomock.MongoClient()
+    with mock.patch("polytope_server.common.mongo_client_factory.create_client", return_value=client):
+        yield ResultCache({"lifetime": 100, "lifetime_recent": 10, "max_size": 25})
+
+
+@pytest.fixture
+def staging():
+    staging = mock.Mock()
+    staging.query.return_value = True
+    return staging
+
+
+def _staged(name, size=10):
+    return StagedObject(name, "http://staging/" + name, size, "application/x-grib", content_encoding="gzip")
+
+
+def test_key_is_canonical(result_cache):
+    a = result_cache.key({"class": "od", "param": ["t", "u"]}, DS_CONFIG)
+    b = result_cache.key({"param": ["t", "u"], "class": "od"}, dict(reversed(list(DS_CONFIG.items()))))
+    assert a == b
+    assert a != result_cache.key({"class": "od", "param": ["u", "t"]}, DS_CONFIG)
+    assert a != result_cache.key({"class": "od", "param": ["t", "u"]}, dict(DS_CONFIG, match={"class": "rd"}))
+
+
+@pytest.mark.parametrize(
+    "user_date, coerced_date, lifetime",
+    [
+        ("-1", (date.today() - timedelta(days=1)).strftime("%Y%m%d"), 10),
+        ("20200101/to/20200105", "20200101/to/20200105", 100),
+        ("20200101/0", "20200101", 10),
+        (None, (date.today() - timedelta(days=1)).strftime("%Y%m%d"), 10),
+        (None, None, 100),
+    ],
+)
+def test_lifetime_depends_on_date(result_cache, user_date, coerced_date, lifetime):
+    user_request = {"class": "od"}
+    coerced = {"class": "od"}
+    if user_date is not None:
+        user_request["date"] = user_date
+    if coerced_date is not None:
+        coerced["date"] = coerced_date
+    request = PolytopeRequest(user_request=str(user_request), coerced_request=coerced)
+    assert result_cache.lifetime_for(request) == lifetime
+
+
+def test_hit_and_miss(result_cache, staging):
+    assert result_cache.get("k", staging) is None
+    result_cache.put("k", _staged("req.grib"), 100)
+    entry = result_cache.get("k", staging)
+    assert (entry["name"], entry["size"], entry["content_encoding"]) == ("req.grib", 10, "gzip")
+    assert "url" not in entry
+    assert result_cache.get("k", staging)["hits"] == 1
+
+
+def test_hit_counted_after_data_is_checked(result_cache, staging):
+    result_cache.put("k", _staged("req.grib"), 100)
+    staging.query.side_effect = lambda name: result_cache.collection.find_one({"_id": "k"})["hits"] == 0
+    assert result_cache.get("k", staging) is not None
+
+
+def test_entry_dropped_when_data_is_gone(result_cache, staging):
+    result_cache.put("k", _staged("req.grib"), 100)
+    staging.query.return_value = False
+    assert result_cache.get("k", staging) is None
+    assert result_cache.pinned() == set()
+
+
+def test_expired_entries_stay_pinned(result_cache, staging):
+    result_cache.put("k", _staged("req.grib"), -1)
+    assert result_cache.get("k", staging) is None
+    assert result_cache.evict(retention=3600) == 1
+    assert result_cache.pinned() == {"req.grib"}
+    result_cache.evict(retention=-1)
+    assert result_cache.pinned() == set()
+
+
+def test_evicts_least_recently_used_by_size(result_cache, staging):
+    for name in ("a", "b", "c"):
+        result_cache.put(name, _staged(name), 100)
+        time.sleep(0.01)
+    result_cache.get("a", staging)
+
+    assert result_cache.evict(retention=3600) == 1
+    assert result_cache.get("b", staging) is None
+    assert result_cache.get("a", staging) is not None
+    assert result_cache.get("c", staging) is not None
+    assert result_cache.pinned() == {"a", "b", "c"}
+
+
+def test_replaced_entry_keeps_old_data_pinned(result_cache, staging):
+    result_cache.put("k", _staged("old.grib"), -1)
+    result_cache.put("k", _staged("new.grib"), 100)
+    assert result_cache.get("k", staging)["name"] == "new.grib"
+    assert result_cache.pinned() == {"old.grib", "new.grib"}
@@ -1,9 +1,17 @@
+import errno
+import hashlib
+import http.client
 import os
+import threading
+import time
 from unittest import mock
 
+import mongomock
 import pytest
 from moto import mock_aws
 
+from polytope_server.basic_object_store.basic_object_store import ObjectStoreServer
+from polytope_server.common.compression import compress, decompress
 from polytope_server.common.staging import staging
 
 
@@ -42,16 +50,548 @@ def test_create_with_presigned_url(s3_config):
     data = [b"test data"]
     name = "mydata"
 
-    url = s3_staging.create(name, data, "text/html")
+    url = s3_staging.create(name, data, "text/html").url
     assert "X-Amz-Credential" in url
     assert "http://localhost:8088/test/" + name + ".bin" in url
 
 
+def test_lifecycle_rules(s3_config):
+    s3_config["s3"]["expiration_days"] = 2
+    s3_staging = staging.create_staging(s3_config)
+    rules = s3_staging.s3_client.get_bucket_lifecycle_configuration(Bucket="test")["Rules"]
+    assert rules[0]["Expiration"] == {"Days": 2}
+    assert rules[0]["AbortIncompleteMultipartUpload"] == {"DaysAfterInitiation": 1}
+
+
 def test_create(s3_config):
     s3_config["s3"]["url"] = "http://localhost:8088"
     s3_staging = staging.create_staging(s3_config)
     data = [b"test data"]
     name = "mydata"
 
-    url = s3_staging.create(name, data, "text/html")
+    url = s3_staging.create(name, data, "text/html").url
     assert "http://localhost:8088/test/" + name + ".bin" == url
+
+
+def test_create_multipart(s3_config):
+    s3_config["s3"]["url"] = "http://localhost:8088"
+    s3_config["s3"]["buffer_size"] = 5 * 1024 * 1024
+    s3_staging = staging.create_staging(s3_config)
+    data = [bytes([i]) * 1024 * 1024 for i in range(12)]
+
+    with mock.patch.object(s3_staging, "upload_part", wraps=s3_staging.upload_part) as upload_part:
+        staged = s3_staging.create("multipart", iter(data), "application/x-grib")
+        assert upload_part.call_count == 3
+
+    assert staged.name == "multipart.grib"
+    assert staged.size == 12 * 1024 * 1024
+    assert staged.checksum == hashlib.sha256(b"".join(data)).hexdigest()
+
+    assert s3_staging.read("multipart.grib") == b"".join(data)
+
+
+def test_create_returns_staged_object(s3_config):
+    s3_config["s3"]["url"] = "http://localhost:8088"
+    s3_staging = staging.create_staging(s3_config)
+
+    with mock.patch.object(s3_staging.s3_client, "head_object") as head_object:
+        staged = s3_staging.create("mydata", [b"test ", b"data"], "application/prs.coverage+json")
+        head_object.assert_not_called()
+
+    assert staged.name == "mydata.covjson"
+    assert staged.size == 9
+    assert staged.content_type == "application/prs.coverage+json"
+    assert staged.checksum == hashlib.sha256(b"test data").hexdigest()
+    assert s3_staging.stat(staged.name) == ("application/prs.coverage+json", 9)
+
+
+def test_create_empty(s3_config):
+    s3_staging = staging.create_staging(s3_config)
+    with pytest.raises(ValueError):
+        s3_staging.create("empty", iter([b""]), "text/html")
+
+
+def test_create_aborts_on_data_error(s3_config):
+    s3_config["s3"]["buffer_size"] = 5 * 1024 * 1024
+    s3_staging = staging.create_staging(s3_config)
+
+    def data():
+        yield b"x" * 11 * 1024 * 1024
+        raise RuntimeError("datasource failed")
+
+    with pytest.raises(RuntimeError):
+        s3_staging.create("failed", data(), "text/html")
+    assert s3_staging.s3_client.list_multipart_uploads(Bucket="test").get("Uploads", []) == []
+
+
+def test_upload_parts_bounded_window(s3_config):
+    s3_config["s3"]["max_threads"] = 2
+    s3_staging = staging.create_staging(s3_config)
+    in_flight = []
+    peak = [0]
+    lock = threading.Lock()
+
+    def upload_part(name, part_number, data, upload_id):
+        with lock:
+            in_flight.append(part_number)
+            peak[0] = max(peak[0], len(in_flight))
+        time.sleep(0.01)
+        with lock:
+            in_flight.remove(part_number)
+        return {"PartNumber": part_number, "ETag": "x"}
+
+    with mock.patch.object(s3_staging, "upload_part", side_effect=upload_part):
+        result = s3_staging.upload_parts("name", (b"x" for _ in range(10)), "upload-id")
+    assert [p["PartNumber"] for p in result] == list(range(1, 11))
+    assert peak[0] <= 2
+
+
+def test_iterator_buffer(s3_config):
+    s3_staging = staging.create_staging(s3_config)
+    s3_staging.PART_SIZE_DOUBLING = 2
+    data = [b"abc", b"defgh", b"", b"ijklmnopqrstuvwxyz"]
+    parts = [bytes(p) for p in s3_staging.iterator_buffer(iter(data), 2)]
+    assert b"".join(parts) == b"".join(data)
+    assert [len(p) for p in parts] == [2, 2, 4, 4, 8, 6]
+
+
+def test_iterator_buffer_passes_owned_chunks_through(s3_config):
+    s3_staging = staging.create_staging(s3_config)
+    owned = bytearray(b"0123")
+    shared = memoryview(bytearray(b"4567"))
+    parts = list(s3_staging.iterator_buffer(iter([owned, shared, b"89"]), 4))
+    assert parts[0] is owned
+    assert parts[1] is not shared.obj
+    assert b"".join(parts) == b"0123456789"
+
+
+@pytest.mark.parametrize("shards", [1, 3, 16])
+def test_list_paginated(s3_config, shards):
+    s3_config["s3"]["list_shards"] = shards
+    s3_staging = staging.create_staging(s3_config)
+    s3_staging.LIST_PAGE_SIZE = 4
+    names = {"{:x}-{}.bin".format(i % 16, i) for i in range(30)} | {"0", "8", "zzz", "-x"}
+    for name in names:
+        s3_staging.s3_client.put_object(Bucket="test", Key=name, Body=b"abc")
+
+    listed = [r.name for r in s3_staging.list()]
+    assert sorted(listed) == sorted(names)
+    assert all(r.size == 3 for r in s3_staging.list())
+
+
+def test_wipe_batched(s3_config):
+    s3_staging = staging.create_staging(s3_config)
+    s3_staging.DELETE_BATCH_SIZE = 7
+    for i in range(20):
+        s3_staging.s3_client.put_object(Bucket="test", Key="obj-{}".format(i), Body=b"abc")
+
+    with mock.patch.object(s3_staging.s3_client, "delete_objects", wraps=s3_staging.s3_client.delete_objects) as d:
+        s3_staging.wipe()
+        assert d.call_count == 3
+    assert list(s3_staging.list()) == []
+
+
+def test_delete_many_reports_errors(s3_config):
+    s3_staging = staging.create_staging(s3_config)
+    response = {"Errors": [{"Key": "b", "Code": "AccessDenied", "Message": "denied"}]}
+    with mock.patch.object(s3_staging.s3_client, "delete_objects", return_value=response):
+        assert s3_staging.delete_many(["a", "b"]) == {"b": "AccessDenied: denied"}
+
+
+@pytest.fixture(scope="function")
+def polytope_config(tmp_path):
+    server = ObjectStoreServer(("127.0.0.1", 0), str(tmp_path))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield {
+        "polytope": {
+            "host": "127.0.0.1",
+            "port": server.server_address[1],
+            "url": "http://polytope/data",
+            "root_dir": str(tmp_path),
+        }
+    }
+    server.shutdown()
+    server.server_close()
+
+
+def test_polytope_create_streams_chunks(polytope_config):
+    polytope_staging = staging.create_staging(polytope_config)
+
+    def data():
+        for i in range(5):
+            yield bytes([i]) * 1000
+            yield b""
+
+    with mock.patch.object(polytope_staging.session, "put", wraps=polytope_staging.session.put) as put:
+        staged = polytope_staging.create("streamed", data(), "application/octet-stream")
+        # the body is handed over as an iterator, not assembled up front
+        assert not isinstance(put.call_args.kwargs["data"], (bytes, bytearray))
+
+    expected = b"".join(bytes([i]) * 1000 for i in range(5))
+    assert staged.size == len(expected)
+    assert staged.checksum == hashlib.sha256(expected).hexdigest()
+    assert polytope_staging.read("streamed") == expected
+
+
+def test_polytope_read_range(polytope_config):
+    polytope_staging = staging.create_staging(polytope_config)
+    polytope_staging.create("ranged", [b"0123456789"], "text/plain")
+    assert b"".join(polytope_staging.read_stream("ranged", 2, 5)) == b"2345"
+    assert b"".join(polytope_staging.read_stream("ranged", start=7)) == b"789"
+    assert b"".join(polytope_staging.read_stream("ranged", chunk_size=3)) == b"0123456789"
+
+
+def test_polytope_metadata_and_listing(polytope_config):
+    polytope_staging = staging.create_staging(polytope_config)
+    before = time.time()
+    polytope_staging.create("a", [b"abc"], "application/x-grib")
+    polytope_staging.create("b", [b"defgh"], "application/json")
+
+    assert polytope_staging.stat("a") == ("application/x-grib", 3)
+    resources = {r.name: r for r in polytope_staging.list()}
+    assert set(resources) == {"a", "b"}
+    assert resources["b"].size == 5
+    assert resources["b"].last_modified >= before - 1
+    assert not any(f.endswith(".meta") for f in os.listdir(polytope_config["polytope"]["root_dir"]))
+
+    polytope_staging.delete("a")
+    assert not polytope_staging.query("a")
+    assert [r.name for r in polytope_staging.list()] == ["b"]
+    with pytest.raises(KeyError):
+        polytope_staging.delete("a")
+    assert polytope_staging.delete_many(["a", "b"]) == {}
+
+
+def test_polytope_compressed_round_trip(polytope_config):
+    polytope_staging = staging.create_staging(polytope_config)
+    data = [b"0123456789" * 8000]
+    compressed = b"".join(compress(data, "gzip"))
+    polytope_staging.create("c", [compressed], "application/json", "gzip")
+
+    assert b"".join(polytope_staging.read_stream("c")) == compressed
+    assert b"".join(decompress(polytope_staging.read_stream("c"), "gzip")) == b"".join(data)
+
+
+def test_polytope_keep_alive(polytope_config):
+    polytope_staging = staging.create_staging(polytope_config)
+    polytope_staging.create("a", [b"abc"], "text/plain")
+
+    conn = http.client.HTTPConnection("127.0.0.1", polytope_config["polytope"]["port"])
+    sock = None
+    for method, headers, expected in (
+        ("GET", {}, b"abc"),
+        ("HEAD", {}, b""),
+        ("GET", {"Range": "bytes=1-"}, b"bc"),
+        ("GET", {"Range": "bytes=0-0"}, b"a"),
+    ):
+        conn.request(method, "/a", headers=headers)
+        assert conn.getresponse().read() == expected
+        sock = sock or conn.sock
+        assert conn.sock is sock
+    conn.close()
+
+
+def test_object_index_migrates_meta_sidecars(tmp_path):
+    (tmp_path / "legacy").write_bytes(b"1234")
+    (tmp_path / "legacy.meta").write_text("application/x-netcdf")
+    server = ObjectStoreServer(("127.0.0.1", 0), str(tmp_path))
+    try:
+        info = server.index.get("legacy")
+        assert (info.size, info.content_type) == (4, "application/x-netcdf")
+        assert [name for name, _ in server.index.items()] == ["legacy"]
+    finally:
+        server.server_close()
+
+
+def test_object_store_without_xattrs(tmp_path):
+    no_xattrs = OSError(errno.ENOTSUP, "Operation not supported")
+    with mock.patch("os.setxattr", side_effect=no_xattrs), mock.patch("os.getxattr", side_effect=no_xattrs):
+        server = ObjectStoreServer(("127.0.0.1", 0), str(tmp_path))
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        port = server.server_address[1]
+        try:
+            polytope_staging = staging.create_staging({"polytope": {"host": "127.0.0.1", "port": port}})
+            polytope_staging.create("a", [b"abc"], "application/x-grib", "gzip")
+            polytope_staging.rename("a", "b")
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        # Metadata survives a restart through the sidecar file
+        server = ObjectStoreServer(("127.0.0.1", 0), str(tmp_path))
+        try:
+            info = server.index.get("b")
+            assert (info.content_type, info.content_encoding) == ("application/x-grib", "gzip")
+            assert sorted(os.listdir(tmp_path)) == ["b", "b.meta"]
+        finally:
+            server.server_close()
+
+
+@pytest.fixture(scope="function")
+def local_config(tmp_path):
+    return {"local": {"root_dir": str(tmp_path), "url": "http://polytope/data", "preallocate": 4096}}
+
+
+def test_local_create(local_config):
+    local_staging = staging.create_staging(local_config)
+    data = [b"a" * 5000, b"", memoryview(b"b" * 100)]
+    staged = local_staging.create("result", data, "application/x-grib")
+
+    expected = b"a" * 5000 + b"b" * 100
+    assert staged.url == "http://polytope/data/result"
+    assert staged.size == len(expected)
+    assert staged.checksum == hashlib.sha256(expected).hexdigest()
+    # preallocated space beyond the data is released
+    assert os.path.getsize(os.path.join(local_config["local"]["root_dir"], "result")) == len(expected)
+    assert local_staging.read("result") == expected
+    assert b"".join(local_staging.read_stream("result", 4999, 5001, chunk_size=2)) == b"abb"
+    assert local_staging.stat("result")[1] == len(expected)
+
+    resources = list(local_staging.list())
+    assert [(r.name, r.size) for r in resources] == [("result", len(expected))]
+    assert resources[0].last_modified is not None
+
+    assert local_staging.delete("result")
+    with pytest.raises(KeyError):
+        local_staging.delete("result")
+    assert not local_staging.query("result")
+
+
+class _TransferableResult:
+    def __init__(self, data):
+        self.data = data
+        self.transferred = False
+
+    def __iter__(self):
+        return iter([self.data])
+
+    def transfer_to(self, fd):
+        self.transferred = True
+        return os.write(fd, self.data)
+
+
+@pytest.mark.parametrize("splice", [True, False])
+def test_local_create_transfers_in_kernel(local_config, splice):
+    local_config["local"]["splice"] = splice
+    local_staging = staging.create_staging(local_config)
+    result = _TransferableResult(b"grib" * 1000)
+    staged = local_staging.create("result", result, "application/x-grib")
+
+    assert result.transferred == splice
+    assert staged.size == 4000
+    assert (staged.checksum is None) == splice
+    assert local_staging.read("result") == b"grib" * 1000
+
+
+def test_local_create_is_atomic(local_config):
+    local_staging = staging.create_staging(local_config)
+    local_staging.create("result", [b"old"], "text/plain")
+
+    def failing():
+        yield b"new"
+        raise RuntimeError("datasource failed")
+
+    with pytest.raises(RuntimeError):
+        local_staging.create("result", failing(), "text/plain")
+    assert local_staging.read("result") == b"old"
+    assert os.listdir(local_config["local"]["root_dir"]) == ["result"]
+
+
+def test_local_served_by_object_store(local_config):
+    local_staging = staging.create_staging(local_config)
+    local_staging.create("result", [b"0123456789"], "application/json")
+
+    server = ObjectStoreServer(("127.0.0.1", 0), local_config["local"]["root_dir"])
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        local_staging.create("late", [b"abc"], "text/plain")
+        conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1])
+        conn.request("GET", "/late", headers={"Range": "bytes=1-"})
+        response = conn.getresponse()
+        assert response.read() == b"bc"
+        conn.request("GET", "/result")
+        response = conn.getresponse()
+        assert response.read() == b"0123456789"
+        if local_staging.stat("result")[0] == "application/json":
+            assert response.getheader("Content-Type") == "application/json"
+        conn.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture(scope="function")
+def dedup_config(tmp_path):
+    client = mongomock.MongoClient()
+    with mock.patch("polytope_server.common.mongo_client_factory.create_client", return_value=client):
+        yield {"local": {"root_dir": str(tmp_path), "url": "http://polytope/data", "deduplicate": {"grace_period": 0}}}
+
+
+def test_dedup_stores_content_once(dedup_config):
+    dedup_staging = staging.create_staging(dedup_config)
+    root_dir = dedup_config["local"]["root_dir"]
+
+    a = dedup_staging.create("req-a", [b"grib", b"data"], "application/x-grib")
+    b = dedup_staging.create("req-b", [b"gribdata"], "application/x-grib")
+    c = dedup_staging.create("req-c", [b"other"], "application/x-grib")
+
+    assert a.url == b.url != c.url
+    assert a.checksum == hashlib.sha256(b"gribdata").hexdigest()
+    assert len(os.listdir(root_dir)) == 2
+    assert dedup_staging.read("req-b") == b"gribdata"
+    assert dedup_staging.stat("req-a") == ("application/x-grib", 8)
+    assert sorted((r.name, r.size) for r in dedup_staging.list()) == [("req-a", 4), ("req-b", 4), ("req-c", 5)]
+
+    dedup_staging.delete("req-a")
+    assert dedup_staging.collect() == 0
+    assert dedup_staging.read("req-b") == b"gribdata"
+
+    dedup_staging.delete_many(["req-b", "req-c"])
+    assert not dedup_staging.query("req-b")
+    assert dedup_staging.collect() == 2
+    assert os.listdir(root_dir) == []
+
+    # content staged again after being collected gets a fresh key
+    d = dedup_staging.create("req-d", [b"gribdata"], "application/x-grib")
+    assert d.url != a.url
+    assert dedup_staging.read("req-d") == b"gribdata"
+
+
+def test_dedup_query_and_incomplete_uploads(dedup_config):
+    dedup_staging = staging.create_staging(dedup_config)
+    root_dir = dedup_config["local"]["root_dir"]
+    staged = dedup_staging.create("req", [b"data"], "text/plain")
+    assert "key_1" in dedup_staging.collection.index_information()
+    # Downloads look objects up by the last part of their URL, which is the content key
+    assert dedup_staging.query(staged.url.rsplit("/", 1)[-1])
+    assert dedup_staging.query("req")
+    assert not dedup_staging.query("missing")
+
+    dedup_staging.inner.create("incoming-interrupted", [b"partial"], "text/plain")
+    time.sleep(0.01)
+    assert dedup_staging.collect() == 0
+    assert "incoming-interrupted" in os.listdir(root_dir)
+    assert dedup_staging.collect(incomplete=True) == 1
+    assert "incoming-interrupted" not in os.listdir(root_dir)
+
+
+def test_dedup_reference_is_replaced(dedup_config):
+    dedup_staging = staging.create_staging(dedup_config)
+    dedup_staging.create("req", [b"first"], "text/plain")
+    dedup_staging.create("req", [b"second"], "text/plain")
+    assert dedup_staging.read("req") == b"second"
+    with pytest.raises(KeyError):
+        dedup_staging.delete("missing")
+
+
+def test_s3_rename(s3_config):
+    s3_staging = staging.create_staging(s3_config)
+    staged = s3_staging.create("src", [b"abc"], "text/plain")
+    s3_staging.rename(staged.name, "dst")
+    assert not s3_staging.query(staged.name)
+    assert s3_staging.read("dst") == b"abc"
+
+
+def test_polytope_content_encoding(polytope_config):
+    polytope_staging = staging.create_staging(polytope_config)
+    staged = polytope_staging.create("encoded", [b"compressed"], "application/json", "gzip")
+    assert staged.content_encoding == "gzip"
+
+    conn = http.client.HTTPConnection("127.0.0.1", polytope_config["polytope"]["port"])
+    conn.request("GET", "/encoded")
+    response = conn.getresponse()
+    assert response.read() == b"compressed"
+    assert response.getheader("Content-Encoding") == "gzip"
+
+    polytope_staging.rename("encoded", "moved")
+    conn.request("GET", "/moved")
+    response = conn.getresponse()
+    assert response.read() == b"compressed"
+    assert response.getheader("Content-Encoding") == "gzip"
+    assert response.getheader("Content-Type") == "application/json"
+    assert not polytope_staging.query("encoded")
+    conn.close()
+
+
+@pytest.fixture(scope="function")
+def tiered_config(tmp_path):
+    client = mongomock.MongoClient()
+    with mock.patch("polytope_server.common.mongo_client_factory.create_client", return_value=client):
+        yield {
+            "tiered": {
+                "url": "http://polytope/api/v1/staged",
+                "hot": {"local": {"root_dir": str(tmp_path / "hot"), "url": "http://hot"}},
+                "cold": {"local": {"root_dir": str(tmp_path / "cold"), "url": "http://cold"}},
+                "migrate_after": 3600,
+                "hot_grace": 0,
+            }
+        }
+
+
+def test_tiered_migration_keeps_urls(tiered_config):
+    tiered_staging = staging.create_staging(tiered_config)
+    staged = tiered_staging.create("req", [b"abc"], "text/plain", "gzip")
+    assert staged.url == "http://polytope/api/v1/staged/req"
+    assert tiered_staging.resolve("req") == "http://hot/req"
+    assert tiered_staging.migrate() == 0
+
+    tiered_staging.migrate_after = 0
+    assert tiered_staging.migrate() == 1
+    assert tiered_staging.resolve("req") == "http://cold/req"
+    assert tiered_staging.read("req") == b"abc"
+    assert tiered_staging.stat("req") == ("text/plain", 3)
+    # the hot copy went once its grace period was over
+    assert not tiered_staging.hot.query("req")
+    assert [r.name for r in tiered_staging.list()] == ["req"]
+
+    stats = tiered_staging.stats()
+    assert stats["resolved"] == {"hot": 1, "cold": 1}
+    assert stats["hot_hit_rate"] == 0.5
+    assert (stats["migrated_objects"], stats["migrated_bytes"]) == (1, 3)
+
+    tiered_staging.delete("req")
+    assert not tiered_staging.cold.query("req")
+    with pytest.raises(KeyError):
+        tiered_staging.resolve("req")
+
+
+def test_tiered_migrates_oldest_over_capacity(tiered_config):
+    tiered_config["tiered"]["hot_capacity"] = 10
+    tiered_staging = staging.create_staging(tiered_config)
+    for name in ("old", "mid", "new"):
+        tiered_staging.create(name, [b"x" * 5], "text/plain")
+        time.sleep(0.01)
+
+    assert tiered_staging.migrate() == 1
+    assert tiered_staging.resolve("old") == "http://cold/old"
+    assert tiered_staging.resolve("new") == "http://hot/new"
+
+
+def test_tiered_migration_skips_replaced_objects(tiered_config):
+    tiered_staging = staging.create_staging(tiered_config)
+    tiered_staging.create("req", [b"old"], "text/plain")
+    doc = tiered_staging.collection.find_one({"_id": "req"})
+    tiered_staging.create("req", [b"new"], "text/plain")
+
+    assert not tiered_staging._migrate_one(doc)
+    assert tiered_staging.read("req") == b"new"
+    assert not tiered_staging.cold.query("req")
+
+
+def test_tiered_migrates_compressed_objects(tiered_config, polytope_config):
+    tiered_config["tiered"]["hot"] = polytope_config
+    tiered_staging = staging.create_staging(tiered_config)
+    data = [b"0123456789" * 8000]
+    compressed = b"".join(compress(data, "gzip"))
+    tiered_staging.create("req", [compressed], "application/json", "gzip")
+
+    tiered_staging.migrate_after = 0
+    assert tiered_staging.migrate() == 1
+    assert tiered_staging.resolve("req") == "http://cold/req"
+    # the cold tier holds the stored bytes, not a copy decoded on the way
+    assert tiered_staging.cold.read("req") == compressed
+    assert tiered_staging.collection.find_one({"_id": "req"})["content_encoding"] == "gzip"
+    assert b"".join(decompress(tiered_staging.read_stream("req"), "gzip")) == b"".join(data)